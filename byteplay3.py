@@ -33,6 +33,10 @@ The following names are available from the module:
             a Code object, just as a bytestring of opcodes is the
             co_code member of a code object.
 
+        CodeDiff
+            The differences between two Code objects found by Code.diff(),
+            as an edit script over their CodeLists.
+
         Label
             Class of a minimal object used to mark jump targets in a
             CodeList. A tuple (Label(),None) precedes the tuple for an opcode
@@ -40,6 +44,36 @@ The following names are available from the module:
             to generate a disassembly of a CodeList; they are discarded
             when to_code() re-creates the code object.
 
+        FlowGraph
+            The basic blocks of a CodeList and the control flow between
+            them, as BasicBlock objects. Offers the dominators, back edges
+            and natural loops (as Loop objects) of the code.
+
+        DefUse
+            An index of the positions at which each name in a CodeList is
+            defined and used, with the reaching definitions of fast locals.
+            It follows changes to the CodeList as they are made.
+
+        TypeInference
+            What is known of the type of each value on the stack, and of
+            each fast local, at each instruction of a CodeList: a Known
+            value, an exact type, or nothing (object).
+
+        OffsetMap
+            A map between the bytecode offsets of instructions and their
+            positions in a CodeList, made on request by from_code() and
+            to_code().
+
+        PhaseTimes
+            The number of times, and the seconds spent in, each phase of
+            from_code() and to_code(), such as "decode" and "stacksize",
+            recorded when timing is turned on by set_phase_recorder() or
+            the context manager record_phases().
+
+        Liveness
+            The fast local variables that are live on entry to and exit
+            from each block of a FlowGraph, and after each instruction.
+
     Global vars:
 
         cmp_op
@@ -90,6 +124,16 @@ The following names are available from the module:
             return the stack effect of that opcode as an int, e.g.
             stack_effect( POP_TOP, None ) ==> -1
 
+        call_sites( codelist )
+            return a list of (call, first, last) for each CALL_FUNCTION in
+            the code list, giving the positions of the instructions that
+            loaded the callable, e.g. LOAD_GLOBAL math, LOAD_ATTR sqrt.
+
+        set_phase_recorder( recorder )
+            make recorder, a PhaseTimes or None, receive the times of the
+            phases of from_code() and to_code(); return the previous one.
+            See also the context manager record_phases().
+
         getse( Opcode, arg=None )
             a fake entry point to keep old code that depends on the
             byteplay2 API from breaking; returns a valid tuple
@@ -161,9 +205,14 @@ __email__ = "davecortesi@gmail.com"
 # access to the set of opcode names.
 #
 
-__all__ = ['cmp_op',
+__all__ = ['BasicBlock',
+           'call_sites',
+           'cmp_op',
            'Code',
+           'CodeDiff',
            'CodeList',
+           'DefUse',
+           'FlowGraph',
            'getse',
            'hasarg',
            'hascode',
@@ -176,17 +225,25 @@ __all__ = ['cmp_op',
            'hasfree',
            'hasflow',
            'isopcode',
+           'Known',
            'Label',
+           'Liveness',
+           'Loop',
            'object_attributes',
+           'OffsetMap',
            'Opcode',
            'opmap',
            'opname',
            'opcodes',
+           'PhaseTimes',
            'print_object_attributes',
            'print_attr_values',
            'printcodelist',
+           'record_phases',
            'SetLineno',
-           'stack_effect'
+           'set_phase_recorder',
+           'stack_effect',
+           'TypeInference'
            ]
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -196,7 +253,9 @@ __all__ = ['cmp_op',
 
 import sys
 from io import StringIO
-import itertools # used for .izip()
+import itertools # used for chain()
+import hashlib # used for Code.structural_hash()
+import time # used by PhaseTimes
 
 # An array('B') object is used to represent a bytecode string when creating a
 # code object, see to_code()
@@ -205,6 +264,12 @@ from array import array
 
 import types # used for CodeType and FunctionType
 
+import weakref # CodeList holds its watchers by weak reference
+
+from collections import Counter # counting keys in Code.diff()
+
+from bisect import bisect_left, bisect_right # searching sorted lists: DefUse, OffsetMap
+
 import operator # names for standard operators such as __eq__
 
 # The opcode module is standard, distributed in lib/python3.v, but is NOT
@@ -493,13 +558,123 @@ bytestring is not self-interpreting; it requires use of other slots of a code
 object (code.lnotab etc). So the code that constructs a CodeList is embedded
 inside the from_code() method.
 
-CodeList is a derivative of a standard list class. The only override of
-normal list behavior is the __str__() function.
+CodeList is a derivative of a standard list class. Besides __str__(), it
+overrides the methods that modify the list, so that any modification sets
+self.changed to True and increments self._version, and is reported to the
+watchers of the list, such as a DefUse index, as a "splice": at position
+start, removed items were replaced by added items. When there are no
+watchers this costs one method call, so code that builds a large list
+should build a plain list and make a CodeList of it at the end, as
+from_code() does.
 
     """
     def __init__( self, *args ):
         super().__init__( *args )
         self.changed = False
+        self._version = 0
+        self._watchers = None
+
+    # Watchers are held by weak references, so that an index that is no
+    # longer used does not go on being updated.
+
+    def _watch( self, watcher ):
+        if self._watchers is None :
+            self._watchers = []
+        self._watchers.append( weakref.ref( watcher ) )
+
+    def _spliced( self, start, removed, added ):
+        self.changed = True
+        self._version += 1
+        if self._watchers :
+            live = []
+            for ref in self._watchers :
+                watcher = ref()
+                if watcher is not None :
+                    watcher._splice( start, removed, added )
+                    live.append( ref )
+            self._watchers = live
+
+    def _span( self, index ):
+        # Return (start, count) of the items a slice or index refers to, or
+        # None for an extended slice, which is reported as a change of the
+        # whole list.
+        if isinstance( index, slice ) :
+            start, stop, step = index.indices( len(self) )
+            if step != 1 :
+                return None
+            return start, max( 0, stop - start )
+        if index < 0 :
+            index += len(self)
+        return index, 1
+
+    def __setitem__( self, index, value ):
+        span = self._span( index )
+        if isinstance( index, slice ) :
+            value = list( value )
+        before = len(self)
+        super().__setitem__( index, value )
+        if span is None :
+            self._spliced( 0, before, len(self) )
+        elif isinstance( index, slice ) :
+            self._spliced( span[0], span[1], len(value) )
+        else :
+            self._spliced( span[0], 1, 1 )
+
+    def __delitem__( self, index ):
+        span = self._span( index )
+        before = len(self)
+        super().__delitem__( index )
+        if span is None :
+            self._spliced( 0, before, len(self) )
+        else :
+            self._spliced( span[0], span[1], 0 )
+
+    def __iadd__( self, other ):
+        self.extend( other )
+        return self
+
+    def __imul__( self, n ):
+        before = len(self)
+        super().__imul__( n )
+        self._spliced( 0, before, len(self) )
+        return self
+
+    def append( self, item ):
+        super().append( item )
+        self._spliced( len(self) - 1, 0, 1 )
+
+    def extend( self, items ):
+        items = list( items )
+        super().extend( items )
+        self._spliced( len(self) - len(items), 0, len(items) )
+
+    def insert( self, index, item ):
+        # list.insert() clamps the index to the list
+        start = max( 0, min( len(self), index + len(self) if index < 0 else index ) )
+        super().insert( index, item )
+        self._spliced( start, 0, 1 )
+
+    def pop( self, index=-1 ):
+        start = index + len(self) if index < 0 else index
+        item = super().pop( index )
+        self._spliced( start, 1, 0 )
+        return item
+
+    def remove( self, item ):
+        del self[ self.index( item ) ]
+
+    def clear( self ):
+        before = len(self)
+        super().clear()
+        self._spliced( 0, before, 0 )
+
+    def sort( self, *args, **kwargs ):
+        super().sort( *args, **kwargs )
+        self._spliced( 0, len(self), len(self) )
+
+    def reverse( self ):
+        super().reverse()
+        self._spliced( 0, len(self), len(self) )
 
     def __str__(self):
         """
@@ -513,7 +688,17 @@ normal list behavior is the __str__() function.
                10 STORE_FAST               1 (item)
 
         """
-        output = [] # list of strings being created
+        return '\n'.join( line for pos, line in self.listing() ) + '\n'
+
+    def listing(self):
+        """
+    Return the disassembly of __str__() as a list of (position, line),
+    where position is the index in the list of the opcode shown on the
+    line, or None for the blank line before a new source line. Code that
+    annotates a disassembly can find the line of each opcode here instead
+    of parsing the text.
+        """
+        output = [] # list of (position, string) being created
 
         labeldict = {}
         pendinglabels = []
@@ -534,7 +719,7 @@ normal list behavior is the __str__() function.
                 # not a bytecode. Set up so that the NEXT opcode will display the
                 # line number in the left margin. Output a blank line here.
                 lineno = arg    # note line number value
-                output.append('') # insert the blank line
+                output.append( (None, '') ) # insert the blank line
                 continue # the loop
 
             if isinstance(op, Label):
@@ -579,8 +764,8 @@ normal list behavior is the __str__() function.
                 op,
                 argstr
             )
-            output.append( line )
-        return '\n'.join( output ) + '\n'
+            output.append( (i, line) )
+        return output
 
 def _get_a_code_object_from( thing ) :
     '''
@@ -707,6 +892,176 @@ CO_FUTURE_UNICODE_LITERALS = 0x20000
 CO_FUTURE_BARRY_AS_BDFL   = 0x40000 # Barry White. No, byte array.
 CO_FUTURE_GENERATOR_STOP  = 0x80000
 
+# The phases of from_code() and to_code() can be timed, to see where the
+# time of disassembly and assembly goes. When _phase_recorder is None, as it
+# is unless timing has been asked for, each phase costs one test of a local
+# variable. Otherwise it is a PhaseTimes, which accumulates the number of
+# times each phase was entered and the seconds spent in it. Phases nest:
+# the decode phase of from_code() includes the from_code() of each nested
+# code object, and to_code() the same. The exclusive time of a phase leaves
+# out the time of the phases nested in it, so the exclusive times of all the
+# phases add up to the total time measured.
+
+_phase_recorder = None
+
+class PhaseTimes(object):
+    """
+    Counts and times of the phases of from_code() and to_code().
+
+    totals      dict { phase name : [count, exclusive seconds, inclusive
+                seconds] }; a phase nested in itself (the from_code() of a
+                nested code object) counts in the inclusive time twice.
+
+    start(phase) begins a phase and returns a mark; stop(mark) ends it, and
+    any phases begun after it that were not stopped, as when an exception
+    is raised. timed(phase, function) returns function wrapped to count as
+    a phase. merge(other) adds another PhaseTimes into this one, and
+    summary() returns a table of the totals.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.totals = {}
+        self._stack = [] # of [phase, start time, seconds in nested phases]
+
+    def start(self, phase):
+        self._stack.append( [phase, self.clock(), 0.0] )
+        return len(self._stack) - 1
+
+    def stop(self, mark):
+        now = self.clock()
+        del self._stack[mark+1:]
+        phase, began, nested = self._stack.pop()
+        elapsed = now - began
+        total = self.totals.get(phase)
+        if total is None:
+            total = self.totals[phase] = [0, 0.0, 0.0]
+        total[0] += 1
+        total[1] += elapsed - nested
+        total[2] += elapsed
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def timed(self, phase, function):
+        def timed_function(*args, **kwargs):
+            mark = self.start(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop(mark)
+        return timed_function
+
+    def merge(self, other):
+        for phase, (count, exclusive, inclusive) in other.totals.items():
+            total = self.totals.setdefault(phase, [0, 0.0, 0.0])
+            total[0] += count
+            total[1] += exclusive
+            total[2] += inclusive
+
+    def summary(self):
+        rows = sorted( self.totals.items(), key=lambda item: item[1][1], reverse=True )
+        whole = sum( total[1] for phase, total in rows ) or 1.0
+        lines = [ '%-12s %10s %12s %7s %12s' % ('phase', 'count', 'exclusive', '', 'inclusive') ]
+        for phase, (count, exclusive, inclusive) in rows:
+            lines.append( '%-12s %10d %12.6f %6.1f%% %12.6f' % (
+                phase, count, exclusive, 100.0 * exclusive / whole, inclusive ) )
+        return '\n'.join(lines) + '\n'
+
+def set_phase_recorder(recorder):
+    """
+    Make recorder, a PhaseTimes or None, receive the phase times of all
+    later calls of from_code() and to_code() in this process. Return the
+    recorder it replaces.
+    """
+    global _phase_recorder
+    previous = _phase_recorder
+    _phase_recorder = recorder
+    return previous
+
+class record_phases(object):
+    """
+    A context manager that records the phase times of the code within it,
+    in recorder or a new PhaseTimes, which it returns:
+
+        with record_phases() as times:
+            ...
+        print( times.summary() )
+
+    On exit the recorder in effect before is restored, and the times are
+    added into it, so nested uses accumulate into the outermost.
+    """
+    def __init__(self, recorder=None):
+        self.recorder = recorder if recorder is not None else PhaseTimes()
+    def __enter__(self):
+        self.previous = set_phase_recorder(self.recorder)
+        return self.recorder
+    def __exit__(self, *exc):
+        set_phase_recorder(self.previous)
+        if self.previous is not None:
+            self.previous.merge(self.recorder)
+        return False
+
+# An OffsetMap relates the bytecode offsets of a code object to the
+# positions of the same instructions in a CodeList. Code.from_code() and
+# Code.to_code() make one on request, as they pass over the instructions in
+# any case. A sampling profiler that records frame.f_lasti can then find the
+# instruction of each sample without disassembling the code again.
+
+class OffsetMap(object):
+    """
+    A map in both directions between the bytecode offsets of the
+    instructions of a code object and their positions in a CodeList.
+
+    offsets     array of the offset of each instruction, in order; an
+                instruction with an EXTENDED_ARG starts at the EXTENDED_ARG
+    positions   array of the CodeList position of each instruction
+    size        the length of the bytecode string
+
+    position(offset) returns the position of the instruction that contains
+    offset, by bisection. offset(pos) returns the offset of the instruction
+    at pos, or for a Label or SetLineno, of the instruction that follows it
+    (size when there is none), from an array with an entry for every
+    item of the CodeList.
+    """
+    def __init__(self, offsets, positions, count, size):
+        self.offsets = array('I', offsets)
+        self.positions = array('I', positions)
+        self.size = size
+        self._by_position = array('I', [size]) * count
+        next_offset = size
+        k = len(self.positions) - 1
+        for pos in range(count - 1, -1, -1):
+            if k >= 0 and self.positions[k] == pos:
+                next_offset = self.offsets[k]
+                k -= 1
+            self._by_position[pos] = next_offset
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def position(self, offset):
+        if not 0 <= offset < self.size:
+            raise IndexError('offset out of range')
+        return self.positions[ bisect_right(self.offsets, offset) - 1 ]
+
+    def offset(self, pos):
+        return self._by_position[pos]
+
+    def __repr__(self):
+        return '<OffsetMap %d instructions, %d bytes>' % (len(self.offsets), self.size)
+
+def _const_key(value):
+    # Return a value that is equal for two constants only when one can
+    # stand for the other in co_consts, as codeobject.c decides: 1, 1.0
+    # and True are ==, as are 0.0 and -0.0, but they are not the same
+    # constant. Numbers are told apart by type and repr.
+    if isinstance(value, (int, float, complex)):
+        return (type(value), repr(value))
+    if isinstance(value, tuple):
+        return (tuple, tuple( _const_key(item) for item in value ))
+    if isinstance(value, frozenset):
+        return (frozenset, frozenset( _const_key(item) for item in value ))
+    return (type(value), value)
+
 class Code(object):
     """
 
@@ -725,7 +1080,8 @@ class Code(object):
         equivalent contents.
 
     code
-        the code as CodeList; see class CodeList above.
+        the code as CodeList; see class CodeList above. A plain list
+        assigned to it is copied into a CodeList.
 
     freevars
         list of strings, names of "free" vars of the code. Technically a "free"
@@ -804,6 +1160,21 @@ class Code(object):
         self.firstlineno = firstlineno
         self.docstring = docstring
 
+    # The code list is always a CodeList, since the cached structural hash,
+    # DefUse index and type inference depend on its version to know when it
+    # has changed. A plain list assigned to code is copied into a CodeList,
+    # so keep using code.code, not the list that was assigned.
+
+    @property
+    def code(self):
+        return self._code
+
+    @code.setter
+    def code(self, value):
+        if not isinstance(value, CodeList):
+            value = CodeList(value)
+        self._code = value
+
     @staticmethod
     def _findlinestarts(code_object):
         """
@@ -870,11 +1241,29 @@ class Code(object):
         yield (addr, lineno)
 
     @classmethod
-    def from_code(cls, code_object):
+    def from_code(cls, code_object, offset_map=False):
         """
         Disassemble a Python code object and make a Code object from the bits.
         This is the expected way to make a Code instance. But you are welcome
         to call Code() directly if you wish.
+
+        When offset_map is true, return a tuple (Code, OffsetMap) relating
+        the offsets in code_object.co_code to the positions in the CodeList.
+        """
+        recorder = _phase_recorder
+        if recorder is None :
+            return cls._from_code(code_object, offset_map, None)
+        mark = recorder.start('from_code')
+        try :
+            return cls._from_code(code_object, offset_map, recorder)
+        finally :
+            recorder.stop(mark)
+
+    @classmethod
+    def _from_code(cls, code_object, offset_map, recorder):
+        """
+        The work of from_code(). When recorder is not None, the time of
+        each phase is recorded in it.
         """
         # It's an annoyance to keep having to add ".__code__" to a function
         # name, so let's automate that when needed.
@@ -889,26 +1278,43 @@ class Code(object):
         # printout.) Store the list as a dict{ addr: Label object} for easy
         # lookup.
 
+        if recorder is not None :
+            mark = recorder.start('findlabels')
         labels = dict((addr, Label()) for addr in findlabels(co_code))
+        if recorder is not None :
+            recorder.stop(mark)
 
         # Make a dict{ source_line : offset } for the source lines in the code.
 
+        if recorder is not None :
+            mark = recorder.start('linestarts')
         linestarts = dict(cls._findlinestarts(code_object))
+        if recorder is not None :
+            recorder.stop(mark)
 
         cellfree = code_object.co_cellvars + code_object.co_freevars
 
-        # Create a CodeList object to represent the bytecode string.
+        # Build a plain list to represent the bytecode string. It becomes a
+        # CodeList at the end, so the building does not pay for the change
+        # tracking of CodeList.
 
-        code = CodeList()   # receives (op,arg) tuples
+        code = []   # receives (op,arg) tuples, made a CodeList at the end
         n = len(co_code)    # number bytes in the bytecode string
         i = 0               # index over the bytecode string
         extended_arg = 0    # upper 16 bits of an extended arg
+        op_start = None     # offset of the current instruction, or of its EXTENDED_ARG
+        offsets = []        # for the OffsetMap, offset and position of each
+        positions = []      # instruction
 
         # Iterate over the bytecode string expanding it into (Opcode,arg) tuples.
 
+        if recorder is not None :
+            mark = recorder.start('decode')
         while i < n:
             # First byte is the opcode
             op = Opcode( co_code[i] )
+            if op_start is None :
+                op_start = i
 
             # If this op is a jump-target, insert (Label,) ahead of it.
             if i in labels:
@@ -996,6 +1402,15 @@ class Code(object):
                     # whatever, just put the arg in the tuple
                     code.append((op, arg))
 
+            # Every opcode but EXTENDED_ARG has now added one tuple.
+            if op != opcode.EXTENDED_ARG :
+                if offset_map :
+                    offsets.append(op_start)
+                    positions.append(len(code) - 1)
+                op_start = None
+        if recorder is not None :
+            recorder.stop(mark)
+
         # Store certain flags from the code object as booleans for convenient
         # reference as Code members.
 
@@ -1022,7 +1437,7 @@ class Code(object):
             docstring = code_object.co_consts[0]
 
         # Funnel all the collected bits through the Code.__init__() method.
-        return cls( code = code,
+        result = cls( code = CodeList( code ),
                     freevars = code_object.co_freevars,
                     args = args,
                     varargs = varargs,
@@ -1035,13 +1450,24 @@ class Code(object):
                     firstlineno = code_object.co_firstlineno,
                     docstring = docstring
                     )
+        if offset_map :
+            return result, OffsetMap(offsets, positions, len(code), n)
+        return result
 
     # Define equality between Code objects the same way that codeobject.c
     # implements the equality test, by ORing the inequalities of each part.
-    # If all attributes are equal, then test the individual tuples of the
-    # two CodeList objects.
+    # If all attributes are equal, then compare the structural hashes of the
+    # two CodeList objects, which are usually cached and which differ for
+    # almost any two code lists that are not equal. Only when they are the
+    # same are the individual tuples of the code lists compared. Constants
+    # are compared by _const_key, so that LOAD_CONST 1 and LOAD_CONST 1.0
+    # are different instructions, as they are to codeobject.c.
 
     def __eq__(self, other):
+        if not isinstance(other, Code):
+            return NotImplemented
+        if self is other:
+            return True
         if (self.freevars != other.freevars or
             self.args != other.args or
             self.varargs != other.varargs or
@@ -1055,14 +1481,17 @@ class Code(object):
             len(self.code) != len(other.code)
             ):
             return False
+        if self.structural_hash() != other.structural_hash():
+            return False
 
         # Compare code. For codeobject.c this would be a comparison of two
         # bytestrings, but this is harder because of extra info, e.g. labels
         # should be matching, not necessarily identical.
         labelmapping = {}
-        for (op1, arg1), (op2, arg2) in itertools.izip(self.code, other.code):
+        for (op1, arg1), (op2, arg2) in zip(self.code, other.code):
             if isinstance(op1, Label):
-                if labelmapping.setdefault(op1, op2) is not op2:
+                if not isinstance(op2, Label) \
+                   or labelmapping.setdefault(op1, op2) is not op2:
                     return False
             else:
                 if op1 != op2:
@@ -1070,11 +1499,105 @@ class Code(object):
                 if op1 in hasjump:
                     if labelmapping.setdefault(arg1, arg2) is not arg2:
                         return False
+                elif op1 in hasconst:
+                    if _const_key(arg1) != _const_key(arg2):
+                        return False
                 elif op1 in hasarg:
                     if arg1 != arg2:
                         return False
         return True
 
+    # A structural hash is a digest of what makes two Code objects equal,
+    # so that equal Code objects have equal hashes. Labels are numbered in
+    # the order they first appear, as an item or as the target of a jump,
+    # so the hash does not depend on which Label objects are used. Numbers
+    # are represented by their type and repr, as _const_key tells them
+    # apart; their Python hash() will not do, since hash(-1) == hash(-2).
+    # Other constants are represented by type and repr too, which for the
+    # objects make_constants binds (modules, functions, classes) names the
+    # object itself. Nested Code objects are represented by their own
+    # hashes.
+    #
+    # The name, filename and firstlineno are left out, so functions that
+    # differ only in those hash alike; that is what finding duplicate
+    # functions in a large body of code needs. Line numbers are left out
+    # unless asked for, and then they are taken relative to firstlineno.
+    #
+    # The digest of the code list is kept with the CodeList and its version
+    # (Code.code is always a CodeList, whose version changes with every
+    # edit), the firstlineno when line numbers are included, and the hashes
+    # of the nested Code objects it was made from, and is made again only
+    # when one of those has changed.
+
+    def structural_hash(self, lineno=False):
+        """
+        Return a hex digest of the structure of this Code object: its
+        opcodes and their arguments, the shape of its jumps, its argument
+        and free variable names and flags, and nested Code objects. With
+        lineno=True the source line numbers are included.
+        """
+        cache = self.__dict__.setdefault('_structural_hash', {})
+        kept = cache.get(lineno)
+        version = self.code._version
+        # Line numbers are hashed relative to firstlineno, so with lineno
+        # the digest also depends on it.
+        first = self.firstlineno if lineno else None
+        if kept is not None and kept[0] is self.code and kept[1] == version \
+           and kept[2] == first \
+           and all( code.structural_hash(lineno) == digest
+                    for code, digest in kept[3] ):
+            code_digest = kept[4]
+        else:
+            nested = []
+            code_digest = self._code_digest(lineno, nested)
+            cache[lineno] = (self.code, version, first, nested, code_digest)
+        digest = hashlib.sha1( code_digest.encode('ascii') )
+        digest.update( repr( ( tuple(self.freevars), tuple(self.args),
+                               bool(self.varargs), bool(self.varkwargs),
+                               self.kwonlyargcount, bool(self.newlocals),
+                               self.docstring ) ).encode('utf-8', 'backslashreplace') )
+        return digest.hexdigest()
+
+    def _code_digest(self, lineno, nested):
+        # Return the digest of the code list alone. Append to nested a
+        # pair (Code, hash) for each nested Code object.
+        def key(value):
+            if isinstance(value, Code):
+                digest = value.structural_hash(lineno)
+                nested.append( (value, digest) )
+                return 'C' + digest
+            if isinstance(value, (str, bytes)) or value is None or value is Ellipsis:
+                return repr(value)
+            if isinstance(value, tuple):
+                return '(' + ','.join( key(item) for item in value ) + ')'
+            if isinstance(value, frozenset):
+                return '{' + ','.join( sorted( key(item) for item in value ) ) + '}'
+            return '%s:%r' % (type(value).__name__, value)
+        labels = {}
+        parts = []
+        for op, arg in self.code:
+            if isinstance(op, Label):
+                parts.append( 'L%d' % labels.setdefault(op, len(labels)) )
+            elif op is SetLineno:
+                parts.append( 'N%d' % (arg - self.firstlineno) if lineno else 'N' )
+            elif op in hasjump:
+                parts.append( '%d>%d' % (op, labels.setdefault(arg, len(labels))) )
+            elif op in hasarg:
+                parts.append( '%d:%s' % (op, key(arg)) )
+            else:
+                parts.append( '%d' % op )
+        return hashlib.sha1( ' '.join(parts).encode('utf-8', 'backslashreplace') ).hexdigest()
+
+    def diff(self, other):
+        """
+        Return a CodeDiff of the differences between this Code object and
+        other: which items of this code list were deleted, inserted or
+        replaced to make the other, which jumps go to different places, and
+        how nested Code objects differ. Labels are matched by position, as
+        __eq__ matches them, not by identity.
+        """
+        return CodeDiff(self, other)
+
     # Re-create the co_flags value based in part on the booleans we pulled
     # out into the Code object (which can be modified by users of the API!)
     # and in part on the contents of the code string itself.
@@ -1308,13 +1831,34 @@ class Code(object):
 
         return maxsize
 
-    def to_code(self):
+    def to_code(self, offset_map=False):
         """
         Assemble a Python code object from this Code object.
+
+        When offset_map is true, return a tuple (code object, OffsetMap)
+        relating the positions in the CodeList to the offsets in co_code.
+        """
+        recorder = _phase_recorder
+        if recorder is None :
+            return self._to_code(offset_map, None)
+        mark = recorder.start('to_code')
+        try :
+            return self._to_code(offset_map, recorder)
+        finally :
+            recorder.stop(mark)
+
+    def _to_code(self, offset_map, recorder):
+        """
+        The work of to_code(). When recorder is not None, the time of each
+        phase is recorded in it.
         """
         co_argcount = len(self.args) - self.varargs - self.varkwargs - self.kwonlyargcount
         co_kwonlyargcount = self.kwonlyargcount
+        if recorder is not None :
+            mark = recorder.start('stacksize')
         co_stacksize = self._compute_stacksize()
+        if recorder is not None :
+            recorder.stop(mark)
         co_flags = self._compute_flags()
 
         co_consts = [self.docstring]
@@ -1353,6 +1897,11 @@ class Code(object):
                 else:
                     raise IndexError("Item not found")
 
+        # When timing, the lookups of constants and names count as a phase
+        # of their own, "intern".
+        if recorder is not None :
+            index = recorder.timed('intern', index)
+
         # List of tuples (pos, label) to be filled later
         jumps = []
         # A mapping from a label to its position
@@ -1361,9 +1910,16 @@ class Code(object):
         lastlineno = self.firstlineno
         lastlinepos = 0
 
+        if recorder is not None :
+            mark = recorder.start('assemble')
         co_code = array('B')
         co_lnotab = array('B')
+        offsets = []
+        positions = []
         for i, (op, arg) in enumerate(self.code):
+            if offset_map and isopcode(op):
+                offsets.append(len(co_code))
+                positions.append(i)
             if isinstance(op, Label):
                 label_pos[op] = len(co_code)
 
@@ -1454,6 +2010,8 @@ class Code(object):
                 raise NotImplementedError("Extended jumps not implemented")
             co_code[pos+1] = jump & 0xFF
             co_code[pos+2] = (jump >> 8) & 0xFF
+        if recorder is not None :
+            recorder.stop(mark)
 
         co_code = co_code.tostring()
         co_lnotab = co_lnotab.tostring()
@@ -1464,11 +2022,1675 @@ class Code(object):
         co_nlocals = len(co_varnames)
         co_cellvars = tuple(co_cellvars)
 
-        return types.CodeType(co_argcount, co_kwonlyargcount, co_nlocals, co_stacksize, co_flags,
-                              co_code,
-                              co_consts, co_names, co_varnames,
-                              self.filename, self.name, self.firstlineno, co_lnotab,
-                              co_freevars, co_cellvars)
+        if recorder is not None :
+            mark = recorder.start('CodeType')
+        result = types.CodeType(co_argcount, co_kwonlyargcount, co_nlocals, co_stacksize, co_flags,
+                                co_code,
+                                co_consts, co_names, co_varnames,
+                                self.filename, self.name, self.firstlineno, co_lnotab,
+                                co_freevars, co_cellvars)
+        if recorder is not None :
+            recorder.stop(mark)
+        if offset_map:
+            return result, OffsetMap(offsets, positions, len(self.code), len(co_code))
+        return result
+
+    def flow_graph(self):
+        """
+        Return a FlowGraph of the basic blocks of this object's code list.
+        The graph is not updated when the code list changes; make a new one.
+        """
+        return FlowGraph(self.code)
+
+    def liveness(self):
+        """
+        Return a Liveness analysis of the fast locals of this object's code
+        list. Like the flow graph, it is not updated when the code changes.
+        """
+        return Liveness(self.code)
+
+    def def_use(self):
+        """
+        Return a DefUse index of this object's code list. The index is made
+        once and kept; it follows changes to the code list. (If the code
+        attribute is replaced by a different list, a new index is made.)
+        """
+        index = getattr(self, '_def_use', None)
+        if index is None or index.code is not self.code:
+            index = DefUse(self.code)
+            self._def_use = index
+        return index
+
+    def infer_types(self, namespace=None):
+        """
+        Return a TypeInference of this object's code list, with the given
+        namespace of globals if any. The result is kept, and returned again
+        until the code list changes or a different namespace is given.
+        """
+        kept = getattr(self, '_types', None)
+        version = self.code._version
+        if kept is not None and kept[0] is self.code and kept[1] == version \
+           and kept[2] is namespace:
+            return kept[3]
+        result = TypeInference(self, namespace)
+        self._types = (self.code, version, namespace, result)
+        return result
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Control-flow analysis. A FlowGraph divides a CodeList into basic blocks,
+# runs of code that are entered only at the top and left only at the bottom,
+# and records how control passes between them. Optimizing passes use it to
+# find loops and to do data-flow analysis.
+#
+# The opcodes that set up a block on the frame's block stack. The target of
+# each is where control goes when the block is left abnormally: the end of
+# the loop for SETUP_LOOP, the exception handler for the others. (There is
+# no SETUP_ASYNC_WITH before Python 3.5.)
+
+_setup_ops = set( Opcode(opmap[name])
+                  for name in ('SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY',
+                               'SETUP_WITH', 'SETUP_ASYNC_WITH')
+                  if name in opmap
+                )
+_handler_ops = _setup_ops - set( [ Opcode(SETUP_LOOP) ] )
+
+# The opcodes after which control never continues with the next item.
+
+_no_fallthrough = set( [ Opcode(RETURN_VALUE), Opcode(RAISE_VARARGS),
+                         Opcode(BREAK_LOOP), Opcode(CONTINUE_LOOP),
+                         Opcode(JUMP_FORWARD), Opcode(JUMP_ABSOLUTE) ] )
+
+class BasicBlock(object):
+    """
+    One basic block of a FlowGraph. Its items are codelist[start:end].
+
+    index       position of the block in FlowGraph.blocks
+    succs       blocks to which control passes in the normal course of
+                events, including the targets of the SETUP_xxx opcodes
+    preds       blocks from which control passes here normally
+    handlers    blocks that receive control when an exception is raised
+                in this block: the targets of the SETUP_EXCEPT, SETUP_FINALLY
+                and SETUP_WITH blocks that enclose it
+    """
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.succs = []
+        self.preds = []
+        self.handlers = []
+    def __repr__(self):
+        return '<BasicBlock %d [%d:%d]>' % (self.index, self.start, self.end)
+
+class Loop(object):
+    """
+    A natural loop found by FlowGraph.loops().
+
+    header      the BasicBlock entered on every iteration
+    blocks      frozenset of the BasicBlocks in the loop, header included
+    tails       the blocks that jump back to the header
+    parent      the innermost Loop that contains this one, or None
+    children    the Loops whose parent this is
+    depth       1 for an outermost loop, 2 for a loop within it, ...
+    kind        'for' when the header begins with FOR_ITER, 'while' when
+                the loop is entered after a SETUP_LOOP, else 'other'
+    """
+    def __init__(self, header, blocks, tails):
+        self.header = header
+        self.blocks = blocks
+        self.tails = tails
+        self.parent = None
+        self.children = []
+        self.depth = 1
+        self.kind = 'other'
+    def __repr__(self):
+        return '<Loop at %d, %d blocks>' % (self.header.start, len(self.blocks))
+
+class FlowGraph(object):
+    """
+    The basic blocks of a CodeList and the control flow among them.
+
+    FlowGraph(thing) accepts a CodeList or a Code object. Its attributes are
+
+    code        the CodeList that was analyzed
+    blocks      list of BasicBlock objects in code-list order; blocks[0]
+                is the entry block
+    block_of    list giving, for each position in code, the BasicBlock
+                that contains it
+
+    The graph is a snapshot: if the code list is modified, build a new one.
+    """
+    def __init__(self, thing):
+        code = thing.code if isinstance( thing, Code ) else thing
+        self.code = code
+
+        label_pos = { op : pos
+                        for pos, (op, arg) in enumerate(code)
+                        if isinstance(op, Label)
+                    }
+
+        # Find the leaders, the positions that begin a block: the first
+        # item, each label (or the first of a run of labels), and each item
+        # that follows a jump or a transfer of control.
+        leaders = set( [0] )
+        after_jump = False
+        for pos, (op, arg) in enumerate(code):
+            if isinstance(op, Label):
+                if after_jump or pos == 0 or not isinstance(code[pos-1][0], Label):
+                    leaders.add(pos)
+            elif after_jump:
+                leaders.add(pos)
+            after_jump = isopcode(op) and (op in hasjump or op in _no_fallthrough)
+        starts = sorted( p for p in leaders if p < len(code) )
+        self.blocks = []
+        self.block_of = [None] * len(code)
+        for i, start in enumerate(starts):
+            end = starts[i+1] if i+1 < len(starts) else len(code)
+            block = BasicBlock(i, start, end)
+            self.blocks.append(block)
+            self.block_of[start:end] = [block] * (end - start)
+        self.entry = self.blocks[0] if self.blocks else None
+
+        # Walk the code as it would execute, carrying the stack of blocks set
+        # up by SETUP_xxx opcodes as a tuple of (opcode, target label). This
+        # is how BREAK_LOOP finds its loop and how each instruction finds its
+        # exception handlers. It is the same walk _compute_stacksize makes,
+        # but without tracking the value stack.
+        setups = [None] * len(code)
+        open_positions = [(0, ())] if code else []
+        while open_positions:
+            pos, state = open_positions.pop()
+            while pos < len(code):
+                if setups[pos] is not None:
+                    break
+                setups[pos] = state
+                op, arg = code[pos]
+                if not isopcode(op):
+                    pos += 1
+                    continue
+                if op in _setup_ops:
+                    open_positions.append( (label_pos[arg], state) )
+                    state = state + ((op, arg),)
+                elif op == POP_BLOCK:
+                    state = state[:-1]
+                elif op in hasjump:
+                    open_positions.append( (label_pos[arg], state) )
+                elif op == BREAK_LOOP:
+                    loops = [arg for (setup, arg) in state if setup == SETUP_LOOP]
+                    if loops:
+                        open_positions.append( (label_pos[loops[-1]], state) )
+                if op in _no_fallthrough:
+                    break
+                pos += 1
+
+        # Now connect the blocks. Each block takes its successors from its
+        # last item, and its handlers from the state of each item in it.
+        for block in self.blocks:
+            handlers = []
+            for pos in range(block.start, block.end):
+                for setup, target in (setups[pos] or ()):
+                    if setup in _handler_ops:
+                        handler = self.block_of[label_pos[target]]
+                        if handler not in handlers:
+                            handlers.append(handler)
+            block.handlers = handlers
+            op, arg = code[block.end - 1]
+            targets = []
+            if isopcode(op):
+                if op in hasjump:
+                    targets.append(label_pos[arg])
+                elif op == BREAK_LOOP:
+                    state = setups[block.end - 1] or ()
+                    loops = [arg for (setup, arg) in state if setup == SETUP_LOOP]
+                    if loops:
+                        targets.append(label_pos[loops[-1]])
+                if op not in _no_fallthrough and block.end < len(code):
+                    targets.insert(0, block.end)
+            elif block.end < len(code):
+                targets.append(block.end)
+            for target in targets:
+                succ = self.block_of[target]
+                if succ not in block.succs:
+                    block.succs.append(succ)
+                    succ.preds.append(block)
+        self._idom = None
+
+    def reachable(self):
+        """
+        Return the list of blocks reachable from the entry block in reverse
+        postorder, meaning each block precedes its successors except where
+        a successor is reached by a back edge.
+        """
+        if not self.blocks:
+            return []
+        order = []
+        seen = set( [self.entry.index] )
+        stack = [(self.entry, iter(self.entry.succs + self.entry.handlers))]
+        while stack:
+            block, successors = stack[-1]
+            for succ in successors:
+                if succ.index not in seen:
+                    seen.add(succ.index)
+                    stack.append( (succ, iter(succ.succs + succ.handlers)) )
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        order.reverse()
+        return order
+
+    def dominators(self):
+        """
+        Return a list giving, for each block, its immediate dominator: the
+        nearest block through which every path from the entry must pass.
+        The entry block, and any unreachable block, has None.
+        (This is the algorithm of Cooper, Harvey and Kennedy, "A Simple,
+        Fast Dominance Algorithm".)
+        """
+        if self._idom is not None:
+            return self._idom
+        order = self.reachable()
+        rpo = { block.index : n for n, block in enumerate(order) }
+        idom = [None] * len(self.blocks)
+        if order:
+            idom[self.entry.index] = self.entry
+        def intersect(a, b):
+            while a is not b:
+                while rpo[a.index] > rpo[b.index]:
+                    a = idom[a.index]
+                while rpo[b.index] > rpo[a.index]:
+                    b = idom[b.index]
+            return a
+        # Exception handlers count as successors of the blocks they cover.
+        preds = [[] for block in self.blocks]
+        for block in order:
+            for succ in block.succs + block.handlers:
+                preds[succ.index].append(block)
+        changed = True
+        while changed:
+            changed = False
+            for block in order[1:]:
+                new = None
+                for pred in preds[block.index]:
+                    if idom[pred.index] is not None:
+                        new = pred if new is None else intersect(pred, new)
+                if new is not idom[block.index]:
+                    idom[block.index] = new
+                    changed = True
+        if order:
+            idom[self.entry.index] = None
+        self._idom = idom
+        return idom
+
+    def dominates(self, a, b):
+        """
+        Return True when every path from the entry to block b passes
+        through block a (a block dominates itself).
+        """
+        idom = self.dominators()
+        while b is not None:
+            if b is a:
+                return True
+            b = idom[b.index]
+        return False
+
+    def back_edges(self):
+        """
+        Return a list of (tail, header) pairs of blocks where tail jumps
+        back to a header that dominates it.
+        """
+        reachable = set( block.index for block in self.reachable() )
+        return [ (block, succ)
+                 for block in self.blocks if block.index in reachable
+                 for succ in block.succs if self.dominates(succ, block)
+               ]
+
+    def loops(self):
+        """
+        Return a list of Loop objects, one for each header block that is the
+        target of a back edge, outermost (largest) loops first. The body of
+        a loop is the header plus all blocks that can reach a tail without
+        passing through the header.
+        """
+        tails = {}
+        for tail, header in self.back_edges():
+            tails.setdefault(header, []).append(tail)
+        loops = []
+        for header, tail_list in tails.items():
+            body = set( [header] )
+            work = [t for t in tail_list if t is not header]
+            body.update(work)
+            while work:
+                block = work.pop()
+                for pred in block.preds:
+                    if pred not in body:
+                        body.add(pred)
+                        work.append(pred)
+            loops.append( Loop(header, frozenset(body), tail_list) )
+        loops.sort( key=lambda loop: (-len(loop.blocks), loop.header.start) )
+
+        # Two natural loops with different headers are either disjoint or
+        # one contains the other, so the parent of a loop is the smallest
+        # of those before it in the list that contains its header.
+        for n, loop in enumerate(loops):
+            for outer in reversed(loops[:n]):
+                if loop.header in outer.blocks:
+                    loop.parent = outer
+                    loop.depth = outer.depth + 1
+                    outer.children.append(loop)
+                    break
+            loop.kind = self._loop_kind(loop)
+        return loops
+
+    def _loop_kind(self, loop):
+        code = self.code
+        header = loop.header
+        for pos in range(header.start, header.end):
+            if isopcode(code[pos][0]):
+                if code[pos][0] == FOR_ITER:
+                    return 'for'
+                break
+        # A while loop is entered from the block ending in its SETUP_LOOP
+        # (a for loop's SETUP_LOOP is followed by the GET_ITER of the
+        # iterable instead).
+        for pred in header.preds:
+            if pred not in loop.blocks:
+                for pos in range(pred.end - 1, pred.start - 1, -1):
+                    if isopcode(code[pos][0]):
+                        if code[pos][0] == SETUP_LOOP:
+                            return 'while'
+                        break
+        return 'other'
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Liveness of fast locals. A local is live at a point in the code when some
+# path from that point loads it before storing it again. The analysis is the
+# classic backward data-flow problem over the blocks of a FlowGraph:
+#
+#   live_out(B) = union of live_in(S) for each successor S of B
+#   live_in(B)  = used(B) | (live_out(B) - defined(B))
+#
+# where used(B) is the set of locals loaded in B before any store in B, and
+# defined(B) is the set stored in B. DELETE_FAST counts as a use, since it
+# raises an error when the local is unbound, and then as a definition.
+#
+# An exception can leave a block at any point, so every local that is live
+# on entry to one of a block's handlers is live throughout the block.
+
+class Liveness(object):
+    """
+    The liveness of the fast locals of a FlowGraph.
+
+    Liveness(thing) accepts a FlowGraph, a CodeList or a Code object. Its
+    attributes are
+
+    graph       the FlowGraph that was analyzed
+    live_in     list giving, for each block, the frozenset of local names
+                live on entry to the block
+    live_out    list giving, for each block, the frozenset of local names
+                live on leaving the block
+
+    Like the FlowGraph, the result is a snapshot of the code list.
+    """
+    def __init__(self, thing):
+        graph = thing if isinstance( thing, FlowGraph ) else FlowGraph(thing)
+        self.graph = graph
+        code = graph.code
+        used = []
+        defined = []
+        for block in graph.blocks:
+            u = set()
+            d = set()
+            for pos in range(block.start, block.end):
+                op, arg = code[pos]
+                if op == LOAD_FAST or op == DELETE_FAST:
+                    if arg not in d:
+                        u.add(arg)
+                if op == STORE_FAST or op == DELETE_FAST:
+                    d.add(arg)
+            used.append(u)
+            defined.append(d)
+
+        live_in = [frozenset()] * len(graph.blocks)
+        live_out = [frozenset()] * len(graph.blocks)
+        # Visit the blocks in postorder, which for a backward problem
+        # settles most of them in one pass, and repeat until nothing changes.
+        order = graph.reachable()[::-1]
+        reached = set( block.index for block in order )
+        order.extend( block for block in reversed(graph.blocks)
+                      if block.index not in reached )
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                i = block.index
+                out = set()
+                for succ in block.succs:
+                    out |= live_in[succ.index]
+                caught = set()
+                for handler in block.handlers:
+                    caught |= live_in[handler.index]
+                new_in = frozenset( used[i] | (out - defined[i]) | caught )
+                live_out[i] = frozenset( out | caught )
+                if new_in != live_in[i]:
+                    live_in[i] = new_in
+                    changed = True
+        self.live_in = live_in
+        self.live_out = live_out
+        self._after = {}
+
+    def _block_after(self, block):
+        # The live set after each item of a block, computed backward from
+        # live_out and cached.
+        after = self._after.get(block.index)
+        if after is None:
+            code = self.graph.code
+            caught = set()
+            for handler in block.handlers:
+                caught |= self.live_in[handler.index]
+            live = set( self.live_out[block.index] )
+            after = [None] * (block.end - block.start)
+            for pos in range(block.end - 1, block.start - 1, -1):
+                after[pos - block.start] = frozenset(live)
+                op, arg = code[pos]
+                if op == STORE_FAST:
+                    live.discard(arg)
+                    live |= caught
+                elif op == LOAD_FAST or op == DELETE_FAST:
+                    live.add(arg)
+            self._after[block.index] = after
+        return after
+
+    def live_after(self, pos):
+        """
+        Return the frozenset of local names live just after the item at
+        position pos of the code list has executed.
+        """
+        block = self.graph.block_of[pos]
+        return self._block_after(block)[pos - block.start]
+
+    def live_before(self, pos):
+        """
+        Return the frozenset of local names live just before the item at
+        position pos of the code list executes.
+        """
+        block = self.graph.block_of[pos]
+        if pos == block.start:
+            return self.live_in[block.index]
+        return self._block_after(block)[pos - block.start - 1]
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# A def-use index. For each name in a CodeList it records the positions of
+# the instructions that define (store or delete) the name and that use
+# (load) it. Names are keyed by kind, since the same string can be a local,
+# a global and an attribute in one code list:
+#
+#   'fast'      LOAD_FAST; STORE_FAST, DELETE_FAST
+#   'global'    LOAD_GLOBAL; STORE_GLOBAL, DELETE_GLOBAL
+#   'name'      LOAD_NAME; STORE_NAME, DELETE_NAME
+#   'deref'     LOAD_DEREF, LOAD_CLASSDEREF, LOAD_CLOSURE;
+#               STORE_DEREF, DELETE_DEREF
+#   'attr'      LOAD_ATTR; STORE_ATTR, DELETE_ATTR
+#
+# The index registers itself as a watcher of the CodeList, which reports
+# every modification as a splice. A splice shifts the positions after it,
+# drops those in the removed range, and scans only the added items. The
+# reaching definitions of fast locals are computed, one name at a time,
+# only when asked for, and forgotten at the next splice.
+
+def _def_use_kinds():
+    kinds = {}
+    for kind, uses, defs in (
+            ('fast', ['LOAD_FAST'], ['STORE_FAST', 'DELETE_FAST']),
+            ('global', ['LOAD_GLOBAL'], ['STORE_GLOBAL', 'DELETE_GLOBAL']),
+            ('name', ['LOAD_NAME'], ['STORE_NAME', 'DELETE_NAME']),
+            ('deref', ['LOAD_DEREF', 'LOAD_CLASSDEREF', 'LOAD_CLOSURE'],
+                      ['STORE_DEREF', 'DELETE_DEREF']),
+            ('attr', ['LOAD_ATTR'], ['STORE_ATTR', 'DELETE_ATTR']) ):
+        for name in uses:
+            if name in opmap:
+                kinds[Opcode(opmap[name])] = (kind, False)
+        for name in defs:
+            if name in opmap:
+                kinds[Opcode(opmap[name])] = (kind, True)
+    return kinds
+
+_def_use_ops = _def_use_kinds()
+
+class DefUse(object):
+    """
+    An index of where each name is defined and used in a CodeList.
+
+    DefUse(thing) accepts a CodeList (not a plain list, whose changes
+    cannot be followed) or a Code object; Code.def_use() returns
+    one that is kept with the Code object. The index follows changes to the
+    CodeList as they are made. kind is one of 'fast', 'global', 'name',
+    'deref' or 'attr'. The lists of positions returned are sorted, and are
+    the index's own: do not modify them.
+    """
+    def __init__(self, thing):
+        code = thing.code if isinstance( thing, Code ) else thing
+        if not isinstance( code, CodeList ):
+            raise ValueError("DefUse needs a CodeList, to follow its changes")
+        self.code = code
+        self._rebuild()
+        code._watch(self)
+
+    def _rebuild(self):
+        self._defs = {}
+        self._uses = {}
+        self._reaching = {}
+        self._graph = None
+        self._scan(0, len(self.code))
+        self._version = self.code._version
+
+    def _scan(self, start, end):
+        # Add the names of code[start:end] to the index. The positions are
+        # greater than those of all entries after start, or the caller has
+        # made room for them, so each insertion keeps its list sorted.
+        code = self.code
+        for pos in range(start, end):
+            op, arg = code[pos]
+            entry = _def_use_ops.get(op)
+            if entry is not None:
+                kind, is_def = entry
+                table = self._defs if is_def else self._uses
+                positions = table.setdefault( (kind, arg), [] )
+                positions.insert( bisect_left(positions, pos), pos )
+
+    def _splice(self, start, removed, added):
+        shift = added - removed
+        stop = start + removed
+        for table in (self._defs, self._uses):
+            for key in list(table):
+                positions = table[key]
+                i = bisect_left(positions, start)
+                if i == len(positions):
+                    continue
+                tail = [ p + shift for p in positions[i:] if p >= stop ]
+                positions[i:] = tail
+                if not positions:
+                    del table[key]
+        self._scan(start, start + added)
+        self._reaching = {}
+        self._graph = None
+        self._version = self.code._version
+
+    def _check(self):
+        if self._version != self.code._version:
+            self._rebuild()
+
+    def defs(self, kind, name):
+        """
+        Return the sorted list of positions that store or delete name.
+        """
+        self._check()
+        return self._defs.get( (kind, name), [] )
+
+    def uses(self, kind, name):
+        """
+        Return the sorted list of positions that load name.
+        """
+        self._check()
+        return self._uses.get( (kind, name), [] )
+
+    def is_stored(self, kind, name):
+        """
+        Return True when some instruction stores or deletes name.
+        """
+        self._check()
+        return (kind, name) in self._defs
+
+    def names(self, kind):
+        """
+        Return the set of names of the given kind that are defined or used.
+        """
+        self._check()
+        return set( name for (k, name) in itertools.chain(self._defs, self._uses)
+                    if k == kind )
+
+    def reaching(self, pos):
+        """
+        Return the sorted list of positions of the STORE_FAST and DELETE_FAST
+        instructions whose definition may reach the LOAD_FAST (or other fast
+        local instruction) at pos. The list begins with None when the value
+        the local had on entry, an argument or unbound, may reach it.
+        """
+        self._check()
+        op, name = self.code[pos]
+        reach_in, at = self._reaching_for(name)
+        return at[pos]
+
+    def reached(self, pos):
+        """
+        Return the sorted list of positions of the LOAD_FAST instructions
+        that may see the value stored by the STORE_FAST at pos.
+        """
+        self._check()
+        op, name = self.code[pos]
+        reach_in, at = self._reaching_for(name)
+        return [ use for use in self._uses.get( ('fast', name), [] )
+                 if pos in at[use] ]
+
+    def _reaching_for(self, name):
+        # Compute the definitions of one local that reach each of its uses
+        # and definitions, by the usual forward data-flow over the blocks.
+        # An exception can leave a block at any point, so the definitions
+        # that reach a handler include all those made in the blocks it
+        # protects. Return (reach_in, at) where reach_in gives the set for
+        # each block and at is { position : sorted list }.
+        cached = self._reaching.get(name)
+        if cached is not None:
+            return cached
+        if self._graph is None:
+            graph = FlowGraph(self.code)
+            protects = [[] for block in graph.blocks]
+            for block in graph.blocks:
+                for handler in block.handlers:
+                    protects[handler.index].append(block)
+            self._graph = (graph, protects)
+        graph, protects = self._graph
+        defs = self._defs.get( ('fast', name), [] )
+        block_defs = {}
+        for d in defs:
+            block_defs.setdefault(graph.block_of[d].index, []).append(d)
+        reach_in = [frozenset()] * len(graph.blocks)
+        reach_out = [frozenset()] * len(graph.blocks)
+        if graph.entry is not None:
+            reach_in[graph.entry.index] = frozenset( [None] )
+        order = graph.reachable()
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                i = block.index
+                new_in = set( reach_in[i] ) if block is graph.entry else set()
+                for pred in block.preds:
+                    new_in |= reach_out[pred.index]
+                for other in protects[i]:
+                    new_in |= reach_in[other.index]
+                    new_in.update( block_defs.get(other.index, ()) )
+                new_in = frozenset(new_in)
+                mine = block_defs.get(i)
+                new_out = frozenset( [mine[-1]] ) if mine else new_in
+                if new_in != reach_in[i] or new_out != reach_out[i]:
+                    reach_in[i] = new_in
+                    reach_out[i] = new_out
+                    changed = True
+        at = {}
+        for kind_table in (self._uses, self._defs):
+            for p in kind_table.get( ('fast', name), [] ):
+                block = graph.block_of[p]
+                before = [ d for d in block_defs.get(block.index, ()) if d < p ]
+                if before:
+                    at[p] = [ before[-1] ]
+                else:
+                    at[p] = sorted( reach_in[block.index],
+                                    key=lambda d: -1 if d is None else d )
+        self._reaching[name] = (reach_in, at)
+        return self._reaching[name]
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Find the instructions that load the callable of each function call.
+#
+# The callable of a CALL_FUNCTION is pushed first, then its arguments, so it
+# lies at a depth below the top of the stack that the call's own stack effect
+# tells us: CALL_FUNCTION with n arguments has an effect of -n. (The same
+# is true of CALL_FUNCTION_VAR, _KW and _VAR_KW, which pop 1 or 2 more.)
+#
+# call_sites() follows the code in a straight line, keeping a stack with one
+# entry per value: either the (first, last) positions of the instructions
+# that loaded the value, or None when the value was computed. It needs only
+# stack_effect(), not the pop and push counts of every opcode, because an
+# opcode never disturbs the values below those it pops. A few opcodes that
+# shuffle the stack are handled specially, and a load may be extended by
+# LOAD_ATTR opcodes that immediately follow it, as in os.path.join. At a label
+# the stack is forgotten, so an argument list that contains a jump (such as
+# f(a or b)) hides its callable.
+
+_call_ops = set( op for name, op in opmap.items() if name.startswith('CALL_FUNCTION') )
+
+_load_ops = set( op for name, op in opmap.items()
+                   if name.startswith('LOAD_') and name != 'LOAD_ATTR' )
+
+# Opcodes that only pop: after them, whatever is on top of the stack was
+# there before, not a newly computed value.
+
+_pop_only_ops = set( op for name, op in opmap.items()
+                       if name.startswith( ('STORE_', 'DELETE_', 'POP_') )
+                       or name == 'PRINT_EXPR' )
+
+def call_sites( codelist ):
+    '''
+    Return a list of (call, first, last) for each CALL_FUNCTION (or _VAR, _KW,
+    _VAR_KW) in codelist. call is the position of the call opcode; first and
+    last are the positions of the LOAD_xxx that pushed the callable and of
+    the last LOAD_ATTR that followed it, or both None when the callable
+    cannot be traced to a load. For example, math.sqrt(x) gives first and
+    last as the positions of LOAD_GLOBAL math and LOAD_ATTR sqrt.
+    '''
+    sites = []
+    stack = []
+    for pos, (op, arg) in enumerate( codelist ):
+        if isinstance( op, Label ):
+            stack = []
+            continue
+        if not isopcode( op ):
+            continue
+        if op in _load_ops:
+            stack.append( (pos, pos) )
+        elif op == LOAD_ATTR:
+            if stack and stack[-1] is not None and stack[-1][1] == pos-1:
+                stack[-1] = (stack[-1][0], pos)
+            elif stack:
+                stack[-1] = None
+        elif op in _call_ops:
+            depth = -stack_effect( op, arg )
+            if depth < len( stack ) and stack[-1-depth] is not None:
+                sites.append( (pos,) + stack[-1-depth] )
+            else:
+                sites.append( (pos, None, None) )
+            del stack[ max( 0, len(stack)-1-depth ) : ]
+            stack.append( None )
+        elif op == ROT_TWO:
+            stack[-2:] = ( [None, None] + stack[-2:] )[-2:][::-1]
+        elif op == ROT_THREE:
+            top = ( [None] * 3 + stack[-3:] )[-3:]
+            stack[-3:] = [ top[2], top[0], top[1] ]
+        elif op == DUP_TOP:
+            stack.append( stack[-1] if stack else None )
+        elif op == DUP_TOP_TWO:
+            stack.extend( ( [None, None] + stack[-2:] )[-2:] )
+        else:
+            effect = stack_effect( op, arg )
+            if effect < 0:
+                del stack[ max( 0, len(stack)+effect ) : ]
+                if stack and op not in _pop_only_ops:
+                    stack[-1] = None
+            else:
+                # the effect is the net of some pops and pushes, so mark
+                # as computed all the values the opcode might have pushed.
+                stack.extend( [None] * effect )
+                for i in range( 1, min( effect+1, len(stack) ) + 1 ):
+                    stack[-i] = None
+    return sites
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Type inference. TypeInference simulates the value stack and the fast
+# locals over the blocks of a FlowGraph, recording for each value what is
+# known about it. What is known is one of
+#
+#   Known(v)    the value is the object v: a constant, or a builtin found
+#               by name in a namespace given to the analysis
+#   a type t    the value is an instance of exactly the type t (not of a
+#               subclass), for example int or str
+#   object      nothing is known
+#
+# Where control paths join, Known(v) and Known(w) with w not v become the
+# type of v if w has the same type, an instance of t and an instance of u
+# with u not t becomes object, and so on.
+#
+# Only the top of the stack is simulated: any value below the entries
+# recorded is object. So where the depth is uncertain, as at the entry of
+# an exception handler or after an opcode the analysis does not know,
+# nothing goes wrong; the stack simply becomes empty, meaning all object.
+# Opcodes with a known number of pops and pushes are in _pop_push below.
+
+class Known(object):
+    """
+    The type-inference value of a specific object: Known(v).value is v.
+    Two Known values are equal when their objects are identical, or are
+    equal ints, strings or bytes.
+    """
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+    def __eq__(self, other):
+        if not isinstance(other, Known):
+            return False
+        a, b = self.value, other.value
+        return a is b or (type(a) is type(b) and type(a) in (int, str, bytes)
+                          and a == b)
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        v = self.value
+        return hash( (type(v), v) ) if type(v) in (int, str, bytes) else id(v)
+    def __repr__(self):
+        return 'Known(%r)' % (self.value,)
+
+def _type_of(v):
+    return type(v.value) if isinstance(v, Known) else v
+
+def _join_value(a, b):
+    if a is None:
+        return b
+    if a == b:
+        return a
+    t = _type_of(a)
+    return t if t is _type_of(b) else object
+
+def _join_stack(a, b):
+    # join from the top down, as deep as both go
+    n = min(len(a), len(b))
+    if n == 0:
+        return ()
+    return tuple( _join_value(x, y) for x, y in zip(a[-n:], b[-n:]) )
+
+_pop_push = {}
+def _set_pop_push(names, pops, pushes):
+    for name in names:
+        if name in opmap:
+            _pop_push[Opcode(opmap[name])] = (pops, pushes)
+_set_pop_push( ['NOP', 'POP_BLOCK', 'SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY',
+                'DELETE_FAST', 'DELETE_GLOBAL', 'DELETE_NAME', 'DELETE_DEREF',
+                'JUMP_FORWARD', 'JUMP_ABSOLUTE'], 0, 0 )
+_set_pop_push( ['LOAD_CONST', 'LOAD_FAST', 'LOAD_GLOBAL', 'LOAD_NAME',
+                'LOAD_DEREF', 'LOAD_CLASSDEREF', 'LOAD_CLOSURE',
+                'LOAD_BUILD_CLASS', 'IMPORT_FROM', 'GET_ANEXT'], 0, 1 )
+_set_pop_push( ['POP_TOP', 'STORE_FAST', 'STORE_GLOBAL', 'STORE_NAME',
+                'STORE_DEREF', 'POP_JUMP_IF_TRUE', 'POP_JUMP_IF_FALSE',
+                'RETURN_VALUE', 'PRINT_EXPR', 'LIST_APPEND', 'SET_ADD',
+                'DELETE_ATTR', 'IMPORT_STAR'], 1, 0 )
+_set_pop_push( ['LOAD_ATTR', 'UNARY_POSITIVE', 'UNARY_NEGATIVE', 'UNARY_NOT',
+                'UNARY_INVERT', 'GET_ITER', 'GET_YIELD_FROM_ITER',
+                'GET_AWAITABLE', 'GET_AITER', 'YIELD_VALUE'], 1, 1 )
+_set_pop_push( [name for name in opmap
+                if name.startswith( ('BINARY_', 'INPLACE_') )]
+               + ['COMPARE_OP', 'IMPORT_NAME', 'YIELD_FROM'], 2, 1 )
+_set_pop_push( ['STORE_ATTR', 'DELETE_SUBSCR', 'MAP_ADD'], 2, 0 )
+_set_pop_push( ['STORE_SUBSCR'], 3, 0 )
+# stack_effect() of these includes what the handler gets, so they are
+# given here as they are when they fall through.
+_set_pop_push( ['SETUP_WITH'], 1, 2 )
+_set_pop_push( ['SETUP_ASYNC_WITH'], 1, 1 )
+
+# Opcodes whose pops depend on the argument, and what they build.
+
+_build_types = {}
+for _name, _type in ( ('BUILD_TUPLE', tuple), ('BUILD_LIST', list),
+                      ('BUILD_SET', set), ('BUILD_MAP', dict),
+                      ('BUILD_SLICE', slice), ('BUILD_STRING', str),
+                      ('BUILD_CONST_KEY_MAP', dict) ):
+    if _name in opmap:
+        _build_types[Opcode(opmap[_name])] = _type
+
+def _pops_of(op, arg):
+    '''
+    Return (pops, pushes) for op with arg, or None when not known.
+    '''
+    if op in _pop_push:
+        return _pop_push[op]
+    if op in _call_ops:
+        return (1 - stack_effect(op, arg), 1)
+    if op in _build_types:
+        return (1 - stack_effect(op, arg), 1)
+    if op == UNPACK_SEQUENCE:
+        return (1, arg)
+    return None
+
+# The types of results of the commonest operations on builtin types.
+
+_number_rank = { bool : 0, int : 1, float : 2, complex : 3 }
+_rank_type = { 0 : int, 1 : int, 2 : float, 3 : complex }
+_sequences = ( str, bytes, tuple, list )
+
+def _binary_name(op):
+    name = opname[op]
+    return name.split('_', 1)[1]
+
+def _binary_type(op, a, b):
+    '''
+    Return the inference value of a BINARY_xxx or INPLACE_xxx op applied
+    to values of inference values a and b.
+    '''
+    kind = _binary_name(op)
+    ta, tb = _type_of(a), _type_of(b)
+    if ta in _number_rank and tb in _number_rank:
+        rank = max(_number_rank[ta], _number_rank[tb])
+        if kind in ('ADD', 'SUBTRACT', 'MULTIPLY'):
+            return _rank_type[rank]
+        if kind in ('FLOOR_DIVIDE', 'MODULO') and rank < 3:
+            return _rank_type[rank]
+        if kind == 'TRUE_DIVIDE':
+            return complex if rank == 3 else float
+        if kind in ('AND', 'OR', 'XOR', 'LSHIFT', 'RSHIFT') and rank < 2:
+            if ta is bool and tb is bool and kind in ('AND', 'OR', 'XOR'):
+                return bool
+            return int
+        if kind == 'POWER' and rank == 1 and isinstance(b, Known) \
+           and b.value >= 0:
+            return int
+        return object
+    if kind == 'ADD' and ta is tb and ta in _sequences:
+        return ta
+    if kind == 'MULTIPLY':
+        if ta in _sequences and tb in (int, bool):
+            return ta
+        if tb in _sequences and ta in (int, bool):
+            return tb
+    if kind == 'MODULO' and ta is str and tb in (str, int, float, tuple, dict):
+        return str
+    if kind == 'SUBSCR' and ta in _sequences:
+        if tb is slice:
+            return ta
+        if tb in (int, bool):
+            return int if ta is bytes else (str if ta is str else object)
+    return object
+
+# Builtins whose result type is always the same, and the builtin types
+# that return an exact instance of themselves when called.
+
+import builtins as _builtins
+_call_types = { len : int, repr : str, ascii : str, format : str, hash : int,
+                id : int, ord : int, chr : str, isinstance : bool,
+                issubclass : bool, callable : bool, sorted : list,
+                hasattr : bool, bin : str, oct : str, hex : str }
+_exact_types = ( int, float, complex, str, bytes, bool, tuple, list, dict,
+                 set, frozenset, range, slice )
+
+def _call_type(callable_value):
+    if isinstance(callable_value, Known):
+        f = callable_value.value
+        try:
+            if f in _exact_types:
+                return f
+            if f in _call_types:
+                return _call_types[f]
+        except Exception:
+            pass # an unhashable or uncomparable object
+    return object
+
+_compare_bool = set( ['in', 'not in', 'is', 'is not', 'exception match'] )
+
+class TypeInference(object):
+    """
+    What is known about the type of each value on the stack, and of each
+    fast local, at each instruction of a CodeList. The values are Known(v),
+    a type, or object; see the comments above.
+
+    TypeInference(thing, namespace=None) accepts a CodeList or a Code
+    object. When namespace is given, a dict of globals, LOAD_GLOBAL of a
+    name in it, or of a builtin name that is not in it, gives Known of
+    the value found. That assumes the names are not rebound later. Code
+    objects give one through Code.infer_types(), which keeps the result
+    until the code list changes.
+    """
+    def __init__(self, thing, namespace=None):
+        code = thing.code if isinstance( thing, Code ) else thing
+        self.code = code
+        self.graph = FlowGraph(code)
+        self.namespace = namespace
+        self._label_block = { op : self.graph.block_of[pos]
+                              for pos, (op, arg) in enumerate(code)
+                              if isinstance(op, Label) }
+        args = thing.args if isinstance( thing, Code ) else ()
+        self._stacks = [None] * len(code)
+        self._locals_in = [None] * len(self.graph.blocks)
+        if self.graph.entry is None:
+            return
+        names = set( arg for op, arg in code if op in haslocal )
+        names.update(args)
+        self._locals_in[self.graph.entry.index] = { name : object for name in names }
+        stacks_in = [None] * len(self.graph.blocks)
+        stacks_in[self.graph.entry.index] = ()
+
+        order = self.graph.reachable()
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                i = block.index
+                if self._locals_in[i] is None:
+                    continue
+                edges, through = self._run(block, stacks_in[i], self._locals_in[i])
+                edges.extend( (handler, (), through) for handler in block.handlers )
+                for succ, stack, local in edges:
+                    j = succ.index
+                    if self._locals_in[j] is None:
+                        new_stack, new_locals = stack, dict(local)
+                    else:
+                        new_stack = _join_stack(stacks_in[j], stack)
+                        old = self._locals_in[j]
+                        new_locals = { name : _join_value(old[name], local[name])
+                                       for name in old }
+                    if new_stack != stacks_in[j] or new_locals != self._locals_in[j]:
+                        stacks_in[j] = new_stack
+                        self._locals_in[j] = new_locals
+                        changed = True
+        # One last pass records the stack before each instruction.
+        for block in order:
+            if self._locals_in[block.index] is not None:
+                self._run(block, stacks_in[block.index],
+                          self._locals_in[block.index], self._stacks)
+
+    def _load(self, op, arg, local):
+        if op == LOAD_CONST:
+            return Known(arg)
+        if op == LOAD_FAST:
+            return local.get(arg, object)
+        if op == LOAD_GLOBAL and self.namespace is not None:
+            if arg in self.namespace:
+                return Known(self.namespace[arg])
+            if hasattr(_builtins, arg):
+                return Known(getattr(_builtins, arg))
+        return object
+
+    def _result(self, op, arg, operands):
+        # the single value pushed by op, given the values it popped
+        if op in _build_types:
+            return _build_types[op]
+        if op in _call_ops:
+            return _call_type(operands[0])
+        if op == COMPARE_OP:
+            if arg in _compare_bool:
+                return bool
+            ta, tb = _type_of(operands[0]), _type_of(operands[1])
+            if ta in _number_rank and tb in _number_rank \
+               or (ta is tb and ta in (str, bytes)):
+                return bool
+            return object
+        if op == UNARY_NOT:
+            return bool
+        if op in (UNARY_NEGATIVE, UNARY_POSITIVE, UNARY_INVERT):
+            t = _type_of(operands[0])
+            if t in _number_rank and not (op == UNARY_INVERT and t not in (int, bool)):
+                return _rank_type[_number_rank[t]]
+            return object
+        if opname[op].startswith( ('BINARY_', 'INPLACE_') ):
+            return _binary_type(op, operands[0], operands[1])
+        return object
+
+    def _run(self, block, stack, local, record=None):
+        '''
+        Simulate one block from the given stack and locals. Return a list of
+        (successor, stack, locals) for its normal successors, and the join
+        of the locals at every point in the block, for its handlers. When
+        record is a list, store the stack before each item in it.
+        '''
+        code = self.code
+        local = dict(local)
+        through = dict(local)
+        op = None
+        for pos in range(block.start, block.end):
+            if record is not None:
+                record[pos] = stack
+            op, arg = code[pos]
+            if not isopcode(op):
+                continue
+            if op == DUP_TOP:
+                stack = stack + stack[-1:] if stack else ()
+                continue
+            if op == DUP_TOP_TWO:
+                stack = stack + stack[-2:] if len(stack) >= 2 else ()
+                continue
+            if op == ROT_TWO:
+                stack = stack[:-2] + stack[-2:][::-1] if len(stack) >= 2 else ()
+                continue
+            if op == ROT_THREE:
+                if len(stack) >= 3:
+                    stack = stack[:-3] + (stack[-1], stack[-3], stack[-2])
+                else:
+                    stack = ()
+                continue
+            if op == FOR_ITER or op in (JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP):
+                continue # handled on the edges below
+            counts = _pops_of(op, arg)
+            if counts is None:
+                # Not modelled: take the depth from stack_effect(), as if
+                # the opcode popped one more value than it nets and pushed
+                # the rest, all unknown, and keep the values below.
+                try:
+                    net = stack_effect(op, arg)
+                except ValueError:
+                    stack = ()
+                    continue
+                pops = max(0, -net) + 1
+                stack = stack[: max(0, len(stack) - pops)] + (object,) * (pops + net)
+                continue
+            pops, pushes = counts
+            operands = ( (object,) * pops + stack )[-pops:] if pops else ()
+            stack = stack[: max(0, len(stack) - pops)]
+            if op == STORE_FAST:
+                local[arg] = operands[0]
+                through[arg] = _join_value(through.get(arg), operands[0])
+            elif op == DELETE_FAST:
+                local[arg] = object
+                through[arg] = object
+            if pushes == 0:
+                continue
+            if op == UNPACK_SEQUENCE:
+                v = operands[0]
+                if isinstance(v, Known) and type(v.value) is tuple \
+                   and len(v.value) == arg:
+                    stack = stack + tuple( Known(x) for x in reversed(v.value) )
+                else:
+                    stack = stack + (object,) * pushes
+            elif pops == 0 and pushes == 1:
+                stack = stack + (self._load(op, arg, local),)
+            elif pushes == 1:
+                stack = stack + (self._result(op, arg, operands),)
+            else:
+                stack = stack + (object,) * pushes
+
+        # The stacks passed along each edge: falling through to the next
+        # block, jumping to the target of a jump, and to any other successor
+        # (the end of the loop, for BREAK_LOOP), where the depth is unknown.
+        fall_stack = jump_stack = stack
+        target = None
+        if op is not None and isopcode(op) and op in hasjump:
+            target = self._label_block[arg]
+            if op == FOR_ITER:
+                fall_stack, jump_stack = stack + (object,), stack[:-1]
+            elif op in (JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP):
+                fall_stack = stack[:-1]
+            elif op in _handler_ops:
+                jump_stack = ()
+        edges = []
+        for succ in block.succs:
+            if succ.start == block.end and ( op is None or not isopcode(op)
+                                             or op not in _no_fallthrough ):
+                edges.append( (succ, fall_stack, local) )
+            if succ is target:
+                edges.append( (succ, jump_stack, local) )
+            elif succ.start != block.end:
+                edges.append( (succ, (), local) )
+        return edges, through
+
+    def stack(self, pos):
+        """
+        Return a tuple of what is known of the values on the stack before
+        the item at pos, with the top of the stack last. Values below those
+        given are not known. Return None if pos is never reached.
+        """
+        return self._stacks[pos]
+
+    def operands(self, pos):
+        """
+        Return a tuple of what is known of the values the instruction at pos
+        pops from the stack, the top of the stack last; None if the number
+        it pops is not known or pos is never reached.
+        """
+        stack = self._stacks[pos]
+        op, arg = self.code[pos]
+        if stack is None or not isopcode(op):
+            return None
+        if op in (FOR_ITER, GET_ITER) or op in (JUMP_IF_TRUE_OR_POP, JUMP_IF_FALSE_OR_POP):
+            n = 1
+        elif op in (DUP_TOP, ROT_TWO, ROT_THREE, DUP_TOP_TWO):
+            n = { DUP_TOP : 1, ROT_TWO : 2, ROT_THREE : 3, DUP_TOP_TWO : 2 }[op]
+        else:
+            counts = _pops_of(op, arg)
+            if counts is None:
+                return None
+            n = counts[0]
+        return ( (object,) * n + stack )[-n:] if n else ()
+
+    def local(self, pos, name):
+        """
+        Return what is known of fast local name just before the item at pos,
+        or None if pos is never reached.
+        """
+        block = self.graph.block_of[pos]
+        local = self._locals_in[block.index]
+        if local is None or self._stacks[pos] is None:
+            return None
+        value = local.get(name, object)
+        for p in range(block.start, pos):
+            op, arg = self.code[p]
+            if arg == name and op in (STORE_FAST, DELETE_FAST):
+                value = self.operands(p)[0] if op == STORE_FAST else object
+        return value
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Differences between two Code objects. Code.diff() aligns the two code
+# lists item by item, using a key for each item that is equal when the
+# items are equal in the sense of Code.__eq__, except that a jump's key does
+# not include its target, and a nested Code object's key does not include
+# its contents. All labels have the same key. After alignment, each pair
+# of matched labels maps a label of one list to one of the other, and a
+# pair of matched jumps whose targets do not map is reported as retargeted;
+# a pair of matched nested Code objects is compared in turn.
+#
+# The alignment first matches the common prefix and suffix, which is all
+# there is to do when a transform changed one small part of a function.
+# The rest is aligned by the algorithm of E. Myers, "An O(ND) Difference
+# Algorithm and its Variations", whose time is proportional to the length
+# times the number of differences D. A gap of more than _diff_gap items,
+# or one that needs more than _diff_limit edits, is first cut at anchors:
+# the items whose keys occur just once in each list (the "patience"
+# method), or failing those, the runs of _diff_run keys that occur just
+# once in each list. The gaps between anchors are aligned in the same way.
+# A gap with no anchors of either kind (bytecode repeats keys such as
+# LOAD_FAST x everywhere) is split at the middle snake of the linear-space
+# variant of the algorithm, from the same paper, and each half is aligned
+# in turn.
+#
+# The work of all this, counted in diagonals visited and keys compared, is
+# limited to _diff_work per item of the two lists, plus _diff_min_work so
+# that the lists of ordinary functions are always aligned properly. A gap
+# that would need more work than is left, such as the whole of two
+# unrelated functions, is aligned by a greedy pass instead (_greedy), and
+# the time of a diff stays linear in the length of the code, at the price
+# of a longer edit script in such cases.
+
+_diff_limit = 500
+_diff_gap = 2000
+_diff_run = 32
+_diff_work = 3
+_diff_min_work = 250000
+
+def _diff_keys(codelist, numbers):
+    # Return a list of small ints, one per item, equal for items whose keys
+    # are equal. numbers is the dict { key : int } shared by both lists.
+    # Only constants need _const_key; the other arguments are names and
+    # counts, which are strings and ints.
+    keys = []
+    for op, arg in codelist:
+        if op in hasarg:
+            if op in hasjump:
+                key = (op, 'jump')
+            elif op not in hasconst:
+                key = (op, arg)
+            elif isinstance(arg, Code):
+                key = (op, 'code')
+            else:
+                key = (op, _const_key(arg))
+                try:
+                    hash(key)
+                except TypeError:
+                    key = (op, id(arg))
+        elif isinstance(op, Label):
+            key = 'label'
+        elif op is SetLineno:
+            key = 'line'
+        else:
+            key = op
+        keys.append( numbers.setdefault(key, len(numbers)) )
+    return keys
+
+def _myers(a, b, limit, work):
+    '''
+    Return the list of matched (i, j) pairs of a shortest edit script from
+    sequence a to sequence b, or None if it needs more than limit edits or
+    more than the work left in work[0], which is reduced by what is done.
+    '''
+    n, m = len(a), len(b)
+    max_d = min(n + m, limit)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        if work[0] < 0:
+            return None
+        trace.append( v[offset - d - 1 : offset + d + 2] )
+        steps = d + 1
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            start = x
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            steps += x - start
+            v[offset + k] = x
+            if x >= n and y >= m:
+                work[0] -= steps
+                return _myers_pairs(trace, n, m)
+        work[0] -= steps
+    return None
+
+def _myers_pairs(trace, n, m):
+    # Walk back through the saved V arrays. trace[d] holds V[-d-1 .. d+1]
+    # as it was before round d.
+    pairs = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        saved = trace[d]
+        def v(k):
+            return saved[k + d + 1]
+        k = x - y
+        if k == -d or (k != d and v(k - 1) < v(k + 1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v(prev_k)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            pairs.append( (x, y) )
+        x, y = prev_x, prev_y
+    pairs.reverse()
+    return pairs
+
+def _middle_snake(a, a0, a1, b, b0, b1, work):
+    '''
+    Return (x, y, u, v): the middle snake of a shortest edit script from
+    a[a0:a1] to b[b0:b1], matching a[a0+x:a0+u] with b[b0+y:b0+v]. Both
+    parts must be non-empty. Return None if it takes more than the work
+    left in work[0], which is reduced by what is done.
+    '''
+    n, m = a1 - a0, b1 - b0
+    delta = n - m
+    odd = delta & 1
+    max_d = (n + m + 1) // 2 + 1
+    offset = max_d + 1
+    vf = [0] * (2 * max_d + 3)
+    vb = [0] * (2 * max_d + 3)
+    for d in range(max_d + 1):
+        if work[0] < 0:
+            return None
+        steps = 2 * d + 2
+        # forward, from the start
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vf[offset + k - 1] < vf[offset + k + 1]):
+                x = vf[offset + k + 1]
+            else:
+                x = vf[offset + k - 1] + 1
+            y = x - k
+            start = x
+            while x < n and y < m and a[a0 + x] == b[b0 + y]:
+                x += 1
+                y += 1
+            steps += x - start
+            vf[offset + k] = x
+            if odd and -d < delta - k < d and x + vb[offset + delta - k] >= n:
+                work[0] -= steps
+                return (start, start - k, x, y)
+        # backward, from the end, in distances from the ends
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and vb[offset + k - 1] < vb[offset + k + 1]):
+                x = vb[offset + k + 1]
+            else:
+                x = vb[offset + k - 1] + 1
+            y = x - k
+            start = x
+            while x < n and y < m and a[a1 - 1 - x] == b[b1 - 1 - y]:
+                x += 1
+                y += 1
+            steps += x - start
+            vb[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + vf[offset + delta - k] >= n:
+                work[0] -= steps
+                return (n - x, m - y, n - start, m - start + k)
+        work[0] -= steps
+    raise ValueError("No middle snake") # not reached
+
+def _unique_anchors(a, b):
+    # Return the (i, j) pairs of the keys found once in a and once in b that
+    # form a longest increasing sequence in both.
+    count_a = Counter(a)
+    count_b = Counter(b)
+    where_b = { key : j for j, key in enumerate(b) if count_b[key] == 1 }
+    pairs = [ (i, where_b[key]) for i, key in enumerate(a)
+              if key in where_b and count_a[key] == 1 ]
+    # When the pairs already increase in both, as they do when the lists
+    # differ by a few edits, they are the sequence.
+    if all( pairs[n][1] < pairs[n + 1][1] for n in range(len(pairs) - 1) ):
+        return pairs
+    # longest increasing subsequence of the j values, by patience sorting
+    tops = []
+    tails = []
+    back = [None] * len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        lo = bisect_left(tops, j)
+        if lo == len(tops):
+            tops.append(j)
+            tails.append(n)
+        else:
+            tops[lo] = j
+            tails[lo] = n
+        back[n] = tails[lo - 1] if lo else None
+    result = []
+    n = tails[-1] if tails else None
+    while n is not None:
+        result.append(pairs[n])
+        n = back[n]
+    result.reverse()
+    return result
+
+def _run_anchors(a, a0, a1, b, b0, b1):
+    # Return (i, j) for each run a[i:i+_diff_run] == b[j:j+_diff_run] of
+    # the runs found once in a[a0:a1] and once in b[b0:b1] that form a
+    # longest increasing sequence in both, leaving out runs that overlap
+    # the one before. Only the runs whose hash is a multiple of _diff_run
+    # are considered; which those are depends only on their keys, so a run
+    # is considered in both lists or in neither, and there are few of them.
+    k = _diff_run
+    def chosen(c, c0, c1):
+        # hashes[i] is a hash of c[c0+i:c0+i+k], made by hashing pairs of
+        # hashes of runs half as long (so k is a power of two).
+        hashes = c[c0:c1]
+        width = 1
+        while width < k:
+            hashes = list( map( hash, zip( hashes, hashes[width:] ) ) )
+            width *= 2
+        starts = [ i for i, h in enumerate(hashes) if h % k == 0 ]
+        return [ c0 + i for i in starts ], [ hashes[i] for i in starts ]
+    starts_a, runs_a = chosen(a, a0, a1)
+    starts_b, runs_b = chosen(b, b0, b1)
+    result = []
+    end_a, end_b = a0, b0
+    for n, m in _unique_anchors(runs_a, runs_b):
+        i, j = starts_a[n], starts_b[m]
+        # (the hashes of different runs can be equal, if rarely)
+        if i >= end_a and j >= end_b and a[i:i + k] == b[j:j + k]:
+            result.append( (i, j) )
+            end_a, end_b = i + k, j + k
+    return result
+
+def _greedy(a, a0, a1, b, b0, b1):
+    # Return matched (i, j) pairs of a[a0:a1] and b[b0:b1] found in one
+    # pass, for a gap there is no work left to align properly. At each
+    # mismatch, find the smallest s up to _diff_run for which s items of
+    # each, or s items of b, or s items of a, can be passed over to reach
+    # equal keys again, and pass over them; else pass over one of each.
+    pairs = []
+    i, j = a0, b0
+    while i < a1 and j < b1:
+        if a[i] == b[j]:
+            pairs.append( (i, j) )
+            i += 1
+            j += 1
+            continue
+        for s in range(1, _diff_run):
+            if i + s < a1 and j + s < b1 and a[i + s] == b[j + s]:
+                i += s
+                j += s
+                break
+            if j + s < b1 and b[j + s] == a[i]:
+                j += s
+                break
+            if i + s < a1 and a[i + s] == b[j]:
+                i += s
+                break
+        else:
+            i += 1
+            j += 1
+    return pairs
+
+def _align(a, b):
+    '''
+    Return the sorted list of matched (i, j) pairs aligning key lists a, b.
+    '''
+    pairs = []
+    work = [ _diff_work * (len(a) + len(b)) + _diff_min_work ]
+    gaps = [ (0, len(a), 0, len(b)) ]
+    while gaps:
+        a0, a1, b0, b1 = gaps.pop()
+        while a0 < a1 and b0 < b1 and a[a0] == b[b0]:
+            pairs.append( (a0, b0) )
+            a0 += 1
+            b0 += 1
+        while a0 < a1 and b0 < b1 and a[a1 - 1] == b[b1 - 1]:
+            a1 -= 1
+            b1 -= 1
+            pairs.append( (a1, b1) )
+        if a0 == a1 or b0 == b1:
+            continue
+        if work[0] < 0:
+            pairs.extend( _greedy(a, a0, a1, b, b0, b1) )
+            continue
+        size = (a1 - a0) + (b1 - b0)
+        if size <= _diff_gap:
+            matched = _myers(a[a0:a1], b[b0:b1], _diff_limit, work)
+            if matched is not None:
+                pairs.extend( (a0 + i, b0 + j) for i, j in matched )
+                continue
+        # Finding anchors takes about one step per item.
+        work[0] -= size
+        anchors = [ (a0 + i, b0 + j, 1)
+                    for i, j in _unique_anchors(a[a0:a1], b[b0:b1]) ]
+        if not anchors and size > 2 * _diff_run:
+            anchors = [ (i, j, _diff_run)
+                        for i, j in _run_anchors(a, a0, a1, b, b0, b1) ]
+        if anchors:
+            previous = (a0, b0)
+            for i, j, length in anchors:
+                pairs.extend( (i + t, j + t) for t in range(length) )
+                gaps.append( (previous[0], i, previous[1], j) )
+                previous = (i + length, j + length)
+            gaps.append( (previous[0], a1, previous[1], b1) )
+            continue
+        snake = _middle_snake(a, a0, a1, b, b0, b1, work)
+        if snake is None:
+            pairs.extend( _greedy(a, a0, a1, b, b0, b1) )
+            continue
+        x, y, u, v = snake
+        pairs.extend( (a0 + i, b0 + y + i - x) for i in range(x, u) )
+        gaps.append( (a0, a0 + x, b0, b0 + y) )
+        gaps.append( (a0 + u, a1, b0 + v, b1) )
+    pairs.sort()
+    return pairs
+
+class CodeDiff(object):
+    """
+    The differences between two Code objects, made by Code.diff(). Its
+    attributes are
+
+    old, new    the two Code objects
+    attributes  list of (name, old value, new value) for each attribute
+                (args, name, flags and so on) that differs
+    entries     the edit script: a list of tuples (tag, i1, i2, j1, j2,
+                detail) meaning that old.code[i1:i2] and new.code[j1:j2]
+                differ as the tag says:
+                  'delete'    the old items are not in new
+                  'insert'    the new items are not in old
+                  'replace'   the old items were replaced by the new ones
+                  'retarget'  a jump goes to a different place
+                  'nested'    a nested Code object differs; detail is its
+                              CodeDiff (detail is None for other tags)
+
+    A CodeDiff is true when there are differences, and str() of it is a
+    listing of them in the style of a unified diff.
+    """
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+        self.attributes = [ (name, getattr(old, name), getattr(new, name))
+                            for name in ('freevars', 'args', 'varargs',
+                                         'varkwargs', 'kwonlyargcount',
+                                         'newlocals', 'name', 'filename',
+                                         'firstlineno', 'docstring')
+                            if getattr(old, name) != getattr(new, name) ]
+        a_code, b_code = old.code, new.code
+        numbers = {}
+        a = _diff_keys(a_code, numbers)
+        b = _diff_keys(b_code, numbers)
+        pairs = _align(a, b)
+
+        # Labels that were matched map to each other.
+        labels = {}
+        for i, j in pairs:
+            if isinstance(a_code[i][0], Label):
+                labels[a_code[i][0]] = b_code[j][0]
+
+        entries = []
+        i = j = 0
+        for pi, pj in pairs + [ (len(a), len(b)) ]:
+            if pi > i and pj > j:
+                entries.append( ('replace', i, pi, j, pj, None) )
+            elif pi > i:
+                entries.append( ('delete', i, pi, j, j, None) )
+            elif pj > j:
+                entries.append( ('insert', i, i, j, pj, None) )
+            if pi < len(a):
+                op, arg = a_code[pi]
+                other = b_code[pj][1]
+                if op in hasjump:
+                    if labels.get(arg) is not other:
+                        entries.append( ('retarget', pi, pi+1, pj, pj+1, None) )
+                elif isinstance(arg, Code):
+                    nested = arg.diff(other)
+                    if nested:
+                        entries.append( ('nested', pi, pi+1, pj, pj+1, nested) )
+            i, j = pi + 1, pj + 1
+        self.entries = entries
+
+    def __bool__(self):
+        return bool(self.entries or self.attributes)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __str__(self):
+        return '\n'.join( self._lines('') )
+
+    def _lines(self, indent):
+        lines = []
+        for name, old, new in self.attributes:
+            lines.append( '%s%s: %r --> %r' % (indent, name, old, new) )
+        a_targets = _label_targets(self.old.code)
+        b_targets = _label_targets(self.new.code)
+        for tag, i1, i2, j1, j2, detail in self.entries:
+            lines.append( '%s@@ -%d,%d +%d,%d @@ %s' % (indent, i1, i2 - i1, j1, j2 - j1, tag) )
+            if tag == 'nested':
+                lines.extend( detail._lines(indent + '    ') )
+                continue
+            for pos in range(i1, i2):
+                lines.append( indent + '-' + _item_str(self.old.code, pos, a_targets) )
+            for pos in range(j1, j2):
+                lines.append( indent + '+' + _item_str(self.new.code, pos, b_targets) )
+        return lines
+
+def _label_targets(codelist):
+    return { op : pos for pos, (op, arg) in enumerate(codelist) if isinstance(op, Label) }
+
+def _item_str(codelist, pos, targets):
+    # One item as a line of a listing, the way CodeList.__str__ shows it.
+    op, arg = codelist[pos]
+    if isinstance(op, Label):
+        return '%6d >>' % pos
+    if op is SetLineno:
+        return '%6d line %s' % (pos, arg)
+    if op in hasjump:
+        argstr = 'to ' + str(targets.get(arg, '?'))
+    elif op in hasconst:
+        argstr = repr(arg) if not isinstance(arg, Code) else '<Code %s>' % arg.name
+    elif op in hasarg:
+        argstr = str(arg)
+    else:
+        argstr = ''
+    return '%6d %-20s %s' % (pos, op, argstr)
 
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -1662,6 +3884,34 @@ def list_the_tests():
         loop.close()
         return loop.is_closed()
 
+    def test_11( n ):
+        ''' nested loops with break and continue, as FlowGraph.loops() sees '''
+        s = 0
+        for i in range( n ) :
+            j = 0
+            while j < i :
+                j += 1
+                if j % 3 == 0 :
+                    continue
+                if j > 5 :
+                    break
+                s += j
+        return s
+
+    def test_12( x ):
+        ''' try, except, finally and with blocks '''
+        import io
+        result = []
+        try :
+            with io.StringIO( 'ab' ) as f :
+                result.append( f.read( 1 ) )
+            result.append( 1 / x )
+        except ZeroDivisionError :
+            result.append( 'zero' )
+        finally :
+            result.append( 'done' )
+        return result
+
     def test_sig1( a, *args, z=1 ):
         ''' test of handling of *args and kwonlyargcount '''
         return z + len( [*args] )
@@ -1680,6 +3930,9 @@ def list_the_tests():
         (test_8, ),
         (test_9, io.StringIO('xx') ),
         (test_10, ),
+        (test_11, 8),
+        (test_12, 2),
+        (test_12, 0),
         (test_sig1, 'a', 1 )
     ]
     return case_list
@@ -0,0 +1,287 @@
+'''
+    block_layout, profile-guided ordering of basic blocks
+
+A conditional jump costs less when it is not taken, and an unconditional
+jump costs an opcode dispatch, so code runs faster when the usual path
+through it falls through from block to block. The compiler lays blocks out
+in source order, which often puts a rare case (an error check, say) in the
+middle of the usual path. The decorator @block_layout reorders the basic
+blocks of the decorated function using counts of how often each block was
+entered, as made by instrument.BlockProfile, so that each block is followed
+by its most frequent successor.
+
+The layout is greedy. Each block starts as a chain of its own; the edges
+between blocks are taken in order of their estimated counts (exact when the
+successor has only the one predecessor, otherwise the smaller of the two
+block counts) and each joins the chain that ends with its source to the
+chain that begins with its destination. The chains are then placed with
+the entry's first and the rest in their original order. Then
+
+    POP_JUMP_IF_FALSE and POP_JUMP_IF_TRUE are inverted when the block
+        they jump to is placed next, and the block they fell into becomes
+        the target;
+
+    a JUMP_ABSOLUTE is added after a block whose fall-through successor is
+        no longer next, and a jump to the block that is next is removed;
+
+    JUMP_FORWARD becomes JUMP_ABSOLUTE, since its target may now be behind.
+
+A block that ends with any other opcode that can fall through (FOR_ITER, a
+SETUP_xxx, JUMP_IF_xxx_OR_POP) keeps its successor. The SETUP_xxx blocks
+and exception handlers are matters of the path taken at run time, which
+does not change, but FOR_ITER and the SETUP_xxx opcodes only jump forward,
+so a layout that puts one of their targets before them is not used. Nor is
+a layout for which Code._compute_stacksize() fails or gives a different
+depth; the code is then left as it was.
+
+The line number table of a code object can only increase, so when a block
+is moved after code from a later line, its lines are reported as that later
+line (a rare error case moved to the end of the function will show in a
+traceback as the last line of the usual path).
+
+Arguments to @block_layout are:
+
+    counts
+        the counts of entries to each block of the function, either a list
+        indexed as FlowGraph(...).blocks, or the dict returned by
+        BlockProfile.collect(), in which the function is looked up by its
+        file name, name and first line number.
+
+    verbose = False
+        when true, the new order of the blocks is printed to stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['_block_layout', 'block_layout', 'layout_code' ]
+
+from byteplay3 import *
+from byteplay3 import _no_fallthrough
+from make_constants import _func_copy
+
+_inverse = { POP_JUMP_IF_FALSE : POP_JUMP_IF_TRUE, POP_JUMP_IF_TRUE : POP_JUMP_IF_FALSE }
+
+_jumps = set( [ JUMP_ABSOLUTE, JUMP_FORWARD ] )
+
+# Relative jumps, which can only go forward.
+
+_forward_only = set( hasjrel )
+
+def _fallthrough( graph, block ):
+    '''
+    Return the block into which block falls through, or None.
+    '''
+    if block.end >= len( graph.code ) :
+        return None
+    op, arg = graph.code[ block.end - 1 ]
+    if isopcode( op ) and op in _no_fallthrough :
+        return None
+    return graph.block_of[ block.end ]
+
+def _target( graph, block, label_pos ):
+    '''
+    Return the block to which the last opcode of block jumps, or None.
+    '''
+    op, arg = graph.code[ block.end - 1 ]
+    if isopcode( op ) and op in hasjump :
+        return graph.block_of[ label_pos[arg] ]
+    return None
+
+def _chains( graph, counts, label_pos ):
+    '''
+    Return the list of chains of blocks, each a list, in the order they are
+    to be placed.
+    '''
+    blocks = graph.blocks
+    chain_of = { block.index : [ block ] for block in blocks }
+    edges = []
+    for block in blocks :
+        fall = _fallthrough( graph, block )
+        op = graph.code[ block.end - 1 ][0]
+        if not isopcode( op ) :
+            op = None
+        movable = op is None or op not in hasjump or op in _inverse
+        if fall is not None and not movable :
+            edges.append( ( 0, 0, 0, block.index, fall.index ) ) # must stay together
+            continue
+        if op in _inverse :
+            successors = [ fall, _target( graph, block, label_pos ) ]
+        elif op in _jumps :
+            successors = [ _target( graph, block, label_pos ) ]
+        else :
+            successors = [ fall ]
+        for n, succ in enumerate( successors ) :
+            if succ is None or succ is graph.entry :
+                continue
+            count = counts[ succ.index ]
+            if len( succ.preds ) > 1 :
+                count = min( count, counts[ block.index ] )
+            edges.append( ( 1, -count, n, block.index, succ.index ) )
+    edges.sort()
+    for edge in edges :
+        source, dest = edge[-2], edge[-1]
+        head, tail = chain_of[ source ], chain_of[ dest ]
+        if head is tail or head[-1].index != source or tail[0].index != dest :
+            continue
+        head.extend( tail )
+        for block in tail :
+            chain_of[ block.index ] = head
+    chains = []
+    for block in blocks :
+        chain = chain_of[ block.index ]
+        if chain[0] is block :
+            chains.append( chain )
+    return chains
+
+def _emit( graph, order, label_pos ):
+    '''
+    Return a new CodeList of the blocks of graph in order, with its jumps
+    fixed as described above.
+    '''
+    code = graph.code
+    # The line in effect at the start of each block, and a label for each.
+    lines = []
+    labels = []
+    added = set()
+    lineno = None
+    for block in graph.blocks :
+        lines.append( lineno )
+        first = code[ block.start ][0]
+        if not isinstance( first, Label ) :
+            first = Label()
+            added.add( first )
+        labels.append( first )
+        for op, arg in code[ block.start : block.end ] :
+            if op is SetLineno :
+                lineno = arg
+    out = CodeList()
+    current = None
+    for n, block in enumerate( order ) :
+        following = order[ n + 1 ] if n + 1 < len( order ) else None
+        items = list( code[ block.start : block.end ] )
+        if not isinstance( items[0][0], Label ) :
+            items.insert( 0, ( labels[ block.index ], None ) )
+        first_op = next( ( i for i, (op, arg) in enumerate( items ) if not isinstance( op, Label ) ),
+                         len( items ) )
+        start_line = lines[ block.index ]
+        if start_line is not None and ( first_op == len( items ) or items[first_op][0] is not SetLineno ) :
+            items.insert( first_op, ( SetLineno, start_line ) )
+        fall = _fallthrough( graph, block )
+        op, arg = items[-1]
+        if isopcode( op ) and op in _inverse and following is not fall \
+           and following is graph.block_of[ label_pos[arg] ] :
+            items[-1] = ( _inverse[op], labels[ fall.index ] )
+            fall = following
+        elif isopcode( op ) and op in _jumps :
+            if graph.block_of[ label_pos[arg] ] is following :
+                del items[-1]
+            else :
+                items[-1] = ( JUMP_ABSOLUTE, arg )
+        if fall is not None and fall is not following :
+            items.append( ( JUMP_ABSOLUTE, labels[ fall.index ] ) )
+        for op, arg in items :
+            if op is SetLineno :
+                if current is not None and arg <= current :
+                    continue
+                current = arg
+            out.append( ( op, arg ) )
+    # Drop the labels that were added but are not jumped to.
+    targets = set( arg for op, arg in out if isopcode( op ) and op in hasjump )
+    return CodeList( item for item in out if item[0] not in added or item[0] in targets )
+
+def _valid( codelist ):
+    '''
+    Return True when every relative jump in codelist goes forward.
+    '''
+    label_pos = { op : pos for pos, (op, arg) in enumerate( codelist ) if isinstance( op, Label ) }
+    return all( label_pos[arg] > pos for pos, (op, arg) in enumerate( codelist )
+                if isopcode( op ) and op in _forward_only )
+
+def layout_code( code, counts, verbose=False ):
+    '''
+    Reorder the basic blocks of a Code object by counts, a list of the
+    entries to each block of FlowGraph(code), modifying its code list in
+    place. Return True if the code was changed, False when the layout was
+    unchanged or could not be used.
+    '''
+    graph = FlowGraph( code )
+    if len( counts ) != len( graph.blocks ) :
+        raise ValueError( 'The counts do not match the blocks of the code' )
+    label_pos = { op : pos for pos, (op, arg) in enumerate( code.code ) if isinstance( op, Label ) }
+    order = [ block for chain in _chains( graph, counts, label_pos ) for block in chain ]
+    if order == graph.blocks :
+        return False
+    original = code.code
+    depth = code._compute_stacksize()
+    code.code = _emit( graph, order, label_pos )
+    try:
+        ok = _valid( code.code ) and code._compute_stacksize() == depth
+    except ( ValueError, KeyError, IndexError ) :
+        ok = False
+    if not ok :
+        code.code = original
+        if verbose :
+            print( 'block_layout: layout of', code.name, 'not used' )
+        return False
+    if verbose :
+        print( 'block_layout:', code.name, [ block.index for block in order ] )
+    return True
+
+def _block_layout( f, counts, verbose=False ):
+    '''
+    Return a copy of function f with its blocks reordered by counts, or f
+    itself when nothing changed.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    if isinstance( counts, dict ) :
+        counts = counts.get( ( co.co_filename, co.co_name, co.co_firstlineno ) )
+        if counts is None :
+            return f
+    co = Code.from_code( co )
+    if not layout_code( co, counts, verbose ) :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def block_layout( counts, verbose=False ):
+    """
+    Return a decorator for reordering blocks by counts.
+    Verify that the first argument is not the function to decorate.
+    """
+    if callable( counts ):
+        raise ValueError("The block_layout decorator must have arguments.")
+    return lambda f: _block_layout( f, counts, verbose )
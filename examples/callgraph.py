@@ -0,0 +1,360 @@
+'''
+    callgraph, static extraction of who calls whom
+
+To choose functions to inline (inline_calls) or to bind (make_constants)
+across a large body of code, one needs to know which functions call which.
+This module finds the call sites in every function of every module in a
+set of directories, and resolves the called name where it can.
+
+Each module is compiled, and the module's code and every function and
+class body nested in it is examined with call_sites() from byteplay3. A
+call whose callable was loaded by LOAD_GLOBAL, LOAD_NAME or LOAD_FAST,
+perhaps followed by LOAD_ATTR, gives a dotted name such as os.path.join,
+which is resolved as follows:
+
+    a name imported by the module ("import os", "from x import y as z")
+        becomes the name of what was imported, e.g. "os.path.join";
+    a function or class defined at the top level of the module becomes
+        its qualified name, e.g. "pkg.mod.helper";
+    self.m, in a method whose class defines m, becomes "pkg.mod.C.m";
+    a builtin name not otherwise bound becomes e.g. "builtins.len".
+
+Anything else is kept as written, with a leading "?", e.g. "?obj.run".
+Calls whose callable is computed, such as f()(), are not recorded.
+
+The graph is kept as a CallGraph: the names are numbered, and for each
+caller there is a dict { callee number : number of call sites }. Edges
+can be written as lines of tab-separated text
+
+    caller <tab> callee <tab> count
+
+and build_callgraph() writes them as the files are finished, so a survey
+of many thousands of modules need not be held in memory to be saved. The
+files are processed in a pool of processes (see corpus.map_files).
+
+Run as a program:
+
+    python callgraph.py [-o edges.tsv] [-j processes] path...
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['build_callgraph', 'CallGraph', 'code_edges', 'module_edges' ]
+
+from byteplay3 import *
+from corpus import compile_file, map_files, module_name, source_files, walk_code
+import builtins
+import functools
+import os
+import sys
+
+_root_ops = set( [ LOAD_GLOBAL, LOAD_NAME, LOAD_FAST ] )
+
+def _resolve_relative( target, level, module, is_package ):
+    '''
+    Return the absolute name of a relative import of target at level from
+    module, e.g. level 1 in package a.b gives a.b.target.
+    '''
+    if not level :
+        return target
+    parts = module.split( '.' )
+    if not is_package :
+        parts.pop()
+    if level > 1 :
+        parts = parts[ : len( parts ) - ( level - 1 ) ]
+    if target :
+        parts.append( target )
+    return '.'.join( parts )
+
+def _bindings( code, module, is_package, prefix ):
+    '''
+    Scan the top-level code of a module or class body and return a dict
+    { name : qualified name } of the names it binds by import, def and
+    class. prefix is prepended to the names of definitions.
+    '''
+    # The compiler produces these sequences (Python 3.4 and 3.5):
+    #   import a.b          IMPORT_NAME a.b, STORE_NAME a
+    #   import a.b as c     IMPORT_NAME a.b, LOAD_ATTR b, STORE_NAME c
+    #   from a import x, y  IMPORT_NAME a, IMPORT_FROM x, STORE_NAME x,
+    #                       IMPORT_FROM y, STORE_NAME y, POP_TOP
+    # with the level of a relative import in a LOAD_CONST just before.
+    bindings = {}
+    codelist = code.code
+    defined = None  # qualified name of the latest function or class code
+    base = None     # module of the import statement being scanned
+    source = None   # what the next STORE_NAME stores
+    for pos, (op, arg) in enumerate( codelist ) :
+        if not isopcode( op ) :
+            continue
+        if op == LOAD_CONST and isinstance( arg, Code ) :
+            defined = arg.name
+            if pos + 1 < len( codelist ) and codelist[pos+1][0] == LOAD_CONST \
+               and isinstance( codelist[pos+1][1], str ) :
+                defined = codelist[pos+1][1]
+        elif op == IMPORT_NAME :
+            level = 0
+            if pos >= 2 and codelist[pos-2][0] == LOAD_CONST \
+               and isinstance( codelist[pos-2][1], int ) :
+                level = codelist[pos-2][1]
+            base = _resolve_relative( arg, level, module, is_package )
+            source = base.split( '.' )[0]
+        elif op == LOAD_ATTR and source is not None :
+            source = base
+        elif op == IMPORT_FROM and base is not None :
+            source = base + '.' + arg if base else arg
+        elif op in ( STORE_NAME, STORE_GLOBAL ) :
+            if source is not None :
+                bindings[arg] = source
+            elif defined is not None and defined.rsplit( '.', 1 )[-1] == arg :
+                bindings[arg] = prefix + defined
+            source = None
+            defined = None
+        elif op == POP_TOP :
+            base = source = None
+    return bindings
+
+def _callee( codelist, first, last, bindings, builtin_names, methods, self_name ):
+    '''
+    Return the resolved name of the callable loaded by codelist[first:last+1],
+    or None when it is not a plain load of a name.
+    '''
+    op, root = codelist[first]
+    if op not in _root_ops :
+        return None
+    attrs = [ arg for op, arg in codelist[first+1:last+1] ]
+    if op == LOAD_FAST :
+        if root == self_name and attrs and attrs[0] in methods :
+            return '.'.join( [ methods[attrs[0]] ] + attrs[1:] )
+        return '?' + '.'.join( [ root ] + attrs )
+    if root in bindings :
+        return '.'.join( [ bindings[root] ] + attrs )
+    if root in builtin_names :
+        return '.'.join( [ 'builtins', root ] + attrs )
+    return '?' + '.'.join( [ root ] + attrs )
+
+def module_edges( path, root=None ):
+    '''
+    Return (module name, edges) for the source file at path, where edges is
+    a list of (caller, callee, count). The module name is relative to the
+    directory root. Return (module name, None) when the file does not
+    compile.
+    '''
+    module = module_name( path, root )
+    code = compile_file( path )
+    if code is None :
+        return module, None
+    is_package = os.path.basename( path ) == '__init__.py'
+    return module, code_edges( Code.from_code( code ), module, is_package )
+
+def code_edges( code, module, is_package=False ):
+    '''
+    Return a sorted list of (caller, callee, count) for the Code object of
+    a module named module.
+    '''
+    builtin_names = set( dir( builtins ) )
+    functions = list( walk_code( code, module ) )
+
+    # Bindings of the module, and the methods defined by each class body,
+    # keyed by the class's qualified name.
+    bindings = _bindings( code, module, is_package, module + '.' )
+    class_methods = {}
+    for name, nested in functions :
+        if nested is not code and not nested.newlocals :
+            defs = _bindings( nested, module, is_package, module + '.' )
+            class_methods[name] = { attr : target for attr, target in defs.items()
+                                    if target.startswith( name + '.' ) }
+
+    counts = {}
+    for name, nested in functions :
+        methods = {}
+        self_name = None
+        owner = name.rsplit( '.', 1 )[0]
+        if nested.args and owner in class_methods :
+            methods = class_methods[owner]
+            self_name = nested.args[0]
+        local = bindings
+        if nested is not code and not nested.newlocals :
+            local = dict( bindings )
+            local.update( _bindings( nested, module, is_package, module + '.' ) )
+        codelist = nested.code
+        for call, first, last in call_sites( codelist ) :
+            if first is None :
+                continue
+            callee = _callee( codelist, first, last, local, builtin_names,
+                              methods, self_name )
+            if callee is not None :
+                counts[ (name, callee) ] = counts.get( (name, callee), 0 ) + 1
+    return [ (caller, callee, n) for (caller, callee), n in sorted( counts.items() ) ]
+
+class CallGraph(object):
+    '''
+    A compact call graph. Each name is numbered once, in the list names,
+    and edges is a dict { caller number : { callee number : count } }.
+    '''
+    def __init__( self ):
+        self.names = []
+        self.numbers = {}
+        self.edges = {}
+
+    def number( self, name ):
+        '''
+        Return the number of name, numbering it if it is new.
+        '''
+        n = self.numbers.get( name )
+        if n is None :
+            n = self.numbers[name] = len( self.names )
+            self.names.append( name )
+        return n
+
+    def add( self, caller, callee, count=1 ):
+        '''
+        Add count call sites of callee in caller.
+        '''
+        row = self.edges.setdefault( self.number( caller ), {} )
+        callee = self.number( callee )
+        row[callee] = row.get( callee, 0 ) + count
+
+    def merge( self, edges ):
+        '''
+        Add an iterable of (caller, callee, count), or another CallGraph.
+        '''
+        if isinstance( edges, CallGraph ) :
+            edges = edges.iter_edges()
+        for caller, callee, count in edges :
+            self.add( caller, callee, count )
+
+    def iter_edges( self ):
+        '''
+        Yield (caller, callee, count) for every edge.
+        '''
+        names = self.names
+        for caller, row in self.edges.items() :
+            for callee, count in row.items() :
+                yield names[caller], names[callee], count
+
+    def callees( self, caller ):
+        '''
+        Return a dict { callee name : count } of what caller calls.
+        '''
+        row = self.edges.get( self.numbers.get( caller ), {} )
+        return { self.names[callee] : count for callee, count in row.items() }
+
+    def callers( self, callee ):
+        '''
+        Return a dict { caller name : count } of what calls callee.
+        '''
+        n = self.numbers.get( callee )
+        return { self.names[caller] : row[n]
+                 for caller, row in self.edges.items() if n in row }
+
+    def write( self, file ):
+        '''
+        Write the edges to a text file (or file name) as lines of
+        caller, callee and count separated by tabs.
+        '''
+        _write_edges( file, self.iter_edges() )
+
+    @classmethod
+    def read( cls, file ):
+        '''
+        Return a CallGraph of the edges in a file written by write().
+        '''
+        graph = cls()
+        with open( file ) if isinstance( file, str ) else _nullcontext( file ) as lines :
+            for line in lines :
+                caller, callee, count = line.rstrip( '\n' ).split( '\t' )
+                graph.add( caller, callee, int( count ) )
+        return graph
+
+class _nullcontext(object):
+    def __init__( self, thing ):
+        self.thing = thing
+    def __enter__( self ):
+        return self.thing
+    def __exit__( self, *exc ):
+        return False
+
+def _write_edges( file, edges ):
+    with open( file, 'w' ) if isinstance( file, str ) else _nullcontext( file ) as out :
+        for caller, callee, count in edges :
+            out.write( '%s\t%s\t%d\n' % ( caller, callee, count ) )
+
+def build_callgraph( paths, root=None, processes=None, out=None, verbose=False ):
+    '''
+    Return the CallGraph of all the source files in paths, a list of files
+    and directories. Module names are relative to root, by default the
+    directory when paths names just one. When out is given, a file or file
+    name, the edges of each module are written to it as soon as the module
+    is done. processes is passed to corpus.map_files.
+    '''
+    if isinstance( paths, str ) :
+        paths = [ paths ]
+    if root is None and len( paths ) == 1 and os.path.isdir( paths[0] ) :
+        root = paths[0]
+    graph = CallGraph()
+    stream = None
+    if out is not None :
+        stream = open( out, 'w' ) if isinstance( out, str ) else out
+    try:
+        work = functools.partial( module_edges, root=root )
+        for module, edges in map_files( work, paths, processes ) :
+            if edges is None :
+                if verbose :
+                    print( 'could not compile', module )
+                continue
+            graph.merge( edges )
+            if stream is not None :
+                _write_edges( stream, edges )
+            if verbose :
+                print( module, len( edges ), 'edges' )
+    finally:
+        if stream is not None and isinstance( out, str ) :
+            stream.close()
+    return graph
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# Following executes only when run as a program.
+
+if __name__ == '__main__' :
+    import argparse
+    parser = argparse.ArgumentParser( description='Extract a static call graph.' )
+    parser.add_argument( '-o', '--out', default=None,
+                         help='file for the edges (default: standard output)' )
+    parser.add_argument( '-j', '--processes', type=int, default=None,
+                         help='number of processes (default: one per CPU)' )
+    parser.add_argument( 'paths', nargs='+', help='source files and directories' )
+    options = parser.parse_args()
+    build_callgraph( options.paths, processes=options.processes,
+                     out=options.out if options.out else sys.stdout )
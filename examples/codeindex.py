@@ -0,0 +1,447 @@
+'''
+    codeindex, an inverted index of the instructions of a body of code
+
+Questions such as "which functions use exec" or "what loads the attribute
+_private" can be answered by decoding every function of every module with
+Code.from_code() and scanning its code list, but that takes a long time for
+a large body of code, and has to be done again for each question. This
+module does the decoding once, and keeps an index on disk from each
+instruction, an opcode with its argument, to where it occurs.
+
+The key of an instruction is its opcode name followed, after a space, by
+its argument: the name for opcodes that take a name (LOAD_GLOBAL exec,
+LOAD_ATTR _private), the operator for COMPARE_OP, the number for opcodes
+such as CALL_FUNCTION, and the repr of a constant for LOAD_CONST. Jumps,
+code objects and large constants are indexed by the opcode name alone.
+Each key has a list of where it occurs: the path of the source file, the
+qualified name of the code object in it (see corpus.walk_code), and the
+index of the instruction in that Code's code list.
+
+The index is a directory holding a manifest and one or more segments. The
+manifest, manifest.json, lists each indexed file with its size, time of
+modification, and the segment that indexes it. A segment is a binary file
+in which the keys are sorted, so it can be searched without reading it: it
+is memory-mapped, and a lookup is a binary search of its directory of keys
+followed by a read of the postings of the key found:
+
+    header      magic b'BPIX', format, number of keys, number of codes,
+                and the offsets of the parts below
+    directory   for each key, in order of its UTF-8 bytes: the offset and
+                length of the key, and the first posting and the count
+    keys        the UTF-8 bytes of the keys
+    postings    pairs of 32-bit numbers (code number, instruction index)
+    codes       a JSON list of [ path, qualified name ] by code number
+
+CodeIndex( directory ).update( paths ) indexes the source files in paths
+that are new or have changed since the last update, and writes them in a
+new segment; the postings of a file in older segments are then ignored,
+since the manifest names its new segment. Files that are no longer found
+are dropped from the manifest. When there are more than max_segments
+segments, all are merged into one (which compact() also does).
+
+    index = CodeIndex( 'fleet.idx' )
+    index.update( [ 'src/' ], processes=8 )
+    for path, qualname, pos in index.find( LOAD_GLOBAL, 'exec' ) :
+        print( path, qualname, pos )
+
+Run as a program:
+
+    python codeindex.py update index-dir path...
+    python codeindex.py find index-dir 'LOAD_GLOBAL exec'
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['CodeIndex', 'index_file', 'instruction_key' ]
+
+from byteplay3 import *
+from corpus import compile_file, map_files, module_name, source_files, walk_code
+import functools
+import json
+import mmap
+import os
+import struct
+
+# The layout of a segment: the header, then one directory entry per key.
+
+_magic = b'BPIX'
+_format = 1
+_header = struct.Struct( '<4sIIIQQQQ' )
+_entry = struct.Struct( '<QIQI' )
+_posting = struct.Struct( '<II' )
+
+# Constants whose repr is part of a key, when it is not too long.
+
+_const_types = ( str, bytes, int, float, complex, bool, type( None ), type( Ellipsis ) )
+_max_repr = 200
+
+def _plain_const( value ):
+    if isinstance( value, ( tuple, frozenset ) ) :
+        return all( _plain_const( item ) for item in value )
+    return isinstance( value, _const_types )
+
+def instruction_key( op, arg ):
+    '''
+    Return the index key of the instruction (op, arg).
+    '''
+    name = opname[op]
+    if op in hasjump or arg is None :
+        return name
+    if op == LOAD_CONST :
+        if not _plain_const( arg ) :
+            return name
+        text = repr( arg )
+        return name if len( text ) > _max_repr else name + ' ' + text
+    return name + ' ' + str( arg )
+
+def index_file( path, root=None ):
+    '''
+    Return (path, entries) for the source file at path, where entries is a
+    list of (qualified name, [ (key, instruction index)... ]) for each of
+    its Code objects, or None when the file cannot be compiled.
+    '''
+    code = compile_file( path )
+    if code is None :
+        return path, None
+    entries = []
+    for qualname, code in walk_code( code, module_name( path, root ) ) :
+        keys = [ (instruction_key( op, arg ), pos)
+                 for pos, (op, arg) in enumerate( code.code ) if isopcode( op ) ]
+        entries.append( (qualname, keys) )
+    return path, entries
+
+def _write_segment( filename, codes, postings ):
+    '''
+    Write a segment file. codes is a list of [ path, qualified name ], and
+    postings a dict { key : [ (code number, instruction index)... ] }.
+    '''
+    keys = sorted( ( key.encode( 'utf-8' ), key ) for key in postings )
+    keys_offset = _header.size + _entry.size * len( keys )
+    directory = []
+    blob = []
+    offset = 0
+    first = 0
+    for data, key in keys :
+        directory.append( _entry.pack( offset, len( data ), first, len( postings[key] ) ) )
+        blob.append( data )
+        offset += len( data )
+        first += len( postings[key] )
+    postings_offset = keys_offset + offset
+    codes_data = json.dumps( codes ).encode( 'utf-8' )
+    codes_offset = postings_offset + _posting.size * first
+    temporary = filename + '.tmp'
+    with open( temporary, 'wb' ) as out :
+        out.write( _header.pack( _magic, _format, len( keys ), len( codes ),
+                                 keys_offset, postings_offset,
+                                 codes_offset, len( codes_data ) ) )
+        out.write( b''.join( directory ) )
+        out.write( b''.join( blob ) )
+        for data, key in keys :
+            out.write( b''.join( _posting.pack( number, pos )
+                                 for number, pos in postings[key] ) )
+        out.write( codes_data )
+    os.replace( temporary, filename )
+
+class _Segment(object):
+    '''
+    A segment file, memory-mapped for reading.
+    '''
+    def __init__( self, filename ):
+        self.file = open( filename, 'rb' )
+        try:
+            self.map = mmap.mmap( self.file.fileno(), 0, access=mmap.ACCESS_READ )
+        except ValueError :
+            # an empty file cannot be mapped
+            self.file.close()
+            raise ValueError( 'Not an index segment: ' + filename )
+        magic, version, self.nkeys, self.ncodes, self.keys_offset, \
+            self.postings_offset, self.codes_offset, self.codes_length \
+            = _header.unpack_from( self.map, 0 )
+        if magic != _magic or version != _format :
+            self.close()
+            raise ValueError( 'Not an index segment: ' + filename )
+        self._codes = None
+
+    def close( self ):
+        self.map.close()
+        self.file.close()
+
+    def codes( self ):
+        '''
+        Return the list of [ path, qualified name ], read when first needed.
+        '''
+        if self._codes is None :
+            data = self.map[ self.codes_offset : self.codes_offset + self.codes_length ]
+            self._codes = json.loads( data.decode( 'utf-8' ) )
+        return self._codes
+
+    def _key( self, n ):
+        offset, length, first, count = _entry.unpack_from( self.map, _header.size + _entry.size * n )
+        start = self.keys_offset + offset
+        return self.map[ start : start + length ], first, count
+
+    def _bisect( self, data ):
+        # The number of the first key that is not less than data.
+        low, high = 0, self.nkeys
+        while low < high :
+            middle = ( low + high ) // 2
+            if self._key( middle )[0] < data :
+                low = middle + 1
+            else :
+                high = middle
+        return low
+
+    def keys( self, key, prefix=False ):
+        '''
+        Yield (key, first posting, count) for key, or when prefix is true,
+        for every key that is key itself or begins with key plus a space.
+        '''
+        data = key.encode( 'utf-8' )
+        n = self._bisect( data )
+        while n < self.nkeys :
+            found, first, count = self._key( n )
+            if found != data and not ( prefix and found.startswith( data + b' ' ) ) :
+                break
+            yield found.decode( 'utf-8' ), first, count
+            n += 1
+
+    def all_keys( self ):
+        for n in range( self.nkeys ) :
+            found, first, count = self._key( n )
+            yield found.decode( 'utf-8' ), first, count
+
+    def postings( self, first, count ):
+        start = self.postings_offset + _posting.size * first
+        return _posting.iter_unpack( self.map[ start : start + _posting.size * count ] )
+
+class CodeIndex(object):
+    '''
+    An inverted index of instructions, kept in directory.
+    '''
+    def __init__( self, directory, max_segments=8 ):
+        self.directory = directory
+        self.max_segments = max_segments
+        self.manifest_file = os.path.join( directory, 'manifest.json' )
+        if os.path.exists( self.manifest_file ) :
+            with open( self.manifest_file ) as source :
+                self.manifest = json.load( source )
+        else :
+            os.makedirs( directory, exist_ok=True )
+            self.manifest = { 'format' : _format, 'next' : 0, 'segments' : [], 'files' : {} }
+        self._segments = {}
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exc ):
+        self.close()
+        return False
+
+    def close( self ):
+        '''
+        Unmap the segments. The index can still be used; they are mapped
+        again as needed.
+        '''
+        for segment in self._segments.values() :
+            segment.close()
+        self._segments = {}
+
+    def _segment( self, name ):
+        if name not in self._segments :
+            self._segments[name] = _Segment( os.path.join( self.directory, name ) )
+        return self._segments[name]
+
+    def _save( self ):
+        temporary = self.manifest_file + '.tmp'
+        with open( temporary, 'w' ) as out :
+            json.dump( self.manifest, out )
+        os.replace( temporary, self.manifest_file )
+
+    def _new_segment( self, codes, postings ):
+        name = 'segment-%d.bpix' % self.manifest['next']
+        self.manifest['next'] += 1
+        _write_segment( os.path.join( self.directory, name ), codes, postings )
+        return name
+
+    def files( self ):
+        '''
+        Return a list of the paths of the indexed files.
+        '''
+        return sorted( path for path, ( size, mtime, name ) in self.manifest['files'].items()
+                       if name is not None )
+
+    def update( self, paths, root=None, processes=None, verbose=False ):
+        '''
+        Bring the index up to date with the source files in paths, a list
+        of files and directories, which are taken to be the whole body of
+        code indexed. Module names are relative to root, as in
+        corpus.module_name. processes is passed to corpus.map_files.
+        Return a tuple (number of files indexed, number removed).
+        '''
+        files = self.manifest['files']
+        found = {}
+        for path in source_files( paths ) :
+            stat = os.stat( path )
+            found[path] = [ stat.st_size, stat.st_mtime_ns ]
+        changed = [ path for path, state in found.items()
+                    if path not in files or files[path][:2] != state ]
+        removed = [ path for path in files if path not in found ]
+        for path in removed :
+            del files[path]
+
+        # Index the changed files, numbering their Code objects.
+        codes = []
+        postings = {}
+        failed = []
+        if changed :
+            work = functools.partial( index_file, root=root )
+            for path, entries in map_files( work, changed, processes ) :
+                if entries is None :
+                    failed.append( path )
+                    if verbose :
+                        print( 'could not compile', path )
+                    continue
+                for qualname, keys in entries :
+                    number = len( codes )
+                    codes.append( [ path, qualname ] )
+                    for key, pos in keys :
+                        postings.setdefault( key, [] ).append( (number, pos) )
+                if verbose :
+                    print( 'indexed', path )
+        if codes :
+            name = self._new_segment( codes, postings )
+            self.manifest['segments'].append( name )
+            for path in changed :
+                files[path] = found[path] + [ name ]
+        for path in failed :
+            # not indexed, and not tried again until it changes
+            files[path] = found[path] + [ None ]
+        if changed or removed :
+            self._save()
+        if len( self.manifest['segments'] ) > self.max_segments :
+            self.compact()
+        return len( changed ) - len( failed ), len( removed )
+
+    def _live( self, name, segment ):
+        '''
+        Return a list, by code number, of whether each code in the segment
+        name is still current.
+        '''
+        files = self.manifest['files']
+        return [ path in files and files[path][2] == name for path, qualname in segment.codes() ]
+
+    def find_key( self, key, prefix=False ):
+        '''
+        Yield (path, qualified name, instruction index) for each occurrence
+        of the instruction key, or of every key beginning key plus a space
+        when prefix is true.
+        '''
+        for name in self.manifest['segments'] :
+            segment = self._segment( name )
+            live = None
+            for found, first, count in segment.keys( key, prefix ) :
+                if live is None :
+                    live = self._live( name, segment )
+                    codes = segment.codes()
+                for number, pos in segment.postings( first, count ) :
+                    if live[number] :
+                        path, qualname = codes[number]
+                        yield path, qualname, pos
+
+    def find( self, op, *arg ):
+        '''
+        Yield (path, qualified name, instruction index) for each occurrence
+        of (op, arg), or of op with any argument when no arg is given. op
+        may be an Opcode or an opcode name.
+        '''
+        if isinstance( op, str ) :
+            op = opmap[op]
+        if arg :
+            return self.find_key( instruction_key( op, arg[0] ) )
+        return self.find_key( opname[op], prefix=True )
+
+    def compact( self ):
+        '''
+        Merge all the segments into one, leaving out what is no longer
+        current, and delete the old segment files.
+        '''
+        codes = []
+        postings = {}
+        for name in self.manifest['segments'] :
+            segment = self._segment( name )
+            live = self._live( name, segment )
+            numbers = {}
+            for number, (path, qualname) in enumerate( segment.codes() ) :
+                if live[number] :
+                    numbers[number] = len( codes )
+                    codes.append( [ path, qualname ] )
+            for key, first, count in segment.all_keys() :
+                for number, pos in segment.postings( first, count ) :
+                    if number in numbers :
+                        postings.setdefault( key, [] ).append( (numbers[number], pos) )
+        old = self.manifest['segments']
+        new = self._new_segment( codes, postings ) if codes else None
+        self.manifest['segments'] = [ new ] if new else []
+        for state in self.manifest['files'].values() :
+            if state[2] is not None :
+                state[2] = new
+        self._save()
+        self.close()
+        for name in old :
+            os.remove( os.path.join( self.directory, name ) )
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# Following executes only when run as a program.
+
+if __name__ == '__main__' :
+    import argparse
+    parser = argparse.ArgumentParser( description='Build or query an index of instructions.' )
+    parser.add_argument( '-j', '--processes', type=int, default=None,
+                         help='number of processes (default: one per CPU)' )
+    parser.add_argument( 'command', choices=[ 'update', 'find', 'compact' ] )
+    parser.add_argument( 'index', help='directory of the index' )
+    parser.add_argument( 'args', nargs='*',
+                         help='for update, source files and directories; for find, keys' )
+    options = parser.parse_args()
+    with CodeIndex( options.index ) as index :
+        if options.command == 'update' :
+            indexed, removed = index.update( options.args, processes=options.processes )
+            print( indexed, 'files indexed,', removed, 'removed' )
+        elif options.command == 'compact' :
+            index.compact()
+        else :
+            for key in options.args :
+                for path, qualname, pos in index.find_key( key, prefix=( ' ' not in key ) ) :
+                    print( '%s\t%s\t%d' % ( path, qualname, pos ) )
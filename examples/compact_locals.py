@@ -0,0 +1,171 @@
+'''
+    compact_locals, sharing of local variable slots
+
+Each distinct local variable name in a function gets its own slot in the
+function's frame; co_nlocals is the number of slots. A function that uses
+many short-lived temporaries, as generated code often does, gets a large
+frame, and every call must allocate the frame and clear every slot when it
+returns. In deeply recursive code this cost shows up in profiles.
+
+The decorator @compact_locals does for local names what a compiler's
+register allocator does for registers. Using the Liveness analysis of
+byteplay3 it finds which locals interfere, meaning that one is stored
+while the other still holds a value that may be loaded. Locals that never
+interfere can share one slot, so each such group is renamed to a single
+name, and Code.to_code() then makes one slot for it. The groups are made
+greedily, in order of each local's first appearance in the code.
+
+Some locals are never merged:
+
+    the parameters, which the caller fills by position and keyword;
+    cell variables, which live in the closure, not in fast slots;
+    any local that may be loaded before it is assigned, or after it is
+        deleted, since merging could hide the UnboundLocalError.
+
+A function that calls locals(), vars(), eval() or exec(), or that touches
+frame objects, is left unchanged, because it could see the renaming. (The
+test is the same one used by dead_stores.) Merged locals do appear under
+the shared name in tracebacks and debuggers.
+
+Arguments to @compact_locals are:
+
+    verbose = False
+        when true, each merge and the change of co_nlocals are printed to
+        stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['_compact_locals', 'compact_code', 'compact_locals' ]
+
+from byteplay3 import *
+from make_constants import _func_copy
+from dead_stores import _introspects
+
+_fast_ops = set( [ LOAD_FAST, STORE_FAST, DELETE_FAST ] )
+
+def _interference( code, liveness, candidates ):
+    '''
+    Return a dict { name : set of names } of the candidates that may not
+    share a slot with each name. A store or delete of x interferes with
+    every other local live just after it.
+    '''
+    interferes = { name : set() for name in candidates }
+    for pos, (op, arg) in enumerate( code.code ) :
+        if op == STORE_FAST or op == DELETE_FAST :
+            for other in liveness.live_after( pos ) :
+                if other != arg :
+                    if arg in candidates :
+                        interferes[arg].add( other )
+                    if other in candidates :
+                        interferes[other].add( arg )
+    return interferes
+
+def compact_code( code, verbose=False ):
+    '''
+    Rename the locals of a Code object so that locals whose lifetimes do
+    not overlap share a name, modifying its code list in place. Return a
+    tuple (before, after, merged) where before and after are the number of
+    local slots (co_nlocals) before and after, and merged is a dict
+    { old name : shared name } of the locals that were renamed.
+    '''
+    codelist = code.code
+    names = list( code.args )
+    for op, arg in codelist :
+        if op in _fast_ops and arg not in names :
+            names.append( arg )
+    before = len( names )
+    merged = {}
+    if not code.newlocals or _introspects( code ) :
+        return before, before, merged
+
+    liveness = Liveness( codelist )
+    excluded = set( code.args )
+    excluded.update( arg for op, arg in codelist if op in hasfree )
+    if liveness.graph.entry is not None :
+        excluded |= liveness.live_in[ liveness.graph.entry.index ]
+    for pos, (op, arg) in enumerate( codelist ) :
+        if op == DELETE_FAST and arg in liveness.live_after( pos ) :
+            excluded.add( arg )
+    candidates = [ name for name in names if name not in excluded ]
+    if len( candidates ) < 2 :
+        return before, before, merged
+    interferes = _interference( code, liveness, set( candidates ) )
+
+    # Greedy coloring: each candidate joins the first group that holds
+    # nothing it interferes with, or starts a new group.
+    groups = []
+    for name in candidates :
+        for group in groups :
+            if not any( member in interferes[name] for member in group ) :
+                group.append( name )
+                merged[name] = group[0]
+                if verbose :
+                    print( 'local', name, 'shares the slot of', group[0] )
+                break
+        else :
+            groups.append( [name] )
+    if merged :
+        for pos, (op, arg) in enumerate( codelist ) :
+            if op in _fast_ops and arg in merged :
+                codelist[pos] = (op, merged[arg])
+    after = before - len( merged )
+    if verbose :
+        print( 'co_nlocals', before, '-->', after )
+    return before, after, merged
+
+def _compact_locals( f, verbose=False ):
+    '''
+    Return a copy of function f with its local slots compacted, or f itself
+    when no locals could be merged.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    co = Code.from_code( co )
+    before, after, merged = compact_code( co, verbose )
+    if not merged :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def compact_locals( verbose=False ):
+    """
+    Return a decorator for compacting local variable slots.
+    Verify that the first argument is not the function to decorate.
+    """
+    if type( verbose ) == type( compact_locals ):
+        raise ValueError("The compact_locals decorator must have arguments.")
+    return lambda f: _compact_locals( f, verbose )
@@ -0,0 +1,156 @@
+'''
+    corpus, tools for analyzing many source files at once
+
+The other example modules work on one function at a time. To decide what
+is worth optimizing across a large body of code, it helps to look at all
+of it, and this module supplies the common parts of such a survey:
+
+    source_files( paths )
+        yields the path of each .py file named in paths, or found in any
+        directory named in paths, in sorted order, skipping hidden
+        directories and __pycache__.
+
+    module_name( path, root )
+        returns the dotted module name of a file below the directory root,
+        e.g. "pkg.sub.mod" for root/pkg/sub/mod.py.
+
+    compile_file( path )
+        returns the module code object of a source file, or None when the
+        file cannot be read or compiled.
+
+    walk_code( code, prefix )
+        yields (qualified name, Code object) for a module's Code object and
+        for every Code object nested in it, to any depth. The names are the
+        __qualname__ the functions will have (which the compiler places in
+        the constant after each function's code), prefixed with the module
+        name, e.g. "pkg.mod.Class.method" or "pkg.mod.f.<locals>.g".
+
+    map_files( function, paths, processes=None )
+        calls function( path ) for each file and yields the results in the
+        order they are finished. The work is done in a pool of processes,
+        so function must be defined at the top level of a module. With
+        processes=1 all the work is done in this process.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['compile_file', 'map_files', 'module_name', 'source_files', 'walk_code' ]
+
+from byteplay3 import *
+import os
+import tokenize
+
+def source_files( paths ):
+    '''
+    Yield the path of each .py file in paths, a list of files and
+    directories, searching directories recursively.
+    '''
+    if isinstance( paths, str ) :
+        paths = [ paths ]
+    for path in paths :
+        if os.path.isfile( path ) :
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk( path ) :
+            dirnames[:] = sorted( d for d in dirnames
+                                  if not d.startswith( '.' ) and d != '__pycache__' )
+            for filename in sorted( filenames ) :
+                if filename.endswith( '.py' ) :
+                    yield os.path.join( dirpath, filename )
+
+def module_name( path, root=None ):
+    '''
+    Return the dotted module name of path relative to the directory root,
+    or just its file name without .py when root is None.
+    '''
+    if root is None or not os.path.isdir( root ) :
+        root = os.path.dirname( path )
+    relative = os.path.relpath( path, root )
+    parts = relative[:-3].split( os.sep ) if relative.endswith( '.py' ) \
+            else relative.split( os.sep )
+    if len( parts ) > 1 and parts[-1] == '__init__' :
+        parts.pop()
+    return '.'.join( parts )
+
+def compile_file( path ):
+    '''
+    Return the code object compiled from the source file at path, or None
+    when it cannot be read or compiled.
+    '''
+    try:
+        with tokenize.open( path ) as source :
+            text = source.read()
+        return compile( text, path, 'exec', dont_inherit=True )
+    except ( OSError, SyntaxError, ValueError, UnicodeDecodeError ) :
+        return None
+
+def walk_code( code, prefix ):
+    '''
+    Yield (qualified name, Code) for code, a Code object (or a code object,
+    which is converted), named prefix, and for all the Code objects nested
+    in it, each named prefix + '.' + its qualified name.
+    '''
+    if not isinstance( code, Code ) :
+        code = Code.from_code( code )
+    stack = [ (prefix, code) ]
+    while stack :
+        name, code = stack.pop()
+        yield name, code
+        codelist = code.code
+        nested = []
+        for pos, (op, arg) in enumerate( codelist ) :
+            if op == LOAD_CONST and isinstance( arg, Code ) :
+                qualname = arg.name
+                if pos + 1 < len( codelist ) and codelist[pos+1][0] == LOAD_CONST \
+                   and isinstance( codelist[pos+1][1], str ) :
+                    qualname = codelist[pos+1][1]
+                nested.append( (prefix + '.' + qualname, arg) )
+        stack.extend( reversed( nested ) )
+
+def map_files( function, paths, processes=None, chunksize=4 ):
+    '''
+    Yield function( path ) for each source file in paths, in the order
+    the results are finished, using a pool of processes (as many as there
+    are CPUs when processes is None).
+    '''
+    files = list( source_files( paths ) )
+    if processes == 1 or len( files ) < 2 :
+        for path in files :
+            yield function( path )
+        return
+    import multiprocessing
+    with multiprocessing.Pool( processes ) as pool :
+        for result in pool.imap_unordered( function, files, chunksize ) :
+            yield result
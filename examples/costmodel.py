@@ -0,0 +1,311 @@
+'''
+    costmodel, a static estimate of the cost of a call
+
+To choose which functions are worth optimizing, it helps to have a rough
+idea of what each costs per call without running it. This module makes a
+static estimate: each instruction is given a weight according to its
+family (loading a fast local, loading a global, a call, a binary
+operator...), and each basic block of the FlowGraph scores the sum of the
+weights of its instructions, multiplied by trip_count for each loop that
+contains it. A block in a loop nested two deep, with the default trip
+count of 10, counts 100 times.
+
+The score of a function is the sum of its blocks. Comprehensions and
+generator expressions, whose code runs as part of the function that makes
+them, add their scores to the block that makes them; other nested code,
+such as functions and classes defined inside, is scored on its own, and
+only the cost of making it counts in its parent. The units are those of
+the weights: in default_weights, loading a fast local costs 1.
+
+code_cost( code, weights=None, trip_count=10 ) returns a Cost, with the
+score of the code, the blocks with their loop depths and scores, and the
+Costs of the nested code; function_cost( f ) does the same for a function.
+Cost.report() returns the scores as text, and the disassembly of the
+costliest blocks.
+
+The default weights are rough. calibrate() times a short statement of
+each family of opcodes on the running interpreter, and returns weights in
+the same units, which can be passed to code_cost:
+
+    weights = calibrate()
+    print( function_cost( f, weights ).report() )
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['calibrate', 'code_cost', 'Cost', 'default_weights',
+           'function_cost', 'opcode_family' ]
+
+from byteplay3 import *
+import time
+
+# The relative cost of each family of opcodes, in units of a LOAD_FAST.
+
+default_weights = {
+    'load_fast' : 1, 'load_const' : 1, 'store_fast' : 1, 'stack' : 1,
+    'jump' : 1, 'load_global' : 3, 'load_name' : 4, 'load_attr' : 4,
+    'store' : 5, 'binary' : 4, 'compare' : 3, 'subscr' : 4, 'build' : 5,
+    'iter' : 4, 'block' : 2, 'yield' : 5, 'call' : 20, 'make_function' : 15,
+    'import' : 50, 'other' : 3 }
+
+_families = {}
+for _name, _op in opmap.items() :
+    if _name in ( 'LOAD_FAST', 'LOAD_DEREF', 'LOAD_CLOSURE' ) :
+        _family = 'load_fast'
+    elif _name == 'LOAD_CONST' :
+        _family = 'load_const'
+    elif _name == 'LOAD_GLOBAL' :
+        _family = 'load_global'
+    elif _name in ( 'LOAD_NAME', 'LOAD_CLASSDEREF' ) :
+        _family = 'load_name'
+    elif _name == 'LOAD_ATTR' :
+        _family = 'load_attr'
+    elif _name in ( 'STORE_FAST', 'DELETE_FAST', 'STORE_DEREF' ) :
+        _family = 'store_fast'
+    elif _name.startswith( ( 'STORE_', 'DELETE_' ) ) :
+        _family = 'store'
+    elif _name.startswith( ( 'ROT_', 'DUP_' ) ) or _name in ( 'POP_TOP', 'NOP', 'EXTENDED_ARG' ) :
+        _family = 'stack'
+    elif _name == 'BINARY_SUBSCR' :
+        _family = 'subscr'
+    elif _name.startswith( ( 'BINARY_', 'INPLACE_', 'UNARY_' ) ) :
+        _family = 'binary'
+    elif _name == 'COMPARE_OP' :
+        _family = 'compare'
+    elif _name.startswith( 'CALL_FUNCTION' ) :
+        _family = 'call'
+    elif _name.startswith( 'BUILD_' ) or _name in ( 'LIST_APPEND', 'SET_ADD', 'MAP_ADD' ) :
+        _family = 'build'
+    elif _name in ( 'GET_ITER', 'FOR_ITER', 'GET_YIELD_FROM_ITER' ) or _name.startswith( 'UNPACK_' ) :
+        _family = 'iter'
+    elif _name.startswith( ( 'SETUP_', 'WITH_CLEANUP' ) ) \
+         or _name in ( 'POP_BLOCK', 'POP_EXCEPT', 'END_FINALLY' ) :
+        _family = 'block'
+    elif _name.startswith( ( 'JUMP_', 'POP_JUMP_' ) ) \
+         or _name in ( 'RETURN_VALUE', 'BREAK_LOOP', 'CONTINUE_LOOP' ) :
+        _family = 'jump'
+    elif _name.startswith( 'MAKE_' ) :
+        _family = 'make_function'
+    elif _name.startswith( 'IMPORT_' ) :
+        _family = 'import'
+    elif _name.startswith( 'YIELD_' ) :
+        _family = 'yield'
+    else :
+        _family = 'other'
+    _families[_op] = _family
+
+def opcode_family( op ):
+    '''
+    Return the name of the family of opcode op, a key of default_weights.
+    '''
+    return _families.get( op, 'other' )
+
+# Nested code that runs as part of the code that makes it.
+
+_inline_names = frozenset( [ '<listcomp>', '<setcomp>', '<dictcomp>', '<genexpr>' ] )
+
+def _weight( op, weights ):
+    name = opname[op]
+    if name in weights :
+        return weights[name]
+    family = _families.get( op, 'other' )
+    if family in weights :
+        return weights[family]
+    return weights.get( 'other', default_weights['other'] )
+
+class Cost(object):
+    '''
+    The estimated cost of one code object.
+
+    name        the name of the code
+    code        the Code object
+    score       the estimated cost of one execution
+    blocks      a list of (BasicBlock, loop depth, score) in code order
+    nested      a list of the Costs of the code objects defined in it
+    '''
+    def __init__( self, name, code, blocks, nested ):
+        self.name = name
+        self.code = code
+        self.blocks = blocks
+        self.nested = nested
+        self.score = sum( score for block, depth, score in blocks )
+
+    def __repr__( self ):
+        return '<Cost %s %.0f>' % ( self.name, self.score )
+
+    def walk( self ):
+        '''
+        Yield this Cost and those nested in it, at any depth.
+        '''
+        yield self
+        for cost in self.nested :
+            for inner in cost.walk() :
+                yield inner
+
+    def report( self, top=3 ):
+        '''
+        Return the score of this code and of each nested in it, with the
+        disassembly of the top costliest blocks of each.
+        '''
+        output = []
+        for cost in self.walk() :
+            output.append( '%-40s %12.0f' % ( cost.name, cost.score ) )
+            listing = { pos : line.rstrip() for pos, line in cost.code.code.listing()
+                        if pos is not None }
+            costliest = sorted( cost.blocks, key=lambda entry: entry[2], reverse=True )[:top]
+            for block, depth, score in sorted( costliest, key=lambda entry: entry[0].start ) :
+                if not score :
+                    continue
+                output.append( '    block %d, loop depth %d, score %.0f' % ( block.index, depth, score ) )
+                output.extend( '    ' + listing[pos] for pos in range( block.start, block.end )
+                               if pos in listing )
+        return '\n'.join( output ) + '\n'
+
+def code_cost( code, weights=None, trip_count=10, name=None ):
+    '''
+    Return the Cost of a Code object (or a code object, which is converted).
+    weights is a dict whose keys are family names (see opcode_family) or
+    opcode names, which take precedence, and whose values are the cost of
+    an instruction; default_weights when None.
+    '''
+    if not isinstance( code, Code ) :
+        code = Code.from_code( code )
+    if weights is None :
+        weights = default_weights
+    if name is None :
+        name = code.name
+    codelist = code.code
+    graph = FlowGraph( codelist )
+    depth = { block.index : 0 for block in graph.blocks }
+    for loop in graph.loops() :
+        for block in loop.blocks :
+            depth[block.index] += 1
+    blocks = []
+    nested = []
+    for block in graph.blocks :
+        score = 0
+        for pos in range( block.start, block.end ) :
+            op, arg = codelist[pos]
+            if not isopcode( op ) :
+                continue
+            score += _weight( op, weights )
+            if op == LOAD_CONST and isinstance( arg, Code ) :
+                inner = code_cost( arg, weights, trip_count, name + '.' + arg.name )
+                if arg.name in _inline_names :
+                    score += inner.score
+                nested.append( inner )
+        blocks.append( (block, depth[block.index], score * trip_count ** depth[block.index]) )
+    return Cost( name, code, blocks, nested )
+
+def function_cost( f, weights=None, trip_count=10 ):
+    '''
+    Return the Cost of function f.
+    '''
+    return code_cost( f.__code__, weights, trip_count, f.__qualname__ )
+
+# Statements that exercise each family, for calibrate(). Each runs in a
+# function whose locals are set up as in _bench_setup.
+
+_bench_base = 'x = a'
+_bench_statements = {
+    'load_const' : 'x = 1',
+    'load_global' : 'x = len',
+    'load_attr' : 'x = o.real',
+    'store' : 'o.attr = a',
+    'binary' : 'x = a + b',
+    'compare' : 'x = a < b',
+    'subscr' : 'x = l[1]',
+    'build' : 'x = (a, b)',
+    'stack' : 'a, b = b, a',
+    'jump' : 'if a: pass',
+    'iter' : 'x, y = p',
+    'call' : 'f()',
+    'make_function' : 'x = lambda: 0',
+    }
+_bench_setup = '''
+    class O: pass
+    o = O(); o.real = 1
+    a = 1; b = 2; l = [1, 2, 3]; p = (1, 2)
+    def f(): pass
+'''
+
+def _bench_function( statement, repeat ):
+    source = 'def bench(n):\n' + _bench_setup
+    source += '    for i in range(n):\n'
+    source += ''.join( '        %s\n' % statement for k in range( repeat ) )
+    namespace = {}
+    exec( compile( source, '<calibrate>', 'exec' ), namespace )
+    return namespace['bench']
+
+def _statement_ops( statement ):
+    # The families of the instructions of the statement alone.
+    namespace = {}
+    source = 'def one(a, b, o, l, p, f):\n    %s\n' % statement
+    exec( compile( source, '<calibrate>', 'exec' ), namespace )
+    ops = [ op for op, arg in Code.from_code( namespace['one'].__code__ ).code if isopcode( op ) ]
+    # leave out the "return None" at the end
+    return [ opcode_family( op ) for op in ops[:-2] ]
+
+def _time_statement( statement, number, repeat, best_of ):
+    bench = _bench_function( statement, repeat )
+    best = None
+    for trial in range( best_of ) :
+        start = time.perf_counter()
+        bench( number )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min( best, elapsed )
+    return best / ( number * repeat )
+
+def calibrate( number=20000, repeat=20, best_of=3 ):
+    '''
+    Time a statement of each family on this interpreter and return a dict
+    of weights, in units of one instruction of the base statement "x = a"
+    (a LOAD_FAST and a STORE_FAST, each taken as 1). Families that are not
+    measured keep their default weights, scaled alike.
+    '''
+    empty = _time_statement( 'pass', number, repeat, best_of )
+    unit = ( _time_statement( _bench_base, number, repeat, best_of ) - empty ) / 2
+    if unit <= 0 :
+        return dict( default_weights )
+    weights = dict( default_weights )
+    for family, statement in _bench_statements.items() :
+        families = _statement_ops( statement )
+        count = families.count( family )
+        if not count :
+            continue
+        elapsed = _time_statement( statement, number, repeat, best_of ) - empty
+        others = sum( weights[f] if f != family else 0 for f in families )
+        weights[family] = max( 0.1, round( ( elapsed / unit - others ) / count, 2 ) )
+    return weights
@@ -0,0 +1,182 @@
+'''
+    dead_stores, removal of useless stores to local variables
+
+The decorator @dead_stores finds each STORE_FAST in the decorated function
+whose value can never be loaded, because on every path from the store the
+local is stored again, or the function returns, before it is loaded. Such
+a store costs a dispatch and holds a reference to its value until the
+local is next assigned or the function returns. It is replaced by POP_TOP,
+which drops the value at once. Stores of this kind are rare in code that
+people write, but common in code generated or rewritten by other passes,
+such as inline_calls.
+
+The analysis is the Liveness class of byteplay3. A local that may be
+used by an exception handler is live everywhere in the code the handler
+protects, so stores inside a try statement are removed only when the
+handler cannot load the local either.
+
+Optionally, the decorator also releases large temporary values early. For
+each local named in release, a DELETE_FAST is inserted just after any load
+of the local that is its last use on every path. The local's value is then
+freed while the function continues, instead of when the function returns.
+
+A function that calls locals(), vars(), dir(), eval() or exec(), or that
+touches frame objects (sys._getframe, inspect.currentframe, f_locals,
+tb_frame and the like), can see its own locals by name, so it is left
+unchanged. So is code that uses a dict of locals, such as a class body.
+
+Arguments to @dead_stores are:
+
+    release = ()
+        a list of the names of locals to delete after their last use, or
+        True to do this for every local that is not a parameter.
+
+    verbose = False
+        when true, each change is printed to stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['_dead_stores', 'dead_store_code', 'dead_stores' ]
+
+from byteplay3 import *
+from make_constants import _func_copy
+
+# Names that, when loaded as globals, show that the code may look at its
+# locals by name.
+
+_frame_names = set( [ 'locals', 'vars', 'dir', 'eval', 'exec', 'breakpoint' ] )
+
+# Attributes that lead to a frame object and so to the frame's locals.
+
+_frame_attrs = set( [ '_getframe', 'currentframe', 'stack', 'trace',
+                      'getouterframes', 'getinnerframes',
+                      'f_locals', 'f_back', 'tb_frame', 'gi_frame', 'cr_frame',
+                      'settrace', 'setprofile' ] )
+
+# Opcodes that show the code uses a dict of local names instead of fast
+# locals (module and class bodies).
+
+_name_ops = set( [ LOAD_NAME, STORE_NAME, DELETE_NAME ] )
+
+def _introspects( code ):
+    '''
+    Return True when code might read its own locals by name.
+    '''
+    for op, arg in code.code :
+        if op in _name_ops :
+            return True
+        if op == LOAD_GLOBAL and arg in _frame_names :
+            return True
+        if op == LOAD_ATTR and arg in _frame_attrs :
+            return True
+        if op == IMPORT_NAME and arg in ( 'inspect', 'pdb', 'traceback' ) :
+            return True
+    return False
+
+def dead_store_code( code, release=(), verbose=False ):
+    '''
+    Remove the dead stores from a Code object, modifying its code list in
+    place, and insert DELETE_FAST after the last use of each local named
+    in release (or of every local but the parameters, if release is True).
+    Return a list of tuples (opcode, local name, line number) for each
+    change, where opcode is POP_TOP for a removed store and DELETE_FAST
+    for an early release.
+    '''
+    changes = []
+    if not code.newlocals or _introspects( code ) :
+        return changes
+    if release is True :
+        params = set( code.args )
+        release = set( arg for op, arg in code.code
+                           if op == STORE_FAST and arg not in params )
+    else :
+        release = set( release )
+
+    codelist = code.code
+    liveness = Liveness( codelist )
+    reached = set( block.index for block in liveness.graph.reachable() )
+    edits = []
+    lineno = None
+    for pos, (op, arg) in enumerate( codelist ) :
+        if op is SetLineno :
+            lineno = arg
+            continue
+        if liveness.graph.block_of[pos].index not in reached :
+            continue
+        if op == STORE_FAST and arg not in liveness.live_after( pos ) :
+            edits.append( (pos, POP_TOP, arg, lineno) )
+        elif op == LOAD_FAST and arg in release \
+             and arg not in liveness.live_after( pos ) :
+            # Nothing is gained just before the function returns.
+            nxt = codelist[pos+1][0] if pos + 1 < len( codelist ) else None
+            if nxt != RETURN_VALUE :
+                edits.append( (pos, DELETE_FAST, arg, lineno) )
+
+    # Work from the end of the code list so the positions stay valid.
+    for pos, op, arg, lineno in reversed( edits ) :
+        if op == POP_TOP :
+            codelist[pos] = (POP_TOP, None)
+        else :
+            codelist.insert( pos + 1, (DELETE_FAST, arg) )
+        changes.append( (op, arg, lineno) )
+        if verbose :
+            print( 'dead store of' if op == POP_TOP else 'released',
+                   arg, 'at line', lineno )
+    changes.reverse()
+    return changes
+
+def _dead_stores( f, release=(), verbose=False ):
+    '''
+    Return a copy of function f with its dead stores removed, or f itself
+    when there is nothing to change.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    co = Code.from_code( co )
+    if not dead_store_code( co, release, verbose ) :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def dead_stores( release=(), verbose=False ):
+    """
+    Return a decorator for removing dead stores.
+    Verify that the first argument is not the function to decorate.
+    """
+    if type( release ) == type( dead_stores ):
+        raise ValueError("The dead_stores decorator must have arguments.")
+    return lambda f: _dead_stores( f, release, verbose )
@@ -0,0 +1,343 @@
+'''
+    guided_constants, profile-guided use of make_constants
+
+Applying make_constants to every function of a program is risky, since it
+freezes the value of every global the function uses, and applying it by
+hand to the functions that matter does not scale. This module chooses the
+functions from a profile, and the globals to bind from a scan of the whole
+program, and records the choice in a plan file that can be applied when the
+modules are imported.
+
+The profile counts, for each function, the calls and the executions of
+LOAD_GLOBAL. It can be made in two ways:
+
+    profile_stats( filename )
+        reads a file written by cProfile (or profile) and takes the number
+        of calls of each function; its LOAD_GLOBAL executions are then
+        estimated as the calls times the number of LOAD_GLOBALs in its code.
+
+    profile_run( run, modules )
+        instruments the functions of the modules (see instrument.py) to
+        count their calls and their LOAD_GLOBAL executions, calls run(),
+        and removes the instrumentation.
+
+scan_sources( paths ) compiles every source file of the program and finds
+the functions in them, with the globals each loads, and the names that are
+unsafe to bind: those stored or deleted by STORE_GLOBAL or DELETE_GLOBAL
+anywhere, and those a module body stores more than once or deletes. Since
+make_constants also binds chains such as Config.level or settings.DEBUG,
+an attribute stored or deleted through a global name, as in
+
+    settings.DEBUG = True
+
+makes the dotted name, settings.DEBUG, unsafe too.
+
+make_plan( profile, scan, top=20 ) takes the top functions by LOAD_GLOBAL
+count, leaving out functions defined inside other functions, and gives
+each the stoplist of the unsafe names it loads (and unsafe dotted names
+that begin with one of them, which make_constants does not bind past); a
+function whose globals
+are all unsafe is left out. The plan is a dict, which write_plan() saves as
+JSON in a fixed order, so the same profile and sources give the same file.
+
+apply_plan( plan, module=None ) applies make_constants to the functions of
+the plan, or only to those of the module named module. Put
+
+    guided_constants.apply_plan( 'constants.plan', __name__ )
+
+at the end of a module (after everything is defined) to apply its part of
+the plan each time it is imported.
+
+Run as a program:
+
+    python guided_constants.py -s profile.out -n 20 -o constants.plan path...
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['apply_plan', 'make_plan', 'profile_run', 'profile_stats',
+           'read_plan', 'scan_sources', 'write_plan' ]
+
+from byteplay3 import *
+from corpus import compile_file, module_name, source_files, walk_code
+from instrument import Instrument, _increment, _nested
+from make_constants import _bind_value, _new_stats
+import json
+import os
+import sys
+
+_plan_format = 1
+
+def _key( filename, firstlineno, name ):
+    # Functions are identified as cProfile does, by file, line and name.
+    return ( os.path.realpath( filename ), firstlineno, name )
+
+def profile_stats( filename ):
+    '''
+    Return a profile, { (file name, first line, name) : (calls, None) },
+    from a file written by cProfile or profile.
+    '''
+    import pstats
+    stats = pstats.Stats( filename ).stats
+    profile = {}
+    for ( path, lineno, name ), ( primitive, calls, tottime, cumtime, callers ) in stats.items() :
+        if path.startswith( '<' ) or path == '~' :
+            continue # builtins and compiled code
+        profile[ _key( path, lineno, name ) ] = ( calls, None )
+    return profile
+
+class _GlobalLoads(Instrument):
+    '''
+    Counts of the calls and the LOAD_GLOBAL executions of each function.
+    Each function has two slots, described by (file name, first line, name).
+    '''
+    def instrument_code( self, code ):
+        if not code.newlocals :
+            for inner in _nested( code ) :
+                self.instrument_code( inner )
+            return
+        key = _key( code.filename, code.firstlineno, code.name )
+        calls = self.slot( key )
+        loads = self.slot( key )
+        codelist = code.code
+        instrumented = _increment( self.counters, calls )
+        for op, arg in codelist :
+            if op == LOAD_GLOBAL :
+                instrumented.extend( _increment( self.counters, loads ) )
+            instrumented.append( (op, arg) )
+        codelist[:] = instrumented
+        for inner in _nested( code ) :
+            self.instrument_code( inner )
+
+    def profile( self ):
+        profile = {}
+        for n in range( 0, len( self.slots ), 2 ) :
+            calls, loads = profile.get( self.slots[n], (0, 0) )
+            profile[ self.slots[n] ] = ( calls + self.counters[n], loads + self.counters[n+1] )
+        return profile
+
+def profile_run( run, modules ):
+    '''
+    Instrument the functions of modules (a module or a list of them) to
+    count their calls and LOAD_GLOBAL executions, call run(), and return
+    the profile, { (file name, first line, name) : (calls, loads) }.
+    '''
+    if not isinstance( modules, ( list, tuple ) ) :
+        modules = [ modules ]
+    counter = _GlobalLoads()
+    try:
+        for module in modules :
+            counter.instrument_all( module, module.__name__ )
+        run()
+    finally:
+        counter.uninstrument()
+    return counter.profile()
+
+def _stored_chain( codelist, pos ):
+    '''
+    Return the dotted name, such as 'settings.DEBUG', of the attribute that
+    the STORE_ATTR or DELETE_ATTR at pos stores through a global name, or
+    None when the object is not loaded by LOAD_GLOBAL or LOAD_NAME and a
+    run of LOAD_ATTR just before it.
+    '''
+    attrs = [ codelist[pos][1] ]
+    pos -= 1
+    while pos >= 0 and codelist[pos][0] == LOAD_ATTR :
+        attrs.append( codelist[pos][1] )
+        pos -= 1
+    if pos < 0 or codelist[pos][0] not in ( LOAD_GLOBAL, LOAD_NAME ) :
+        return None
+    attrs.append( codelist[pos][1] )
+    return '.'.join( reversed( attrs ) )
+
+def _stoplist( names, unsafe ):
+    '''
+    Return the sorted list of the names, and the unsafe dotted names
+    beginning with one of them, that are in unsafe.
+    '''
+    stop = set( names ) & unsafe
+    stop.update( dotted for dotted in unsafe
+                 if '.' in dotted and dotted.split( '.' )[0] in names )
+    return sorted( stop )
+
+def scan_sources( paths, root=None ):
+    '''
+    Compile the source files in paths and return a tuple (functions,
+    unsafe). functions is { (file name, first line, name) : (module,
+    qualified name, [ names of globals loaded ], number of LOAD_GLOBALs) }
+    and unsafe is the set of the global names, and dotted names of their
+    attributes, that it is not safe to bind. Module names are relative to
+    root, as in corpus.module_name.
+    '''
+    functions = {}
+    unsafe = set()
+    for path in source_files( paths ) :
+        code = compile_file( path )
+        if code is None :
+            continue
+        module = module_name( path, root )
+        for qualname, code in walk_code( code, module ) :
+            stored = {}
+            loads = []
+            codelist = code.code
+            for pos, (op, arg) in enumerate( codelist ) :
+                if op in ( STORE_ATTR, DELETE_ATTR ) :
+                    dotted = _stored_chain( codelist, pos )
+                    if dotted is not None :
+                        unsafe.add( dotted )
+                elif op in ( STORE_GLOBAL, DELETE_GLOBAL ) :
+                    unsafe.add( arg )
+                elif op == DELETE_NAME :
+                    unsafe.add( arg )
+                elif op == STORE_NAME :
+                    stored[arg] = stored.get( arg, 0 ) + 1
+                elif op == LOAD_GLOBAL :
+                    loads.append( arg )
+            if qualname == module :
+                # the module body: a name bound twice may change later
+                unsafe.update( name for name, count in stored.items() if count > 1 )
+            elif code.newlocals and not stored :
+                functions[ _key( code.filename, code.firstlineno, code.name ) ] = \
+                    ( module, qualname[ len( module ) + 1 : ], sorted( set( loads ) ), len( loads ) )
+    return functions, unsafe
+
+def make_plan( profile, scan, top=20, builtin_only=False, guarded=False ):
+    '''
+    Return a plan for binding the globals of the top functions of profile
+    (from profile_stats or profile_run), ranked by LOAD_GLOBAL executions,
+    using scan, the result of scan_sources.
+    '''
+    functions, unsafe = scan
+    # A property's getter and setter, say, share one qualified name and are
+    # bound together, so each name gets the stoplist of all its functions.
+    loaded = {}
+    for module, qualname, names, count in functions.values() :
+        loaded.setdefault( ( module, qualname ), set() ).update( names )
+    scores = {}
+    for key, ( calls, loads ) in profile.items() :
+        if key not in functions :
+            continue
+        module, qualname, names, count = functions[key]
+        if '<locals>' in qualname or '<' in qualname.split( '.' )[-1] :
+            continue # not reachable by name from its module
+        if loads is None :
+            loads = calls * count
+        if loads and not set( names ) <= unsafe :
+            scores[ ( module, qualname ) ] = scores.get( ( module, qualname ), 0 ) + loads
+    ranked = sorted( ( -loads, module, qualname )
+                     for ( module, qualname ), loads in scores.items() )
+    return { 'format' : _plan_format,
+             'builtin_only' : builtin_only,
+             'guarded' : guarded,
+             'functions' : [ { 'module' : module, 'qualname' : qualname, 'loads' : -score,
+                               'stoplist' : _stoplist( loaded[ ( module, qualname ) ], unsafe ) }
+                             for score, module, qualname in ranked[:top] ] }
+
+def write_plan( plan, filename ):
+    '''
+    Write plan as JSON, in a fixed order.
+    '''
+    with open( filename, 'w' ) as out :
+        json.dump( plan, out, indent=1, sort_keys=True )
+        out.write( '\n' )
+
+def read_plan( filename ):
+    with open( filename ) as source :
+        plan = json.load( source )
+    if plan.get( 'format' ) != _plan_format :
+        raise ValueError( 'Not a plan file: ' + filename )
+    return plan
+
+def apply_plan( plan, module=None, verbose=False ):
+    '''
+    Apply make_constants to the functions in plan, a plan or the name of a
+    plan file, or when module is given, only to those in the module of that
+    name, which must already be in sys.modules (as it is while it is being
+    imported). Other modules are imported. Return a dict of statistics like
+    that of make_constants.bind_all, with the count of functions 'missing'
+    because they were not found.
+    '''
+    import importlib
+    if isinstance( plan, str ) :
+        plan = read_plan( plan )
+    stats = _new_stats()
+    stats['missing'] = 0
+    for entry in plan['functions'] :
+        if module is not None and entry['module'] != module :
+            continue
+        target = sys.modules.get( entry['module'] )
+        if target is None :
+            target = importlib.import_module( entry['module'] )
+        parts = entry['qualname'].split( '.' )
+        for part in parts[:-1] :
+            target = getattr( target, part, None )
+        value = vars( target ).get( parts[-1] ) if target is not None else None
+        if value is None :
+            stats['missing'] += 1
+            if verbose :
+                print( 'not found:', entry['module'], entry['qualname'] )
+            continue
+        options = { 'builtin_only' : plan['builtin_only'], 'stoplist' : entry['stoplist'],
+                    'verbose' : verbose, 'guarded' : plan['guarded'] }
+        new = _bind_value( value, options, stats )
+        if new is not value :
+            setattr( target, parts[-1], new )
+    return stats
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# Following executes only when run as a program.
+
+if __name__ == '__main__' :
+    import argparse
+    parser = argparse.ArgumentParser( description='Make a plan for make_constants from a profile.' )
+    parser.add_argument( '-s', '--stats', required=True,
+                         help='profile written by cProfile' )
+    parser.add_argument( '-n', '--top', type=int, default=20,
+                         help='number of functions to bind (default: 20)' )
+    parser.add_argument( '-o', '--out', default='constants.plan',
+                         help='plan file to write (default: constants.plan)' )
+    parser.add_argument( '-r', '--root', default=None,
+                         help='directory to which module names are relative' )
+    parser.add_argument( '--guarded', action='store_true',
+                         help='bind with guarded=True' )
+    parser.add_argument( 'paths', nargs='+', help='source files and directories of the program' )
+    options = parser.parse_args()
+    root = options.root
+    if root is None and len( options.paths ) == 1 and os.path.isdir( options.paths[0] ) :
+        root = options.paths[0]
+    plan = make_plan( profile_stats( options.stats ), scan_sources( options.paths, root ),
+                      options.top, guarded=options.guarded )
+    write_plan( plan, options.out )
+    print( len( plan['functions'] ), 'functions in', options.out )
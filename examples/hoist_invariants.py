@@ -0,0 +1,282 @@
+'''
+    hoist_invariants, a loop optimizer
+
+The decorator @hoist_invariants finds the loops in the decorated function
+and moves loop-invariant name lookups out of them, in the way a careful
+programmer writes
+
+    append = out.append
+    for x in data:
+        append( len(x) )
+
+instead of calling out.append and len by name on every iteration.
+
+A lookup is loop-invariant when it is
+
+    LOAD_GLOBAL name    and nothing in the loop stores or deletes the
+                        global name, or
+
+    LOAD_FAST name      and nothing in the loop stores or deletes the
+                        local name,
+
+followed by zero or more LOAD_ATTR attr where nothing in the loop stores
+or deletes any attribute of that name. (A plain LOAD_FAST is not worth
+hoisting, so a local must be followed by at least one LOAD_ATTR.)
+
+A lookup is only hoisted from a block that runs on every pass through the
+loop: one that dominates every block that jumps back to the loop header and
+every block that leaves the loop, other than the header itself. So in
+
+    for x in data:
+        if cb is not None:
+            cb.send( x )
+
+cb.send is not hoisted, since it is looked up only when cb is not None.
+
+Each distinct invariant lookup is evaluated once, just before the loop is
+entered, and stored in a new local variable whose name is the dotted
+lookup with a leading period, e.g. ".out.append" or ".len". The names
+cannot collide with any Python identifier. Inside the loop each occurrence
+of the lookup becomes a single LOAD_FAST of the new local. The new names
+are added to the code's local variables by Code.to_code().
+
+Unlike make_constants, this does not freeze any value between calls. But
+it does assume that nothing called from inside the loop rebinds the global
+names, or replaces the attributes, that are hoisted. It also evaluates the
+lookups when the loop is entered, even if the loop body would never have
+executed. Where that matters, pass attributes=False to hoist only global
+names, or do not use this decorator.
+
+Arguments to @hoist_invariants are:
+
+    attributes = True
+        when False only LOAD_GLOBAL lookups are hoisted, not attribute
+        chains.
+
+    verbose = False
+        when true, each hoisted lookup is printed to stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['_hoist_invariants', 'hoist_code', 'hoist_invariants' ]
+
+from byteplay3 import *
+from byteplay3 import _no_fallthrough
+from make_constants import _func_copy
+
+# Opcodes that make a name, local or global, change its value.
+
+_global_stores = set( [ STORE_GLOBAL, DELETE_GLOBAL ] )
+_fast_stores = set( [ STORE_FAST, DELETE_FAST ] )
+_attr_stores = set( [ STORE_ATTR, DELETE_ATTR ] )
+
+# Opcodes that show the code uses a dict of local names instead of fast
+# locals (module and class bodies), where adding locals is not possible.
+
+_name_ops = set( [ LOAD_NAME, STORE_NAME, DELETE_NAME ] )
+
+def _find_preheader( graph, loop ):
+    '''
+    Return the position in the code list at which code can be inserted so
+    that it runs once each time the loop is entered, or None if there is no
+    such place. This requires that the loop header is entered from outside
+    the loop only by falling into it from the block just above it.
+    '''
+    header = loop.header
+    outside = [ pred for pred in header.preds if pred not in loop.blocks ]
+    if len( outside ) != 1 :
+        return None
+    pred = outside[0]
+    if pred.end != header.start :
+        return None
+    op, arg = graph.code[ pred.end - 1 ]
+    if isopcode( op ) :
+        if op in _no_fallthrough :
+            return None
+        if op in hasjump and any( graph.code[pos][0] is arg
+                                  for pos in range( header.start, header.end ) ) :
+            # it jumps to the header, skipping anything inserted above it
+            return None
+    return header.start
+
+def _every_pass( graph, loop ):
+    '''
+    Return the set of the blocks of loop that run on every pass through it:
+    those that dominate each tail of the loop and each block, other than
+    the header, from which control leaves the loop.
+    '''
+    exits = []
+    for block in loop.blocks :
+        if block is loop.header :
+            continue
+        op, arg = graph.code[ block.end - 1 ]
+        if any( succ not in loop.blocks for succ in block.succs ) \
+           or ( isopcode( op ) and op in ( RETURN_VALUE, RAISE_VARARGS ) ) :
+            exits.append( block )
+    return set( block for block in loop.blocks
+                if all( graph.dominates( block, other )
+                        for other in list( loop.tails ) + exits ) )
+
+def _hoist_loop( code, graph, loop, attributes ):
+    '''
+    Hoist the invariant lookups out of one loop of code.code, whose flow
+    graph is graph. Return a list of the dotted names of what was hoisted
+    (possibly empty).
+    '''
+    insert_at = _find_preheader( graph, loop )
+    if insert_at is None :
+        return []
+
+    codelist = code.code
+    positions = []
+    for block in sorted( loop.blocks, key=lambda b: b.start ) :
+        positions.extend( range( block.start, block.end ) )
+
+    # Take a census of what the loop stores.
+    stored_globals = set()
+    stored_fast = set()
+    stored_attrs = set()
+    for pos in positions :
+        op, arg = codelist[pos]
+        if op in _global_stores :
+            stored_globals.add( arg )
+        elif op in _fast_stores :
+            stored_fast.add( arg )
+        elif op in _attr_stores :
+            stored_attrs.add( arg )
+
+    # Find the invariant lookup chains. chains is a dict of
+    # { (root opcode, root name, attribute names) : [ (pos, length)... ] }
+    # Chains are only collected within a block, so a label cannot
+    # separate the items of one chain, and only in blocks that run on
+    # every pass, so a lookup made under a condition is not made early.
+    chains = {}
+    for block in sorted( _every_pass( graph, loop ), key=lambda b: b.start ) :
+        pos = block.start
+        while pos < block.end :
+            op, arg = codelist[pos]
+            if ( op == LOAD_GLOBAL and arg not in stored_globals ) \
+               or ( op == LOAD_FAST and attributes and arg not in stored_fast ) :
+                root = (op, arg)
+                attrs = []
+                end = pos + 1
+                while attributes and end < block.end \
+                      and codelist[end][0] == LOAD_ATTR \
+                      and codelist[end][1] not in stored_attrs :
+                    attrs.append( codelist[end][1] )
+                    end += 1
+                if op == LOAD_GLOBAL or attrs :
+                    key = root + ( tuple( attrs ), )
+                    chains.setdefault( key, [] ).append( (pos, end - pos) )
+                pos = end
+            else :
+                pos += 1
+    if not chains :
+        return []
+
+    # Replace each occurrence of a chain with a LOAD_FAST of its new local,
+    # working from the end of the code list so the positions stay valid.
+    occurrences = []
+    prologue = []
+    hoisted = []
+    for (op, name, attrs), where in sorted( chains.items(), key=lambda kv: kv[1][0] ) :
+        dotted = '.'.join( (name,) + attrs )
+        local = '.' + dotted
+        hoisted.append( dotted )
+        prologue.append( (op, name) )
+        prologue.extend( (LOAD_ATTR, attr) for attr in attrs )
+        prologue.append( (STORE_FAST, local) )
+        occurrences.extend( (pos, length, local) for (pos, length) in where )
+    for pos, length, local in sorted( occurrences, reverse=True ) :
+        codelist[pos:pos+length] = [ (LOAD_FAST, local) ]
+
+    # All the replacements are at or after insert_at, so it is still valid.
+    codelist[insert_at:insert_at] = prologue
+    return hoisted
+
+def hoist_code( code, attributes=True, verbose=False ):
+    '''
+    Hoist the loop-invariant lookups out of every loop in a Code object,
+    modifying its code list in place. Return a list of the dotted names
+    that were hoisted, with repetitions when the same name was hoisted
+    out of more than one loop.
+    '''
+    if not code.newlocals or any( op in _name_ops for op, arg in code.code ) :
+        return []
+    hoisted = []
+
+    # Each hoist changes the code, so the flow graph is rebuilt and the
+    # loops examined again, largest first, until no loop yields anything.
+    # Hoisting out of an outer loop first means that a lookup that is
+    # invariant in both is moved all the way out.
+    while True :
+        graph = FlowGraph( code.code )
+        for loop in graph.loops() :
+            names = _hoist_loop( code, graph, loop, attributes )
+            if names :
+                if verbose :
+                    for name in names :
+                        print( 'hoisted', name, 'out of loop at', loop.header.start )
+                hoisted.extend( names )
+                break
+        else :
+            break
+    return hoisted
+
+def _hoist_invariants( f, attributes=True, verbose=False ):
+    '''
+    Return a copy of function f with the invariant lookups hoisted out of
+    its loops, or f itself when there is nothing to hoist.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    if verbose :
+        print( 'hoist_invariants on', f.__name__ )
+    co = Code.from_code( co )
+    if not hoist_code( co, attributes, verbose ) :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def hoist_invariants( attributes=True, verbose=False ):
+    """
+    Return a decorator for hoisting loop-invariant lookups.
+    Verify that the first argument is not a function.
+    """
+    if type( attributes ) == type( hoist_invariants ):
+        raise ValueError("The hoist_invariants decorator must have arguments.")
+    return lambda f: _hoist_invariants( f, attributes, verbose )
@@ -0,0 +1,288 @@
+'''
+    inline_calls, a call-site inliner
+
+The decorator @inline_calls replaces calls of small helper functions in the
+decorated function with the bodies of those helpers, saving the cost of a
+Python function call on each execution. A call site is the sequence
+
+    LOAD_GLOBAL f
+    ... n arguments ...
+    CALL_FUNCTION n
+
+where f names one of the callee functions given to the decorator. The
+LOAD_GLOBAL is removed and the CALL_FUNCTION is replaced with
+
+    STORE_FAST      the parameters of f, last first (defaults are loaded
+                    for parameters not passed)
+    ...             the code of f, with its locals renamed and each
+                    RETURN_VALUE changed to a jump to the end
+    Label           the end, where the returned value is on the stack
+
+A callee is eligible when it is small (max_size opcodes or fewer), shares
+the caller's globals, takes only positional parameters, is not a generator
+or coroutine, has no closure and defines no inner functions, does not refer
+to its own name (so is not directly recursive), contains no loops, try
+or with statements (whose blocks a return would leave behind), and cannot
+read a local before assigning it (which would otherwise see the value left
+by an earlier run of the inlined code, where the callee would have raised
+UnboundLocalError). Calls that pass keyword or star arguments are not
+inlined.
+
+The locals of the callee become locals of the caller, named for example
+".f1.x" for local x of the first inlined copy of f. At the end of the
+inlined code the parameters are deleted and the other locals set to None,
+so they do not keep their values alive until the caller returns (a local
+that is assigned on only some paths might be unbound there, so it cannot
+be deleted). Like make_constants,
+this binds the callee as it was when the decorator was applied: rebinding
+the name f later has no effect on the caller. Also, the source lines of the
+callee are not kept. The line number table of a code object can only
+increase, so the inlined code is reported as part of the caller's line.
+
+Arguments to @inline_calls are:
+
+    callees
+        a dict of { name : function } of the functions to inline, or a
+        list of functions, which are keyed by their __name__.
+
+    max_size = 30
+        the largest callee, in opcodes, that will be inlined.
+
+    budget = 300
+        the largest total number of opcodes that will be added to the
+        caller by inlining.
+
+    verbose = False
+        when true, each inlined call is printed to stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['_inline_calls', 'inline_code', 'inline_calls' ]
+
+from byteplay3 import *
+from make_constants import _func_copy
+import types
+
+# co_flags bits that make a function ineligible: *args, **kwargs,
+# generators and coroutines.
+
+_bad_flags = 0x0004 | 0x0008 | 0x0020 | 0x0080 | 0x0100
+
+# Opcodes that make a callee ineligible: blocks that a return would leave
+# on the block stack, yields, name-dict access, and inner functions.
+
+_bad_ops = set( op for name, op in opmap.items()
+                  if name.startswith( ('SETUP_', 'YIELD_', 'MAKE_') )
+                  or name in ('LOAD_NAME', 'STORE_NAME', 'DELETE_NAME',
+                              'LOAD_CLOSURE', 'LOAD_DEREF', 'STORE_DEREF',
+                              'LOAD_CLASSDEREF', 'DELETE_DEREF',
+                              'IMPORT_STAR', 'BREAK_LOOP', 'CONTINUE_LOOP') )
+
+# Global names that look at the current frame, which after inlining is the
+# caller's frame.
+
+_frame_names = set( [ 'locals', 'vars', 'dir', 'eval', 'exec', 'super' ] )
+
+class _Callee(object):
+    '''
+    The parts of an eligible callee function that inlining needs.
+    '''
+    def __init__( self, name, function, code ):
+        self.name = name
+        self.function = function
+        self.code = code
+        self.nargs = len( code.args )
+        self.defaults = function.__defaults__ or ()
+        self.size = sum( 1 for op, arg in code.code if isopcode( op ) )
+        self.copies = 0
+
+def _eligible( name, f, max_size, caller_globals ):
+    '''
+    Return a _Callee for function f if it can be inlined, else None.
+    '''
+    if not isinstance( f, types.FunctionType ) :
+        return None
+    co = f.__code__
+    if f.__closure__ or co.co_freevars or co.co_cellvars \
+       or co.co_flags & _bad_flags or co.co_kwonlyargcount :
+        return None
+    if caller_globals is not None and f.__globals__ is not caller_globals :
+        return None
+    code = Code.from_code( co )
+    callee = _Callee( name, f, code )
+    if callee.size > max_size :
+        return None
+    for op, arg in code.code :
+        if op in _bad_ops :
+            return None
+        if op == LOAD_GLOBAL and ( arg == name or arg == co.co_name or arg in _frame_names ) :
+            return None
+    # Only the parameters may be live on entry; any other local that is
+    # live there can be read before it is assigned.
+    if Liveness( code ).live_in[0] - set( code.args ) :
+        return None
+    return callee
+
+def _expansion( callee, nargs ):
+    '''
+    Return the list of (op, arg) that replaces a CALL_FUNCTION nargs of
+    callee, with the callable and nargs arguments on the stack.
+    '''
+    callee.copies += 1
+    prefix = '.%s%d.' % ( callee.name, callee.copies )
+    params = callee.code.args
+    expansion = []
+
+    # Push the defaults of parameters that were not passed.
+    first_default = callee.nargs - len( callee.defaults )
+    for i in range( nargs, callee.nargs ) :
+        expansion.append( (LOAD_CONST, callee.defaults[ i - first_default ]) )
+
+    # Pop the arguments into the renamed parameters, last one first.
+    for param in reversed( params ) :
+        expansion.append( (STORE_FAST, prefix + param) )
+
+    # Copy the body with fresh labels and renamed locals. A return
+    # becomes a jump to the end label, except a return at the very end,
+    # which can simply fall through to it.
+    end = Label()
+    labels = {}
+    body = [ item for item in callee.code.code if item[0] is not SetLineno ]
+    last_op = max( i for i, (op, arg) in enumerate( body ) if isopcode( op ) )
+    for i, (op, arg) in enumerate( body ) :
+        if isinstance( op, Label ) :
+            expansion.append( (labels.setdefault( op, Label() ), None) )
+        elif op == RETURN_VALUE :
+            if i != last_op :
+                expansion.append( (JUMP_ABSOLUTE, end) )
+        elif op in hasjump :
+            expansion.append( (op, labels.setdefault( arg, Label() )) )
+        elif op in haslocal :
+            expansion.append( (op, prefix + arg) )
+        else :
+            expansion.append( (op, arg) )
+    expansion.append( (end, None) )
+
+    # Let go of the values of the renamed locals. The parameters were
+    # stored on the way in, so they can be deleted; the others might not
+    # have been assigned, so they are set to None instead.
+    for param in params :
+        expansion.append( (DELETE_FAST, prefix + param) )
+    others = []
+    for op, arg in body :
+        if op in haslocal and arg not in params and arg not in others :
+            others.append( arg )
+    for name in others :
+        expansion.extend( [ (LOAD_CONST, None), (STORE_FAST, prefix + name) ] )
+    return expansion
+
+def inline_code( code, callees, max_size=30, budget=300, caller_globals=None, verbose=False ):
+    '''
+    Inline the calls of eligible callees into a Code object, modifying its
+    code list in place. callees is a dict { name : function }. When
+    caller_globals is given, only callees that share that dict of globals
+    are eligible. Return a report, a list of tuples (callee name, line
+    number of the call, opcodes added).
+    '''
+    report = []
+    if not code.newlocals \
+       or any( op in (LOAD_NAME, STORE_NAME, DELETE_NAME) for op, arg in code.code ) :
+        return report
+    eligible = {}
+    for name, f in callees.items() :
+        callee = _eligible( name, f, max_size, caller_globals )
+        if callee is not None :
+            eligible[name] = callee
+
+    # Inline one call at a time, then look for call sites again, since
+    # the positions have changed. An inlined body may itself contain
+    # calls of eligible callees; these are inlined in turn, until the
+    # budget runs out.
+    while eligible :
+        codelist = code.code
+        for call, first, last in call_sites( codelist ) :
+            if first is None or first != last :
+                continue
+            op, name = codelist[first]
+            callop, nargs = codelist[call]
+            if op != LOAD_GLOBAL or callop != CALL_FUNCTION or name not in eligible :
+                continue
+            callee = eligible[name]
+            if nargs > callee.nargs or nargs < callee.nargs - len( callee.defaults ) :
+                continue
+            if callee.size > budget :
+                continue
+            expansion = _expansion( callee, nargs )
+            budget -= callee.size
+            lineno = None
+            for op, arg in codelist[:call] :
+                if op is SetLineno :
+                    lineno = arg
+            codelist[call:call+1] = expansion
+            del codelist[first]
+            report.append( (name, lineno, len( expansion )) )
+            if verbose :
+                print( 'inlined', name, 'at line', lineno )
+            break
+        else :
+            break
+    return report
+
+def _inline_calls( f, callees, max_size=30, budget=300, verbose=False ):
+    '''
+    Return a copy of function f with calls of callees inlined, or f itself
+    when no call was inlined.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    if not isinstance( callees, dict ) :
+        callees = { g.__name__ : g for g in callees }
+    co = Code.from_code( co )
+    report = inline_code( co, callees, max_size, budget, f.__globals__, verbose )
+    if not report :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def inline_calls( callees, max_size=30, budget=300, verbose=False ):
+    """
+    Return a decorator for inlining calls of the given callees.
+    Verify that the first argument is not the function to decorate.
+    """
+    if isinstance( callees, types.FunctionType ):
+        raise ValueError("The inline_calls decorator must have arguments.")
+    return lambda f: _inline_calls( f, callees, max_size, budget, verbose )
@@ -0,0 +1,501 @@
+'''
+    instrument, counters compiled into the code of functions
+
+Tools such as coverage measurement that work through sys.settrace() call a
+Python function on every line executed, which can make a program several
+times slower. This module instead inserts into the code of the functions
+being measured the shortest sequence of instructions that counts an event,
+the equivalent of
+
+    counters[slot] += 1
+
+where counters is an array of unsigned 64-bit integers (array('Q')) that
+is bound into the code as a constant, and slot is the number of the
+counter for that event. No function is called, so the overhead is a few
+instructions per event. The instructions leave the stack as they found it,
+so they can be put anywhere, even inside an expression.
+
+An Instrument holds the array of counters, a list describing what each
+slot counts, and the original code of each function it has changed, so
+that the change can be undone. instrument( f ) replaces f.__code__ with an
+instrumented copy, so the function object, and every reference to it, is
+unchanged; uninstrument( f ) puts the original code back, or with no
+argument, that of every function instrumented. instrument_all( mc ) does
+this for every function, method, staticmethod, classmethod and property
+in a module or class, and the classes nested in it, like bind_all in
+make_constants, and instrument_package( package ) does it for every module
+of a package, like bind_package. Functions defined inside an instrumented function are
+instrumented as they are created, but are not restored by uninstrument.
+
+Coverage is an Instrument that counts the execution of each source line,
+with an increment after each (SetLineno, line) in the code list. Its
+collect() returns { file name : { line number : count } }.
+
+    coverage = Coverage()
+    coverage.instrument_all( mymodule )
+    run_the_tests()
+    coverage.uninstrument()
+    for filename, lines in coverage.collect().items() : ...
+
+BlockProfile is an Instrument that counts the entries to each basic block
+of the FlowGraph of each code object, with an increment before the first
+instruction of the block, after any labels, so that it counts both the
+jumps to the block and the falls into it. Its report() is the disassembly
+of the original code, as printcodelist shows it, with the count of each
+block in the left margin of the block's first instruction.
+
+The increment needs at most four more items of stack, which Code.to_code()
+allows for when it computes the stack size. It takes from the stack what
+it puts there, so the depth of the stack at each original instruction is
+as it was, and an increment at the head of an exception handler, with the
+exception on the stack, is harmless.
+
+Timing is an Instrument that counts the calls of each function and adds
+up the time spent in it, in an array('d') of seconds beside the counters.
+The code of the function becomes
+
+    counters[slot] += 1
+    .t0 = perf_counter()
+    try:
+        ... the original code ...
+    finally:
+        seconds[slot] += perf_counter() - .t0
+
+in which .t0 is a new local variable and perf_counter is bound as a
+constant. Since the finally block runs at every return and on every
+exception, each way out of the function is timed. In a generator, the
+time is also added up before each YIELD_VALUE, and .t0 set again when it
+resumes, so the time the generator is suspended is not counted. (The time
+a YIELD_FROM waits, which includes the time its sub-iterator is
+suspended, is counted.) The time of a function includes that of the
+functions it calls. Module and class bodies, which have no fast locals,
+are not timed, nor is a function with so many nested blocks that another
+would exceed Python's limit. report() lists the functions by time.
+
+AllocationSites is an Instrument that counts the executions of each
+instruction that makes a new object: BUILD_TUPLE, BUILD_LIST, BUILD_SET,
+BUILD_MAP and their _UNPACK forms, BUILD_SLICE, MAKE_FUNCTION and
+MAKE_CLOSURE, and the calls (found by call_sites) of constructors named
+by LOAD_GLOBAL or LOAD_NAME, with any LOAD_ATTR after: by default the
+builtin types such as list and dict, to which others, such as
+"collections.OrderedDict" or "Point", can be added. Unlike tracemalloc it
+does not see every allocation, nor measure sizes, but it costs only the
+increment at each site, so it can be left on to show where objects are
+made most often. report() ranks the sites by count, with their lines.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['AllocationSites', 'BlockProfile', 'Coverage', 'Instrument', 'Timing' ]
+
+from byteplay3 import *
+from array import array
+import time
+import types
+
+def _increment( counters, slot ):
+    '''
+    Return the list of (op, arg) that adds one to counters[slot].
+    '''
+    return [ (LOAD_CONST, counters), (LOAD_CONST, slot), (DUP_TOP_TWO, None),
+             (BINARY_SUBSCR, None), (LOAD_CONST, 1), (INPLACE_ADD, None),
+             (ROT_THREE, None), (STORE_SUBSCR, None) ]
+
+def _nested( code ):
+    '''
+    Yield the Code objects of functions and classes defined in code.
+    '''
+    for op, arg in code.code :
+        if op == LOAD_CONST and isinstance( arg, Code ) :
+            yield arg
+
+class Instrument(object):
+    '''
+    An array of counters and the functions whose code updates them. A
+    subclass defines instrument_code() to insert the updates.
+    '''
+    typecode = 'Q'
+
+    def __init__( self ):
+        self.counters = array( self.typecode )
+        # what each slot counts
+        self.slots = []
+        # { function : its original code object }
+        self.originals = {}
+
+    def slot( self, description ):
+        '''
+        Add a counter and return its slot number.
+        '''
+        self.counters.append( 0 )
+        self.slots.append( description )
+        return len( self.slots ) - 1
+
+    def reset( self ):
+        '''
+        Set all the counters to zero.
+        '''
+        for n in range( len( self.counters ) ) :
+            self.counters[n] = 0
+
+    def instrument_code( self, code ):
+        '''
+        Insert the instrumentation into a Code object and the Code objects
+        nested in it, in place. Each subclass does this in its own way; the
+        base class inserts nothing, so instrument() of it only replaces the
+        code with an equivalent copy.
+        '''
+        pass
+
+    def instrument( self, f ):
+        '''
+        Replace the code of function f with an instrumented copy. Return
+        True if it was changed, False when f is not a Python function or is
+        already instrumented.
+        '''
+        if not isinstance( f, types.FunctionType ) or f in self.originals :
+            return False
+        code = Code.from_code( f.__code__ )
+        self.instrument_code( code )
+        self.originals[f] = f.__code__
+        f.__code__ = code.to_code()
+        return True
+
+    def uninstrument( self, f=None ):
+        '''
+        Restore the original code of f, or when f is None, of every function
+        that was instrumented. The counters are kept.
+        '''
+        functions = list( self.originals ) if f is None else [ f ]
+        for f in functions :
+            if f in self.originals :
+                f.__code__ = self.originals.pop( f )
+
+    def instrument_all( self, mc, prefix=None, seen=None ):
+        '''
+        Instrument the functions in the namespace of module or class mc, and
+        recurse into the classes and modules it contains. When prefix is
+        given, only functions and classes whose __module__ starts with it,
+        and modules whose __name__ does, are instrumented. Return the number
+        of functions instrumented.
+        '''
+        if seen is None :
+            seen = set()
+        if id( mc ) in seen :
+            return 0
+        seen.add( id( mc ) )
+        try:
+            d = vars( mc )
+        except TypeError:
+            return 0
+        def ours( v, name_attr='__module__' ):
+            name = getattr( v, name_attr, None ) or ''
+            return prefix is None or name == prefix or name.startswith( prefix + '.' )
+        count = 0
+        for v in list( d.values() ) :
+            if isinstance( v, types.ModuleType ) :
+                if ours( v, '__name__' ) :
+                    count += self.instrument_all( v, prefix, seen )
+            elif isinstance( v, type ) :
+                if ours( v ) :
+                    count += self.instrument_all( v, prefix, seen )
+            elif isinstance( v, ( staticmethod, classmethod ) ) :
+                if ours( v.__func__ ) :
+                    count += self.instrument( v.__func__ )
+            elif isinstance( v, property ) :
+                for f in ( v.fget, v.fset, v.fdel ) :
+                    if f is not None and ours( f ) :
+                        count += self.instrument( f )
+            elif isinstance( v, types.FunctionType ) and ours( v ) :
+                count += self.instrument( v )
+        return count
+
+    def instrument_package( self, package ):
+        '''
+        Import every submodule of package, then instrument the functions
+        and classes defined in the package and its submodules. Return the
+        number of functions instrumented.
+        '''
+        import importlib
+        import pkgutil
+        modules = [ package ]
+        for finder, name, ispkg in pkgutil.walk_packages(
+                getattr( package, '__path__', [] ), package.__name__ + '.' ) :
+            modules.append( importlib.import_module( name ) )
+        seen = set()
+        return sum( self.instrument_all( module, package.__name__, seen )
+                    for module in modules )
+
+class Coverage(Instrument):
+    '''
+    Counts of the executions of each source line. Each slot is described
+    by a tuple (file name, line number).
+    '''
+    def instrument_code( self, code ):
+        codelist = code.code
+        instrumented = []
+        for op, arg in codelist :
+            instrumented.append( (op, arg) )
+            if op is SetLineno :
+                slot = self.slot( (code.filename, arg) )
+                instrumented.extend( _increment( self.counters, slot ) )
+        codelist[:] = instrumented
+        for inner in _nested( code ) :
+            self.instrument_code( inner )
+
+    def collect( self ):
+        '''
+        Return { file name : { line number : count } } for every line of the
+        instrumented code, including lines that were not executed.
+        '''
+        result = {}
+        for (filename, lineno), count in zip( self.slots, self.counters ) :
+            lines = result.setdefault( filename, {} )
+            lines[lineno] = lines.get( lineno, 0 ) + count
+        return result
+
+class BlockProfile(Instrument):
+    '''
+    Counts of the entries to each basic block. Each slot is described by a
+    tuple (file name, code name, first line number, block index).
+    '''
+    def __init__( self ):
+        super().__init__()
+        # for each code object instrumented, a tuple (Code, copy of its
+        # original code list, [ (position of first instruction, slot)... ])
+        self.profiled = []
+
+    def instrument_code( self, code ):
+        codelist = code.code
+        original = CodeList( codelist )
+        entries = []
+        for block in FlowGraph( codelist ).blocks :
+            for pos in range( block.start, block.end ) :
+                if isopcode( codelist[pos][0] ) :
+                    slot = self.slot( (code.filename, code.name, code.firstlineno, block.index) )
+                    entries.append( (pos, slot) )
+                    break
+        for pos, slot in reversed( entries ) :
+            codelist[pos:pos] = _increment( self.counters, slot )
+        self.profiled.append( (code, original, entries) )
+        for inner in _nested( code ) :
+            self.instrument_code( inner )
+
+    def collect( self ):
+        '''
+        Return { (file name, code name, first line number) : [ count of each
+        block ] } for every code object instrumented.
+        '''
+        result = {}
+        for (filename, name, firstlineno, index), count in zip( self.slots, self.counters ) :
+            result.setdefault( (filename, name, firstlineno), [] ).append( count )
+        return result
+
+    def report( self, name=None ):
+        '''
+        Return the disassembly of each code object instrumented (or only of
+        those whose name is name) with the count of each block beside its
+        first instruction.
+        '''
+        output = []
+        for code, original, entries in self.profiled :
+            if name is not None and code.name != name :
+                continue
+            counts = { pos : self.counters[slot] for pos, slot in entries }
+            output.append( '=== %s (%s:%d) ===' % ( code.name, code.filename, code.firstlineno ) )
+            for pos, line in original.listing() :
+                if pos in counts :
+                    output.append( '%10d  %s' % ( counts[pos], line ) )
+                else :
+                    output.append( ( '%10s  %s' % ( '', line ) ).rstrip() )
+        return '\n'.join( output ) + '\n'
+
+# The most blocks (loops, try and with statements) that can be nested in
+# a function, CO_MAXBLOCKS in CPython.
+
+_max_blocks = 20
+
+_setup_ops = set( [ SETUP_LOOP, SETUP_EXCEPT, SETUP_FINALLY, SETUP_WITH ] )
+
+class Timing(Instrument):
+    '''
+    The number of calls of each function, and the total seconds spent in
+    it. Each slot is described by a tuple (file name, code name, first line
+    number).
+    '''
+    def __init__( self, clock=time.perf_counter ):
+        super().__init__()
+        self.clock = clock
+        self.seconds = array( 'd' )
+
+    def slot( self, description ):
+        self.seconds.append( 0.0 )
+        return super().slot( description )
+
+    def reset( self ):
+        super().reset()
+        for n in range( len( self.seconds ) ) :
+            self.seconds[n] = 0.0
+
+    def _elapsed( self, slot ):
+        # seconds[slot] += clock() - .t0
+        return [ (LOAD_CONST, self.seconds), (LOAD_CONST, slot), (DUP_TOP_TWO, None),
+                 (BINARY_SUBSCR, None), (LOAD_CONST, self.clock), (CALL_FUNCTION, 0),
+                 (LOAD_FAST, '.t0'), (BINARY_SUBTRACT, None), (INPLACE_ADD, None),
+                 (ROT_THREE, None), (STORE_SUBSCR, None) ]
+
+    def _start( self ):
+        # .t0 = clock()
+        return [ (LOAD_CONST, self.clock), (CALL_FUNCTION, 0), (STORE_FAST, '.t0') ]
+
+    def instrument_code( self, code ):
+        for inner in _nested( code ) :
+            self.instrument_code( inner )
+        codelist = code.code
+        if not code.newlocals \
+           or sum( 1 for op, arg in codelist if op in _setup_ops ) >= _max_blocks - 1 :
+            return
+        slot = self.slot( (code.filename, code.name, code.firstlineno) )
+        body = []
+        for op, arg in codelist :
+            if op == YIELD_VALUE :
+                body.extend( self._elapsed( slot ) )
+                body.append( (op, arg) )
+                body.extend( self._start() )
+            else :
+                body.append( (op, arg) )
+        final = Label()
+        prologue = _increment( self.counters, slot ) + self._start() + [ (SETUP_FINALLY, final) ]
+        epilogue = []
+        last = [ op for op, arg in codelist if isopcode( op ) ][-1:]
+        if not last or last[0] not in ( RETURN_VALUE, RAISE_VARARGS, JUMP_ABSOLUTE, JUMP_FORWARD ) :
+            # the code can fall off its end into the finally block
+            epilogue = [ (POP_BLOCK, None), (LOAD_CONST, None) ]
+        epilogue.append( (final, None) )
+        epilogue.extend( self._elapsed( slot ) )
+        # END_FINALLY continues the return or the exception. It falls
+        # through only when the finally block was entered by POP_BLOCK,
+        # and the code then returns None, as Python functions do.
+        epilogue.extend( [ (END_FINALLY, None), (LOAD_CONST, None), (RETURN_VALUE, None) ] )
+        codelist[:] = prologue + body + epilogue
+
+    def collect( self ):
+        '''
+        Return { (file name, code name, first line number) : (calls, seconds) }
+        for every function instrumented.
+        '''
+        return { description : (calls, seconds) for description, calls, seconds
+                 in zip( self.slots, self.counters, self.seconds ) }
+
+    def report( self, limit=None ):
+        '''
+        Return a table of the functions that were called, with the number
+        of calls and the total and average seconds, most time first.
+        '''
+        rows = sorted( ( (seconds, calls, description) for description, (calls, seconds)
+                         in self.collect().items() if calls ),
+                       key=lambda row: row[0], reverse=True )
+        output = [ '%10s %12s %12s  %s' % ( 'calls', 'seconds', 'per call', 'function' ) ]
+        for seconds, calls, (filename, name, firstlineno) in rows[:limit] :
+            output.append( '%10d %12.6f %12.9f  %s (%s:%d)' % (
+                calls, seconds, seconds / calls, name, filename, firstlineno ) )
+        return '\n'.join( output ) + '\n'
+
+# Opcodes that make a new object, where this version of Python has them.
+
+_allocating_ops = set( opmap[name] for name in (
+    'BUILD_TUPLE', 'BUILD_LIST', 'BUILD_SET', 'BUILD_MAP', 'BUILD_SLICE',
+    'BUILD_TUPLE_UNPACK', 'BUILD_LIST_UNPACK', 'BUILD_SET_UNPACK',
+    'BUILD_MAP_UNPACK', 'BUILD_MAP_UNPACK_WITH_CALL',
+    'MAKE_FUNCTION', 'MAKE_CLOSURE' ) if name in opmap )
+
+# The builtin types whose calls are counted by default.
+
+_constructors = frozenset( [ 'bytearray', 'bytes', 'dict', 'frozenset', 'list',
+                             'object', 'set', 'tuple' ] )
+
+class AllocationSites(Instrument):
+    '''
+    Counts of the executions of the instructions that make new objects.
+    Each slot is described by a tuple (file name, code name, line number,
+    opcode name, constructor name or None).
+    '''
+    def __init__( self, constructors=() ):
+        super().__init__()
+        self.constructors = _constructors | frozenset( constructors )
+
+    def instrument_code( self, code ):
+        codelist = code.code
+        sites = {}
+        for call, first, last in call_sites( codelist ) :
+            if first is None or codelist[first][0] not in ( LOAD_GLOBAL, LOAD_NAME ) :
+                continue
+            name = '.'.join( arg for op, arg in codelist[first:last+1] )
+            if name in self.constructors :
+                sites[call] = name
+        lineno = code.firstlineno
+        probes = []
+        for pos, (op, arg) in enumerate( codelist ) :
+            if op is SetLineno :
+                lineno = arg
+            elif op in _allocating_ops or pos in sites :
+                description = ( code.filename, code.name, lineno, opname[op], sites.get( pos ) )
+                if op in hascode :
+                    # to_code() needs the LOAD_CONST of the code and of the
+                    # name just before MAKE_FUNCTION, so count before them.
+                    pos -= 2
+                probes.append( (pos, self.slot( description )) )
+        for pos, slot in reversed( probes ) :
+            codelist[pos:pos] = _increment( self.counters, slot )
+        for inner in _nested( code ) :
+            self.instrument_code( inner )
+
+    def collect( self ):
+        '''
+        Return a list of (count, description) of every site, most first.
+        '''
+        return sorted( zip( self.counters, self.slots ), key=lambda pair: pair[0], reverse=True )
+
+    def report( self, limit=20 ):
+        '''
+        Return a table of the sites executed most often, at most limit.
+        '''
+        output = [ '%12s  %-28s %s' % ( 'count', 'instruction', 'where' ) ]
+        for count, (filename, name, lineno, op, constructor) in self.collect()[:limit] :
+            if not count :
+                break
+            what = op + ( ' ' + constructor if constructor else '' )
+            output.append( '%12d  %-28s %s (%s:%d)' % ( count, what, name, filename, lineno ) )
+        return '\n'.join( output ) + '\n'
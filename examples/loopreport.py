@@ -0,0 +1,190 @@
+'''
+    loopreport, a survey of the loops in a body of code
+
+hoist_invariants and make_constants pay off where loops load globals and
+attributes many times. To find those places in a large body of code, this
+module lists every loop in every function of every module, as found by
+FlowGraph.loops(), with
+
+    module      the dotted name of the module, see corpus.module_name
+    function    the qualified name of the code, see corpus.walk_code
+    line        the line number of the loop's header
+    kind        for, while or other (see Loop.kind)
+    depth       1 for an outermost loop, 2 for a loop nested in it, ...
+    size        the number of instructions in the loop, nested loops
+                included
+    globals     the names of the globals loaded in the loop
+    attrs       the names of the attributes loaded in the loop
+
+The files are processed in a pool of processes (see corpus.map_files).
+loop_report() returns a list of LoopRecords sorted on any field, and can
+write them as lines of tab-separated text, with the names separated by
+commas; those lines can in turn be sorted by other tools.
+
+Run as a program:
+
+    python loopreport.py [-o loops.tsv] [-s size] [-j processes] [-r root] path...
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['code_loops', 'file_loops', 'loop_report', 'LoopRecord' ]
+
+from byteplay3 import *
+from corpus import compile_file, map_files, module_name, walk_code
+import collections
+import functools
+import os
+import sys
+
+LoopRecord = collections.namedtuple( 'LoopRecord',
+    [ 'module', 'function', 'line', 'kind', 'depth', 'size', 'globals', 'attrs' ] )
+
+_fields = LoopRecord._fields
+
+def code_loops( code, module, function ):
+    '''
+    Return a list of LoopRecords for the loops of one Code object.
+    '''
+    codelist = code.code
+    graph = FlowGraph( codelist )
+    loops = graph.loops()
+    if not loops :
+        return []
+    # The line of each position: the last SetLineno at or before it.
+    lines = []
+    lineno = code.firstlineno
+    for op, arg in codelist :
+        if op is SetLineno :
+            lineno = arg
+        lines.append( lineno )
+    records = []
+    for loop in sorted( loops, key=lambda loop: loop.header.start ) :
+        size = 0
+        global_names = set()
+        attr_names = set()
+        for block in loop.blocks :
+            for op, arg in codelist[block.start:block.end] :
+                if not isopcode( op ) :
+                    continue
+                size += 1
+                if op == LOAD_GLOBAL :
+                    global_names.add( arg )
+                elif op == LOAD_ATTR :
+                    attr_names.add( arg )
+        first = loop.header.start
+        while first < loop.header.end - 1 and not isopcode( codelist[first][0] ) :
+            first += 1
+        records.append( LoopRecord( module, function, lines[first], loop.kind,
+                                    loop.depth, size, tuple( sorted( global_names ) ),
+                                    tuple( sorted( attr_names ) ) ) )
+    return records
+
+def file_loops( path, root=None ):
+    '''
+    Return (path, list of LoopRecords) for the source file at path, or
+    (path, None) when it cannot be compiled. The module name is relative to
+    root, as in corpus.module_name.
+    '''
+    code = compile_file( path )
+    if code is None :
+        return path, None
+    module = module_name( path, root )
+    records = []
+    for qualname, code in walk_code( code, '' ) :
+        records.extend( code_loops( code, module, qualname.lstrip( '.' ) or '<module>' ) )
+    return path, records
+
+def _write_records( out, records ):
+    for record in records :
+        out.write( '\t'.join( ','.join( value ) if isinstance( value, tuple ) else str( value )
+                              for value in record ) + '\n' )
+
+def loop_report( paths, sort='size', reverse=True, processes=None, out=None, verbose=False,
+                 root=None ):
+    '''
+    Return a list of the LoopRecords of all the source files in paths, a
+    list of files and directories, sorted on the field named sort, largest
+    first unless reverse is False. When out is given, a file or file name,
+    the sorted records are written to it as tab-separated lines after a
+    line of the field names. processes is passed to corpus.map_files.
+    Module names are relative to root, as in corpus.module_name.
+    '''
+    if sort not in _fields :
+        raise ValueError( 'No such field: ' + str( sort ) )
+    records = []
+    work = functools.partial( file_loops, root=root )
+    for path, found in map_files( work, paths, processes ) :
+        if found is None :
+            if verbose :
+                print( 'could not compile', path )
+            continue
+        records.extend( found )
+        if verbose :
+            print( path, len( found ), 'loops' )
+    index = _fields.index( sort )
+    records.sort( key=lambda record: ( len( record[index] ) if isinstance( record[index], tuple )
+                                       else record[index] ), reverse=reverse )
+    if out is not None :
+        stream = open( out, 'w' ) if isinstance( out, str ) else out
+        try:
+            stream.write( '\t'.join( _fields ) + '\n' )
+            _write_records( stream, records )
+        finally:
+            if isinstance( out, str ) :
+                stream.close()
+    return records
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# Following executes only when run as a program.
+
+if __name__ == '__main__' :
+    import argparse
+    parser = argparse.ArgumentParser( description='List the loops in source files.' )
+    parser.add_argument( '-o', '--out', default=None,
+                         help='file for the report (default: standard output)' )
+    parser.add_argument( '-s', '--sort', default='size', choices=_fields,
+                         help='field to sort on, largest first (default: size)' )
+    parser.add_argument( '-j', '--processes', type=int, default=None,
+                         help='number of processes (default: one per CPU)' )
+    parser.add_argument( '-r', '--root', default=None,
+                         help='directory to which module names are relative' )
+    parser.add_argument( 'paths', nargs='+', help='source files and directories' )
+    options = parser.parse_args()
+    root = options.root
+    if root is None and len( options.paths ) == 1 and os.path.isdir( options.paths[0] ) :
+        root = options.paths[0]
+    loop_report( options.paths, options.sort, processes=options.processes,
+                 out=options.out if options.out else sys.stdout, root=root )
@@ -7,7 +7,9 @@ in the following two ways.
 Where it contains a LOAD_GLOBAL bytecode, the current value of the named
 global is added to the functions' list of constants, and the bytecode is
 changed to LOAD_CONST. This saves a name lookup in the global environment at
-execution.
+execution. When the global is a module or class, a following chain of
+LOAD_ATTR bytecodes (as in math.sqrt or os.path.join) is resolved as well,
+and the whole chain becomes one LOAD_CONST of the final attribute value.
 
 Second, if the code now contains any of the sequences
 
@@ -34,11 +36,31 @@ Arguments to @make_constants are:
     stoplist = []
         a list (or set) of names not to be converted, perhaps because
         although they appear in the function's global names dict, their
-        values are not really static.
+        values are not really static. Dotted names such as "os.path" stop
+        the resolution of an attribute chain at that point; "os.path.join"
+        would then be compiled as LOAD_CONST os.path, LOAD_ATTR join.
 
     verbose = False
         when true, conversions are printed to stdout.
 
+    guarded = False
+        when True, the optimized function begins with a check that every
+        global it bound still has the same value (an identity test of each
+        name's current value, and of each attribute in a bound chain,
+        against the value that was bound). If any binding has gone stale,
+        for example because a test monkeypatched a global or a module was
+        reloaded, the optimized function passes its arguments on to the
+        original, unoptimized function and returns what that returns. A
+        name that has been deleted, or an attribute that has been removed,
+        counts as stale too, so the original raises the NameError or
+        AttributeError only if it gets to that reference. So a guarded
+        function is always correct, at the price of the check on each call.
+        The check costs one call of the get method of the globals dict and
+        an identity test for each bound name (two for a name bound from
+        builtins, which must also still be absent from the globals), and a
+        call of getattr for each attribute, so it pays off in functions that
+        use their globals more than once per call.
+
 '''
 
 #-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -74,38 +96,139 @@ __email__ = "davecortesi@gmail.com"
 # The __all__ global establishes the complete API of the module on import.
 #
 
-__all__ = ['_make_constants', 'bind_all', 'make_constants' ]
+__all__ = ['_make_constants', 'bind_all', 'bind_package', 'make_constants' ]
 
 from byteplay3 import *
 import types
 import builtins
+import time # for the summary of bind_all
 
 def _func_copy(f, newcode) :
     '''
-    Return a copy of function f with a different __code__
-    Because I can't find proper documentation on the
-    correct signature of the types.FunctionType() constructor,
-    I pass the minimum arguments then set the important
-    dunder-values by direct assignment.
-
-    Note you cannot assign __closure__, it is a "read-only attribute".
-    Ergo, you should not apply _make_constants() to a function that
-    has a closure!
+    Return a copy of function f with a different __code__. The
+    types.FunctionType() constructor takes (code, globals, name, defaults,
+    closure), and passing the closure of f along keeps the cells that
+    its free variables refer to. (You cannot assign __closure__ after
+    the fact; it is a "read-only attribute".) The other important
+    dunder-values are set by direct assignment.
     '''
-    newf = types.FunctionType( newcode, f.__globals__ )
+    newf = types.FunctionType( newcode, f.__globals__, f.__name__,
+                               f.__defaults__, f.__closure__ )
     newf.__annotations__ = f.__annotations__
-    # newf.__closure__ = f.__closure__
-    newf.__defaults__ = f.__defaults__
     newf.__doc__ = f.__doc__
-    newf.__name__ = f.__name__
     newf.__kwdefaults__ = f.__kwdefaults__
     newf.__qualname__ = f.__qualname__
+    newf.__module__ = f.__module__
+    newf.__dict__.update( f.__dict__ )
     return newf
 
 # This function implements a decorator; as such it takes a function
 # object as its first argument and returns a replacement for it.
 
-def _make_constants(f, builtin_only=False, stoplist=[], verbose=False):
+# The guard for guarded=True. For each name bound in pass one, generate
+#
+#    LOAD_CONST  the get method of the function's globals dict
+#    LOAD_CONST  name
+#    LOAD_CONST  missing (an object that is no global's value)
+#    CALL_FUNCTION 2
+#    LOAD_CONST  bound value
+#    COMPARE_OP  is not
+#    POP_JUMP_IF_TRUE  stale
+#
+# which looks the name up as LOAD_GLOBAL would, except that a deleted name
+# is stale rather than a NameError on every call. A name bound from
+# builtins is tested twice: its globals lookup, with the bound value as
+# the default, must still find nothing else, and the same lookup in the
+# dict of builtins must find the bound value. For each attribute of a
+# bound chain, generate the same test of
+#
+#    LOAD_CONST  getattr
+#    LOAD_CONST  parent (the bound value the attribute is taken from)
+#    LOAD_CONST  attr
+#    LOAD_CONST  missing
+#    CALL_FUNCTION 3
+#
+# so that a deleted attribute is stale too, and the AttributeError is left
+# to the original function, which raises it only if it gets that far. At
+# label stale the original function is called with the same arguments:
+#
+#    LOAD_CONST  original function
+#    LOAD_FAST   each positional argument
+#    LOAD_CONST  name, LOAD_FAST name, of each keyword-only argument
+#    LOAD_FAST   *args and/or **kwargs
+#    CALL_FUNCTION, or _VAR, _KW, _VAR_KW
+#    RETURN_VALUE
+#
+# An argument that is also a cell variable is loaded with LOAD_DEREF. In a
+# generator or coroutine the result of the call is delegated to with yield
+# from or await before returning.
+
+def _guard_code(co, f, bindings):
+    stale = Label()
+    missing = object()
+    guard = []
+    def test(lookup, args, value):
+        guard.append( (LOAD_CONST, lookup) )
+        guard.extend( (LOAD_CONST, arg) for arg in args )
+        guard.extend( [ (CALL_FUNCTION, len(args)),
+                        (LOAD_CONST, value),
+                        (COMPARE_OP, 'is not'),
+                        (POP_JUMP_IF_TRUE, stale) ] )
+    namespace = f.__globals__
+    global_get = namespace.get
+    builtin_get = vars( builtins ).get
+    checked = set()
+    for name, value, steps in bindings:
+        if name not in checked:
+            checked.add( name )
+            if name in namespace:
+                test( global_get, (name, missing), value )
+            else:
+                test( global_get, (name, value), value )
+                test( builtin_get, (name, missing), value )
+        dotted = name
+        for parent, attr, value in steps:
+            dotted += '.' + attr
+            if dotted not in checked:
+                checked.add( dotted )
+                test( getattr, (parent, attr, missing), value )
+
+    # Find which arguments live in cells rather than fast locals.
+    cellvars = set( arg for op, arg in co.code
+                    if op in hasfree and arg not in co.freevars )
+    def load(name):
+        return ( LOAD_DEREF if name in cellvars else LOAD_FAST, name )
+    npos = len(co.args) - co.varargs - co.varkwargs - co.kwonlyargcount
+    positional = co.args[ : npos ]
+    keywords = co.args[ npos : npos + co.kwonlyargcount ]
+    fallback = [ (stale, None), (LOAD_CONST, f) ]
+    fallback.extend( load(name) for name in positional )
+    for name in keywords:
+        fallback.extend( [ (LOAD_CONST, name), load(name) ] )
+    call = CALL_FUNCTION
+    if co.varargs:
+        fallback.append( load( co.args[ npos + co.kwonlyargcount ] ) )
+        call = CALL_FUNCTION_VAR
+    if co.varkwargs:
+        fallback.append( load( co.args[-1] ) )
+        call = CALL_FUNCTION_VAR_KW if co.varargs else CALL_FUNCTION_KW
+    fallback.append( (call, len(positional) | (len(keywords) << 8)) )
+    if co.coflags & 0x0080 : # CO_COROUTINE
+        fallback.extend( [ (GET_AWAITABLE, None), (LOAD_CONST, None),
+                           (YIELD_FROM, None) ] )
+    elif co.coflags & 0x0120 : # CO_GENERATOR | CO_ITERABLE_COROUTINE
+        fallback.extend( [ (opmap.get('GET_YIELD_FROM_ITER', GET_ITER), None),
+                           (LOAD_CONST, None), (YIELD_FROM, None) ] )
+    fallback.append( (RETURN_VALUE, None) )
+
+    # The guard goes ahead of everything but the first line number, and
+    # the fallback after everything.
+    start = 1 if co.code and co.code[0][0] is SetLineno else 0
+    co.code[start:start] = guard
+    co.code.extend( fallback )
+
+def _make_constants(f, builtin_only=False, stoplist=[], verbose=False, guarded=False,
+                    stats=None):
     try:
         co = f.__code__
     except AttributeError:
@@ -136,15 +259,58 @@ def _make_constants(f, builtin_only=False, stoplist=[], verbose=False):
     # Pass One: scan the list of instructions looking for (LOAD_GLOBAL,name)
     # where name is a candidate. Replace the instruction with a LOAD_CONST of
     # the name's current value.
-
-    for i, (op, arg) in enumerate(co.code):
-        if op == LOAD_GLOBAL:
-            name = arg
-            if name in candidates and name not in stop_set:
-                value = candidates[name]
-                co.code[i] = (LOAD_CONST, value)
-                if verbose:
-                    print( name, '-->', value )
+    #
+    # When the value is a module or a class, also look at the opcodes that
+    # follow it. A reference like os.path.join compiles to
+    #
+    #    LOAD_GLOBAL os
+    #    LOAD_ATTR path
+    #    LOAD_ATTR join
+    #
+    # and the whole chain can be resolved right now and replaced with a
+    # single LOAD_CONST of the function os.path.join. The chain is followed
+    # only while the value in hand is a module or class, and it stops at any
+    # dotted name (e.g. "os.path") that appears in the stop list. Because
+    # this pass may shorten the code list, it copies into newcode.
+    #
+    # Each binding is also recorded in bindings as a tuple (name, value,
+    # steps), where steps is a list of (parent, attr, value) for the chain
+    # of attributes, for use by the guard. When guarded, a chain stops at
+    # any attribute that does not return the same object each time it is
+    # fetched (such as a classmethod), since it could never pass the guard.
+
+    bindings = []
+    newcode = []
+    i = 0
+    n = len(co.code)
+    while i < n:
+        op, arg = co.code[i]
+        i += 1
+        if op == LOAD_GLOBAL and arg in candidates and arg not in stop_set:
+            dotted = arg
+            value = candidates[arg]
+            steps = []
+            while i < n \
+                  and isinstance( value, (types.ModuleType, type) ) \
+                  and co.code[i][0] == LOAD_ATTR :
+                attr = co.code[i][1]
+                longer = dotted + '.' + attr
+                if longer in stop_set or not hasattr( value, attr ) :
+                    break
+                attr_value = getattr( value, attr )
+                if guarded and attr_value is not getattr( value, attr ) :
+                    break
+                steps.append( (value, attr, attr_value) )
+                dotted = longer
+                value = attr_value
+                i += 1
+            bindings.append( (arg, candidates[arg], steps) )
+            newcode.append( (LOAD_CONST, value) )
+            if verbose:
+                print( dotted, '-->', value )
+        else:
+            newcode.append( (op, arg) )
+    co.code = newcode
 
     # Pass Two: again scan the list of instructions looking for the sequence
     # LOAD_CONST, LOAD_CONST,... BUILD_TUPLE. Create an actual tuple of the
@@ -215,8 +381,28 @@ def _make_constants(f, builtin_only=False, stoplist=[], verbose=False):
     # We have copied and possibly modified the code; put it back in the
     # code object.
 
+    folded = len( co.code ) - len( newcode )
     co.code = newcode
 
+    # When neither pass changed anything, there is no need to assemble a
+    # new code object: return the function as it was. If the caller is
+    # keeping statistics, count this function as skipped or bound.
+
+    if stats is not None:
+        stats['functions'] += 1
+        stats['bindings'] += len( bindings )
+        stats['skipped' if not ( bindings or folded ) else 'bound'] += 1
+    if not ( bindings or folded ):
+        return f
+
+    # If asked, put the guard at the front of the code and the call of the
+    # original function at the back.
+
+    if guarded and bindings:
+        if verbose:
+            print( 'guarding', len(bindings), 'bindings' )
+        _guard_code( co, f, bindings )
+
     # Return a new function object just like the input function object, but
     # with new bytecode.
     newfun = _func_copy( f, co.to_code() )
@@ -224,37 +410,127 @@ def _make_constants(f, builtin_only=False, stoplist=[], verbose=False):
 
 _make_constants = _make_constants(_make_constants) # optimize thyself!
 
-def bind_all(mc, builtin_only=False, stoplist=[],  verbose=False):
+def _bind_value(v, options, stats):
+    '''
+    Apply _make_constants to v when it is a function, or to the functions
+    wrapped in v when it is a staticmethod, classmethod or property. Return
+    v if nothing changed, else an equivalent replacement.
+    '''
+    if isinstance( v, types.FunctionType ) :
+        if options['verbose'] :
+            print( 'make_constants(', v.__name__, ')' )
+        return _make_constants( v, stats=stats, **options )
+    if isinstance( v, (staticmethod, classmethod) ) :
+        newf = _bind_value( v.__func__, options, stats )
+        return v if newf is v.__func__ else type(v)( newf )
+    if isinstance( v, property ) :
+        parts = [ _bind_value( f, options, stats ) if f is not None else None
+                  for f in ( v.fget, v.fset, v.fdel ) ]
+        if parts == [ v.fget, v.fset, v.fdel ] :
+            return v
+        return property( parts[0], parts[1], parts[2], v.__doc__ )
+    return v
+
+def _bind_namespace(mc, options, stats, seen, prefix=None):
+    '''
+    Bind the functions in the namespace of module or class mc, and recurse
+    into the classes and modules it contains. When prefix is given, only
+    functions and classes whose __module__ starts with it are bound, and
+    only modules whose __name__ does, so that imported code is left alone.
+    '''
+    if id( mc ) in seen :
+        return
+    seen.add( id( mc ) )
+    try:
+        d = vars(mc)
+    except TypeError:
+        return
+    def ours(v, name_attr='__module__'):
+        name = getattr( v, name_attr, None ) or ''
+        return prefix is None or name == prefix or name.startswith( prefix + '.' )
+    for k, v in list( d.items() ):
+        if isinstance( v, types.ModuleType ) :
+            if ours( v, '__name__' ) :
+                _bind_namespace( v, options, stats, seen, prefix )
+        elif isinstance( v, type ) :
+            if ours( v ) :
+                _bind_namespace( v, options, stats, seen, prefix )
+        elif ours( getattr( v, '__func__', None ) or getattr( v, 'fget', None ) or v ) :
+            newv = _bind_value( v, options, stats )
+            if newv is not v :
+                setattr( mc, k, newv )
+
+def _new_stats():
+    return { 'functions' : 0, 'bound' : 0, 'skipped' : 0, 'bindings' : 0,
+             'seconds' : 0.0 }
+
+def _print_stats(stats):
+    print( 'make_constants: {bindings} bindings in {bound} functions, '
+           '{skipped} of {functions} functions unchanged, '
+           '{seconds:.3f} seconds'.format( **stats ) )
+
+def bind_all(mc, builtin_only=False, stoplist=[],  verbose=False, guarded=False):
     """Recursively apply constant binding to functions in a module or class.
 
     Use as the last line of the module (after everything is defined, but
     before test code).  In modules that need modifiable globals, set
-    builtin_only to True.
+    builtin_only to True. Methods, staticmethods, classmethods and the
+    functions of properties are all bound, and closures are preserved.
 
+    Returns a dict of statistics: the counts of 'functions' examined,
+    'bound' (changed) and 'skipped' (unchanged), the total number of
+    'bindings' made, and the 'seconds' taken. With verbose=True these
+    are also printed.
     """
-    import types
-    try:
-        d = vars(mc)
-    except TypeError:
-        return
-    for k, v in d.items():
-        if isinstance( v, types.FunctionType ) :
-            if verbose :
-                print( 'make_constants(', v.__name__, ')' )
-            newv = _make_constants(v, builtin_only, stoplist,  verbose)
-            setattr(mc, k, newv)
-        elif type(v) in ( type, types.ModuleType ):
-            bind_all(v, builtin_only, stoplist, verbose)
+    options = { 'builtin_only' : builtin_only, 'stoplist' : stoplist,
+                'verbose' : verbose, 'guarded' : guarded }
+    stats = _new_stats()
+    start = time.perf_counter()
+    _bind_namespace( mc, options, stats, set() )
+    stats['seconds'] = time.perf_counter() - start
+    if verbose :
+        _print_stats( stats )
+    return stats
+
+def bind_package(package, builtin_only=False, stoplist=[],  verbose=False, guarded=False):
+    """Apply constant binding to every module of a package.
+
+    Every submodule of the package is imported, then bind_all is applied
+    to the package and each submodule, with one difference: only functions
+    and classes defined in the package are bound, and the walk does not
+    descend into modules outside the package.
+
+    Returns a dict of statistics like that of bind_all, with the count of
+    'modules' added. With verbose=True a summary is printed.
+    """
+    import importlib
+    import pkgutil
+    options = { 'builtin_only' : builtin_only, 'stoplist' : stoplist,
+                'verbose' : verbose, 'guarded' : guarded }
+    stats = _new_stats()
+    start = time.perf_counter()
+    modules = [ package ]
+    for finder, name, ispkg in pkgutil.walk_packages(
+            getattr( package, '__path__', [] ), package.__name__ + '.' ) :
+        modules.append( importlib.import_module( name ) )
+    seen = set()
+    for module in modules :
+        _bind_namespace( module, options, stats, seen, package.__name__ )
+    stats['modules'] = len( modules )
+    stats['seconds'] = time.perf_counter() - start
+    if verbose :
+        _print_stats( stats )
+    return stats
 
 @_make_constants
-def make_constants(builtin_only=False, stoplist=[], verbose=False):
+def make_constants(builtin_only=False, stoplist=[], verbose=False, guarded=False):
     """
     Return a decorator for optimizing global references.
     Verify that the first argument is a function.
     """
     if type(builtin_only) == type(make_constants):
         raise ValueError("The make_constants decorator must have arguments.")
-    return lambda f: _make_constants(f, builtin_only, stoplist, verbose)
+    return lambda f: _make_constants(f, builtin_only, stoplist, verbose, guarded)
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 # Here endeth the useful parts of module make_constants. Following executes
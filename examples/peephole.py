@@ -0,0 +1,571 @@
+'''
+    peephole, a pattern language and rewriter for code lists
+
+Rewrites of short sequences of opcodes, like the folding of LOAD_CONST...
+BUILD_TUPLE in make_constants, are usually coded by hand as little state
+machines, one pass over the code for each. This module lets them be
+written as rules, each a pattern and a replacement, and applies any number
+of rules in one pass over the code.
+
+A pattern is a list of elements, each matching instructions:
+
+    Op( ops, arg=ANY, name=None )
+        one instruction whose opcode is ops, or is in ops when that is a
+        set or list; opcodes may be given by name. arg is ANY, a value the
+        argument must equal, a function of the argument that returns True
+        when it matches, or Ref( name ), which requires the same argument
+        as the instruction captured under name.
+
+    Any( name=None )
+        any one instruction.
+
+    Repeat( pattern, min=0, max=None, name=None )
+        from min to max (no limit when None) repetitions of an element or
+        list of elements, as many as possible.
+
+An element with a name captures what it matched: the instruction (op, arg)
+for Op and Any, or the list of instructions for Repeat.
+
+    Rule( pattern, replace, where=None, name=None )
+
+makes a rule. replace is either a function that receives a dict of the
+captures and returns the list of instructions to put in place of the
+match, or a template: a list whose items are (op, arg) tuples, where the
+arg may be Arg( name ) for the argument of a captured instruction, or
+Cap( name ) for the captured instructions themselves. where, if given, is
+a function of the captures that must return True for the match to count.
+
+A Rewriter( rules ) compiles all its rules into one program for a
+"Pike" virtual machine, a way of running a nondeterministic automaton that
+follows every rule and every way of matching in step, so that the code is
+scanned once, in time proportional to its length, however many rules there
+are. (A rule with a Ref or a where test keeps a thread for each different
+set of captures, and so may take longer.) Where matches overlap, the one that starts first wins, then the rule
+given first, then the longest.
+
+A match never spans a Label, since code could jump into the middle of it.
+SetLineno items are passed over, and any within a match are put back just
+before its replacement. rewriter.rewrite( codelist ) applies the rules,
+then applies them again to the result, until nothing changes.
+
+peephole_code( code, rules ) rewrites a Code object in place. The rules in
+standard_rules are examples: folding constant tuples as
+make_constants does, removing a constant that is loaded and popped, and
+jumping on the opposite condition instead of applying UNARY_NOT.
+
+Arguments to the decorator @peephole are:
+
+    rules = None
+        a list of Rules, or None for standard_rules.
+
+    verbose = False
+        when true, each rewrite is printed to stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+
+__all__ = ['_peephole', 'ANY', 'Any', 'Arg', 'Cap', 'Match', 'Op', 'peephole',
+           'peephole_code', 'Ref', 'Repeat', 'Rewriter', 'Rule', 'standard_rules' ]
+
+from byteplay3 import *
+from make_constants import _func_copy
+
+class _AnyArg(object):
+    def __repr__( self ):
+        return 'ANY'
+
+# As the arg of an Op: match any argument.
+
+ANY = _AnyArg()
+
+def _opcodes( ops ):
+    '''
+    Return a frozenset of the Opcodes named by ops: an opcode, an opcode
+    name, or a collection of either.
+    '''
+    if isinstance( ops, str ) :
+        return frozenset( [ Opcode( opmap[ops] ) ] )
+    if isinstance( ops, int ) :
+        return frozenset( [ Opcode( ops ) ] )
+    return frozenset( op for x in ops for op in _opcodes( x ) )
+
+class Ref(object):
+    '''
+    As the arg of an Op: the argument of the instruction captured as name.
+    '''
+    def __init__( self, name ):
+        self.name = name
+
+class Arg(object):
+    '''
+    In a template: the argument of the instruction captured as name.
+    '''
+    def __init__( self, name ):
+        self.name = name
+
+class Cap(object):
+    '''
+    In a template: the instruction or instructions captured as name.
+    '''
+    def __init__( self, name ):
+        self.name = name
+
+class Op(object):
+    '''
+    Pattern element matching one instruction by opcode and argument.
+    '''
+    def __init__( self, ops, arg=ANY, name=None ):
+        self.ops = _opcodes( ops )
+        self.arg = arg
+        self.name = name
+
+class Any(object):
+    '''
+    Pattern element matching any one instruction.
+    '''
+    def __init__( self, name=None ):
+        self.name = name
+
+class Repeat(object):
+    '''
+    Pattern element matching from min to max repetitions of a pattern.
+    '''
+    def __init__( self, pattern, min=0, max=None, name=None ):
+        if max is not None and max < min :
+            raise ValueError( 'Repeat max is less than min' )
+        self.pattern = pattern if isinstance( pattern, list ) else [ pattern ]
+        self.min = min
+        self.max = max
+        self.name = name
+
+class Rule(object):
+    '''
+    A pattern, its replacement, and an optional test of the captures.
+    '''
+    def __init__( self, pattern, replace, where=None, name=None ):
+        self.pattern = pattern if isinstance( pattern, list ) else [ pattern ]
+        self.replace = replace
+        self.where = where
+        self.name = name if name is not None else 'rule'
+
+    def replacement( self, captures ):
+        '''
+        Return the list of (op, arg) that replaces a match with captures.
+        '''
+        if callable( self.replace ) :
+            return list( self.replace( captures ) )
+        result = []
+        for item in self.replace :
+            if isinstance( item, Cap ) :
+                value = captures[item.name]
+                if isinstance( value, list ) :
+                    result.extend( value )
+                else :
+                    result.append( value )
+            else :
+                op, arg = item
+                if isinstance( arg, Arg ) :
+                    arg = captures[arg.name][1]
+                result.append( (op, arg) )
+        return result
+
+class Match(object):
+    '''
+    A match of rule on the items codelist[start:end], with a dict of its
+    captures { name : (op, arg) or list of (op, arg) }.
+    '''
+    def __init__( self, rule, start, end, captures ):
+        self.rule = rule
+        self.start = start
+        self.end = end
+        self.captures = captures
+
+    def __repr__( self ):
+        return '<Match %s [%d:%d]>' % ( self.rule.name, self.start, self.end )
+
+def _first( codelist, start ):
+    '''
+    Return the first instruction at or after codelist[start], passing over
+    SetLineno items.
+    '''
+    while codelist[start][0] is SetLineno :
+        start += 1
+    return codelist[start]
+
+# The instructions of the compiled program are tuples whose first item is
+# one of these:
+#   (_TEST, opcodes or None, arg)   consume one instruction that matches
+#   (_SPLIT, pc1, pc2)              continue at both, pc1 preferred
+#   (_JMP, pc)                      continue at pc
+#   (_SAVE, slot)                   record the position in a capture slot
+#   (_MATCH, rule number)           the rule has matched
+
+_TEST, _SPLIT, _JMP, _SAVE, _MATCH = range( 5 )
+
+class Rewriter(object):
+    '''
+    A list of rules compiled into one automaton. Rules given earlier have
+    priority over those given later.
+    '''
+    def __init__( self, rules ):
+        self.rules = list( rules )
+        self.program = []
+        # For each rule a dict { capture name : (slot, single) }. Each
+        # capture has two slots, for its start and end positions; slots are
+        # numbered across all the rules.
+        self.slots = []
+        self.nslots = 0
+        # The pcs of the rules whose match depends on what was captured,
+        # through a Ref or a where test. Threads of those rules at the same
+        # pc are only redundant when their captures are the same too.
+        self.exact = set()
+        entries = []
+        for number, rule in enumerate( self.rules ) :
+            if self._min_length( rule.pattern ) == 0 :
+                raise ValueError( 'A pattern must match at least one instruction' )
+            self.slots.append( {} )
+            entries.append( len( self.program ) )
+            self._compile( rule.pattern, number )
+            self.program.append( (_MATCH, number) )
+            if rule.where is not None or self._uses_refs( rule.pattern ) :
+                self.exact.update( range( entries[-1], len( self.program ) ) )
+        # The entry point is a chain of splits, trying the rules in order.
+        self.start = len( self.program )
+        for n, entry in enumerate( entries ) :
+            if n < len( entries ) - 1 :
+                self.program.append( (_SPLIT, entry, len( self.program ) + 1) )
+            else :
+                self.program.append( (_JMP, entry) )
+        # The opcodes that can begin a match, or None when any can; there
+        # is no need to start matching at any other instruction.
+        seeds = []
+        self._add( seeds, set(), self.start, 0, (None,) * self.nslots, 0 )
+        self.first = frozenset()
+        for pc, start, caps in seeds :
+            ops = self.program[pc][1]
+            if ops is None :
+                self.first = None
+                break
+            self.first |= ops
+
+    def _min_length( self, pattern ):
+        total = 0
+        for element in pattern :
+            if isinstance( element, Repeat ) :
+                total += element.min * self._min_length( element.pattern )
+            else :
+                total += 1
+        return total
+
+    def _uses_refs( self, pattern ):
+        for element in pattern :
+            if isinstance( element, Repeat ) :
+                if self._uses_refs( element.pattern ) :
+                    return True
+            elif isinstance( element, Op ) and isinstance( element.arg, Ref ) :
+                return True
+        return False
+
+    def _key( self, pc, caps ):
+        '''
+        Return what identifies a thread at pc with the captures caps: two
+        threads at the same position with the same key match alike.
+        '''
+        return (pc, caps) if pc in self.exact else pc
+
+    def _compile( self, pattern, rule ):
+        '''
+        Append the program for a list of pattern elements of rule number rule.
+        '''
+        program = self.program
+        for element in pattern :
+            slot = None
+            if element.name is not None :
+                if element.name in self.slots[rule] :
+                    raise ValueError( 'Capture name used twice: ' + element.name )
+                slot = self.nslots
+                self.nslots += 2
+                self.slots[rule][element.name] = (slot, not isinstance( element, Repeat ))
+                program.append( (_SAVE, slot) )
+            if isinstance( element, Repeat ) :
+                for i in range( element.min ) :
+                    self._compile( element.pattern, rule )
+                if element.max is None :
+                    # split body, out; body; jmp back to the split
+                    split = len( program )
+                    program.append( None )
+                    self._compile( element.pattern, rule )
+                    program.append( (_JMP, split) )
+                    program[split] = (_SPLIT, split + 1, len( program ))
+                else :
+                    # each optional repetition can skip to the end
+                    splits = []
+                    for i in range( element.max - element.min ) :
+                        splits.append( len( program ) )
+                        program.append( None )
+                        self._compile( element.pattern, rule )
+                    for split in splits :
+                        program[split] = (_SPLIT, split + 1, len( program ))
+            elif isinstance( element, Op ) :
+                arg = element.arg
+                if isinstance( arg, Ref ) :
+                    if arg.name not in self.slots[rule] :
+                        raise ValueError( 'Ref to an unknown capture: ' + arg.name )
+                    arg = Ref( self.slots[rule][arg.name][0] )
+                program.append( (_TEST, element.ops, arg) )
+            elif isinstance( element, Any ) :
+                program.append( (_TEST, None, ANY) )
+            else :
+                raise ValueError( 'Not a pattern element: ' + repr( element ) )
+            if slot is not None :
+                program.append( (_SAVE, slot + 1) )
+
+    def _add( self, threads, seen, pc, start, caps, pos ):
+        '''
+        Add the threads that continue from pc at position pos to the list
+        threads, in order of priority, following jumps, splits and saves.
+        seen is the set of the keys of the threads already at pos; a thread
+        of lower priority with the same key is redundant.
+        '''
+        program = self.program
+        while self._key( pc, caps ) not in seen :
+            seen.add( self._key( pc, caps ) )
+            ins = program[pc]
+            kind = ins[0]
+            if kind == _JMP :
+                pc = ins[1]
+            elif kind == _SPLIT :
+                self._add( threads, seen, ins[1], start, caps, pos )
+                pc = ins[2]
+            elif kind == _SAVE :
+                slot = ins[1]
+                caps = caps[:slot] + (pos,) + caps[slot+1:]
+                pc += 1
+            else :
+                threads.append( (pc, start, caps) )
+                return
+
+    def _test( self, ins, codelist, pos, caps ):
+        kind, ops, arg = ins
+        op, value = codelist[pos]
+        if ops is not None and op not in ops :
+            return False
+        if arg is ANY :
+            return True
+        if isinstance( arg, Ref ) :
+            return value == _first( codelist, caps[arg.name] )[1]
+        if callable( arg ) :
+            return bool( arg( value ) )
+        return value == arg
+
+    def _match( self, rule, start, end, codelist, caps ):
+        '''
+        Return the Match of rule number rule on codelist[start:end], or None
+        when its where test rejects the captures.
+        '''
+        captures = {}
+        for name, (slot, single) in self.slots[rule].items() :
+            first, last = caps[slot], caps[slot + 1]
+            if first is None or last is None :
+                continue
+            if single :
+                captures[name] = _first( codelist, first )
+            else :
+                captures[name] = [ item for item in codelist[first:last]
+                                   if item[0] is not SetLineno ]
+        rule = self.rules[rule]
+        if rule.where is not None and not rule.where( captures ) :
+            return None
+        return Match( rule, start, end, captures )
+
+    def search( self, codelist, begin=0 ):
+        '''
+        Return the first Match of the rules in codelist at or after position
+        begin, or None. Threads for every rule and every way of matching
+        advance together through the code list, and new ones are started at
+        each instruction until a match is found, so one scan finds the
+        match whatever the number of rules.
+        '''
+        n = len( codelist )
+        nothing = (None,) * self.nslots
+        first = self.first
+        threads = []
+        best = None
+        for pos in range( begin, n + 1 ) :
+            op = codelist[pos][0] if pos < n else None
+            if best is None and pos < n and isopcode( op ) \
+               and ( first is None or op in first ) :
+                # Start matching here, at lower priority than the threads
+                # that started earlier.
+                self._add( threads, set( self._key( pc, caps )
+                                         for pc, start, caps in threads ),
+                           self.start, pos, nothing, pos )
+            following = []
+            seen = set()
+            for pc, start, caps in threads :
+                ins = self.program[pc]
+                if ins[0] == _MATCH :
+                    match = self._match( ins[1], start, pos, codelist, caps )
+                    if match is not None :
+                        # Threads of lower priority are dropped, those of
+                        # higher priority may yet find a better match.
+                        best = match
+                        break
+                elif op is SetLineno :
+                    self._add( following, seen, pc, start, caps, pos + 1 )
+                elif op is not None and isopcode( op ) \
+                     and self._test( ins, codelist, pos, caps ) :
+                    self._add( following, seen, pc + 1, start, caps, pos + 1 )
+                # Any thread at a Label dies: a match cannot span a label.
+            threads = following
+            if best is not None and not threads :
+                break
+        return best
+
+    def matches( self, codelist ):
+        '''
+        Return a list of the non-overlapping Matches of the rules in
+        codelist, in order of position.
+        '''
+        found = []
+        match = self.search( codelist )
+        while match is not None :
+            found.append( match )
+            match = self.search( codelist, match.end )
+        return found
+
+    def rewrite( self, codelist, max_passes=10, verbose=False ):
+        '''
+        Replace the matches of the rules in codelist, in place. Since a
+        replacement can make a new match, repeat until there are no more
+        matches, or for at most max_passes. Return a list of tuples (rule
+        name, line number) of the rewrites.
+        '''
+        report = []
+        for npass in range( max_passes ) :
+            found = self.matches( codelist )
+            if not found :
+                break
+            # Note the line number of each match, then replace them from
+            # the end so the positions of the earlier ones stay valid.
+            lineno = None
+            where = []
+            pos = 0
+            for match in found :
+                for op, arg in codelist[pos:match.start] :
+                    if op is SetLineno :
+                        lineno = arg
+                pos = match.start
+                where.append( lineno )
+            for match, lineno in reversed( list( zip( found, where ) ) ) :
+                lines = [ item for item in codelist[match.start:match.end]
+                          if item[0] is SetLineno ]
+                codelist[match.start:match.end] = lines + match.rule.replacement( match.captures )
+                report.append( (match.rule.name, lineno) )
+                if verbose :
+                    print( 'rewrote', match.rule.name, 'at line', lineno )
+        return report
+
+# Example rules.
+
+def _plain( value ):
+    # A constant that can go in a folded tuple: not the code of a function.
+    return not isinstance( value, Code )
+
+def _fold_tuple( captures ):
+    consts = captures['consts']
+    n = captures['build'][1]
+    folded = tuple( arg for op, arg in consts[len( consts ) - n:] )
+    return consts[:len( consts ) - n] + [ (LOAD_CONST, folded) ]
+
+standard_rules = [
+    # LOAD_CONST a; LOAD_CONST b; BUILD_TUPLE 2 -> LOAD_CONST (a, b)
+    Rule( [ Repeat( Op( LOAD_CONST, _plain ), 1, name='consts' ),
+            Op( BUILD_TUPLE, name='build' ) ],
+          _fold_tuple,
+          where=lambda c: 0 < c['build'][1] <= len( c['consts'] ),
+          name='fold tuple' ),
+    # A constant loaded only to be discarded.
+    Rule( [ Op( LOAD_CONST ), Op( POP_TOP ) ], [], name='unused constant' ),
+    # UNARY_NOT; POP_JUMP_IF_FALSE L -> POP_JUMP_IF_TRUE L, and the reverse
+    Rule( [ Op( UNARY_NOT ), Op( POP_JUMP_IF_FALSE, name='jump' ) ],
+          [ (POP_JUMP_IF_TRUE, Arg( 'jump' )) ], name='not jump' ),
+    Rule( [ Op( UNARY_NOT ), Op( POP_JUMP_IF_TRUE, name='jump' ) ],
+          [ (POP_JUMP_IF_FALSE, Arg( 'jump' )) ], name='not jump' ),
+    ]
+
+_standard_rewriter = None
+
+def peephole_code( code, rules=None, verbose=False ):
+    '''
+    Apply rules, or standard_rules when None, to a Code object, modifying
+    its code list in place. rules may also be a Rewriter, to save compiling
+    the same rules again. Return the report of Rewriter.rewrite().
+    '''
+    global _standard_rewriter
+    if isinstance( rules, Rewriter ) :
+        rewriter = rules
+    elif rules is None :
+        if _standard_rewriter is None :
+            _standard_rewriter = Rewriter( standard_rules )
+        rewriter = _standard_rewriter
+    else :
+        rewriter = Rewriter( rules )
+    return rewriter.rewrite( code.code, verbose=verbose )
+
+def _peephole( f, rules=None, verbose=False ):
+    '''
+    Return a copy of function f rewritten by rules, or f itself when no
+    rule matched.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    co = Code.from_code( co )
+    if not peephole_code( co, rules, verbose ) :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def peephole( rules=None, verbose=False ):
+    """
+    Return a decorator for rewriting with rules.
+    Verify that the first argument is not a function.
+    """
+    if type( rules ) == type( peephole ):
+        raise ValueError("The peephole decorator must have arguments.")
+    rewriter = Rewriter( rules ) if rules is not None else None
+    return lambda f: _peephole( f, rewriter, verbose )
@@ -0,0 +1,372 @@
+'''
+    propagate_constants, constant propagation through local variables
+
+make_constants turns global names into constants, but a local computed
+from them, as in
+
+    n = LIMIT * 2
+    for x in data:
+        if x < n: ...
+
+is still loaded with LOAD_FAST each time it is used. The decorator
+@propagate_constants finds each local that holds one known constant on
+every path that reaches a load of it, and replaces the load with
+LOAD_CONST. The stores are left in place; dead_stores can remove them
+afterward, and the constants are then visible to any folding or branch
+simplification that follows.
+
+The analysis is a forward data-flow over the blocks of a FlowGraph. At
+each point each local has one of the values
+
+    UNBOUND     the local has not been assigned (or was deleted)
+    a constant  the local holds this value on every path to this point
+    NAC         "not a constant": different values, or an unknown one
+
+and where paths join, a local keeps its constant only if every path has
+the same constant. Two constants are the same only when they are of the
+same type and equal in every way that matters, so 1 and 1.0 and True, or
+0.0 and -0.0, are different. A local that may be UNBOUND on some path is
+NAC, so that the UnboundLocalError still happens. Only values of
+immutable types (numbers, strings, bytes, None, and tuples and frozensets
+of these) are propagated. Parameters are NAC on entry.
+
+The value stored into a local is known when, within the block, it comes
+from a LOAD_CONST, from a LOAD_FAST of a local known to be constant, or
+(when fold is true) from a unary or binary arithmetic operation on known
+values. The result of a fold is kept only when it is small, in the way of
+the CPython peephole optimizer. Each pass over the code takes time in
+proportion to its length, and the number of passes is small because a
+local can change only from UNBOUND to a constant to NAC.
+
+A function that may read or change its locals by name (see dead_stores)
+is left unchanged.
+
+Arguments to @propagate_constants are:
+
+    fold = True
+        when false, arithmetic on known values is not evaluated, and only
+        locals assigned a literal (or a copy of one) are propagated.
+
+    verbose = False
+        when true, each replaced load is printed to stdout.
+
+'''
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# Establish version and other import dunder-constants.
+
+__license__ = '''
+                 License (GPL-3.0) :
+    This file is part of the byteplay module.
+    byteplay is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This module is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You can find a copy of the GNU General Public License in the file
+    COPYING.TXT included in the distribution of this module, or see:
+    <http://www.gnu.org/licenses/>.
+'''
+__version__ = "3.5.0"
+__author__  = "David Cortesi"
+__copyright__ = "Copyright (C) 2016 David Cortesi"
+__maintainer__ = "David Cortesi"
+__email__ = "davecortesi@gmail.com"
+
+
+#-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+#
+# The __all__ global establishes the complete API of the module on import.
+#
+
+__all__ = ['_propagate_constants', 'propagate_code', 'propagate_constants' ]
+
+from byteplay3 import *
+from make_constants import _func_copy
+from dead_stores import _introspects
+import operator
+
+# The lattice values other than constants. A constant is a _Const.
+
+class _Marker(object):
+    def __init__( self, name ):
+        self.name = name
+    def __repr__( self ):
+        return self.name
+
+UNBOUND = _Marker( 'UNBOUND' )
+NAC = _Marker( 'NAC' )
+
+_atomic_types = ( type(None), bool, int, float, complex, str, bytes, type(Ellipsis) )
+
+def _immutable( value ):
+    '''
+    Return True when value is of a type that cannot be changed in place.
+    '''
+    if type( value ) in _atomic_types :
+        return True
+    if type( value ) in ( tuple, frozenset ) :
+        return all( _immutable( item ) for item in value )
+    return False
+
+def _same( a, b ):
+    '''
+    Return True when constants a and b cannot be told apart: the same type
+    and equal, where for floats -0.0 is not 0.0 and a NaN is itself.
+    '''
+    if a is b :
+        return True
+    if type( a ) is not type( b ) :
+        return False
+    if type( a ) in ( float, complex ) :
+        return repr( a ) == repr( b )
+    if type( a ) is tuple :
+        return len( a ) == len( b ) and all( _same( x, y ) for x, y in zip( a, b ) )
+    if type( a ) is frozenset :
+        # frozenset({0}) == frozenset({False}); only identity is safe
+        return False
+    return a == b
+
+class _Const(object):
+    def __init__( self, value ):
+        self.value = value
+    def __eq__( self, other ):
+        return isinstance( other, _Const ) and _same( self.value, other.value )
+    def __ne__( self, other ):
+        return not self == other
+    def __repr__( self ):
+        return 'Const(%r)' % ( self.value, )
+
+def _meet( a, b ):
+    if a is None :
+        return b
+    if a == b :
+        return a
+    return NAC
+
+# The operations that are folded when fold is true.
+
+_binary = {
+    BINARY_ADD : operator.add, BINARY_SUBTRACT : operator.sub,
+    BINARY_MULTIPLY : operator.mul, BINARY_TRUE_DIVIDE : operator.truediv,
+    BINARY_FLOOR_DIVIDE : operator.floordiv, BINARY_MODULO : operator.mod,
+    BINARY_POWER : operator.pow, BINARY_LSHIFT : operator.lshift,
+    BINARY_RSHIFT : operator.rshift, BINARY_AND : operator.and_,
+    BINARY_OR : operator.or_, BINARY_XOR : operator.xor,
+    }
+_unary = {
+    UNARY_NEGATIVE : operator.neg, UNARY_POSITIVE : operator.pos,
+    UNARY_INVERT : operator.invert, UNARY_NOT : operator.not_,
+    }
+
+def _small( value ):
+    '''
+    Return True when a folded value is small enough to be a constant.
+    '''
+    if isinstance( value, ( str, bytes, tuple ) ) :
+        return len( value ) <= 20
+    if isinstance( value, int ) :
+        return value.bit_length() <= 128
+    return True
+
+def _fold( op, operands ):
+    func = _binary.get( op ) or _unary.get( op )
+    if len( operands ) == 2 :
+        a, b = operands
+        if op == BINARY_MODULO and isinstance( a, ( str, bytes ) ) :
+            return NAC # string formatting
+        # Refuse before computing anything that could be huge.
+        if op in ( BINARY_POWER, BINARY_LSHIFT ) and isinstance( b, int ) \
+           and abs( b ) > 128 :
+            return NAC
+        if op == BINARY_MULTIPLY and any( isinstance( x, ( str, bytes, tuple ) )
+                                          for x in operands ) \
+           and any( type( x ) is int and x > 20 for x in operands ) :
+            return NAC
+    try:
+        value = func( *operands )
+    except Exception:
+        return NAC
+    if _immutable( value ) and _small( value ) :
+        return _Const( value )
+    return NAC
+
+# Opcodes whose pops and pushes are known to be (n, 1) or (1, 0); all the
+# values they push are NAC, except as folded above. Any other opcode makes
+# the whole simulated stack NAC, which is always safe.
+
+_pop_push = {}
+for _op in list( _binary ) + [ op for name, op in opmap.items()
+                               if name.startswith( ('INPLACE_', 'BINARY_') ) ] \
+           + [ COMPARE_OP ] :
+    _pop_push[_op] = (2, 1)
+_pop_push[STORE_ATTR] = (2, 0)
+for _op in list( _unary ) + [ LOAD_ATTR, GET_ITER ] :
+    _pop_push[_op] = (1, 1)
+for _op in ( POP_TOP, STORE_GLOBAL, STORE_NAME, STORE_DEREF,
+             POP_JUMP_IF_TRUE, POP_JUMP_IF_FALSE, RETURN_VALUE ) :
+    _pop_push[_op] = (1, 0)
+for _op in ( LOAD_GLOBAL, LOAD_NAME, LOAD_DEREF, LOAD_CLOSURE ) :
+    _pop_push[_op] = (0, 1)
+_pop_push[STORE_SUBSCR] = (3, 0)
+
+_call_ops = set( op for name, op in opmap.items() if name.startswith( 'CALL_FUNCTION' ) )
+_build_ops = set( op for name, op in opmap.items()
+                  if name.startswith( 'BUILD_' ) and name != 'BUILD_MAP' )
+
+def _transfer( codelist, block, state, fold, replace=None ):
+    '''
+    Simulate the items of block, starting with state, a dict { local name :
+    lattice value }. Return (state at the end, meet of the states at every
+    point in the block). When replace is a list, append to it (position,
+    name, value) for each LOAD_FAST of a known constant.
+    '''
+    state = dict( state )
+    through = dict( state )
+    stack = []
+    for pos in range( block.start, block.end ) :
+        op, arg = codelist[pos]
+        if not isopcode( op ) :
+            continue
+        if op == LOAD_CONST :
+            stack.append( _Const( arg ) if _immutable( arg ) else NAC )
+        elif op == LOAD_FAST :
+            value = state.get( arg, NAC )
+            if isinstance( value, _Const ) :
+                if replace is not None :
+                    replace.append( (pos, arg, value.value) )
+                stack.append( value )
+            else :
+                stack.append( NAC )
+        elif op == STORE_FAST or op == DELETE_FAST :
+            if op == STORE_FAST :
+                value = stack.pop() if stack else NAC
+            else :
+                value = UNBOUND
+            state[arg] = value
+            through[arg] = _meet( through.get( arg ), value )
+        elif op == DUP_TOP :
+            stack.append( stack[-1] if stack else NAC )
+        elif op == DUP_TOP_TWO :
+            stack.extend( ( [NAC, NAC] + stack[-2:] )[-2:] )
+        elif op == ROT_TWO :
+            stack[-2:] = ( [NAC, NAC] + stack[-2:] )[-2:][::-1]
+        elif op == ROT_THREE :
+            top = ( [NAC] * 3 + stack[-3:] )[-3:]
+            stack[-3:] = [ top[2], top[0], top[1] ]
+        elif fold and ( op in _binary or op in _unary ) :
+            n = 2 if op in _binary else 1
+            operands = ( [NAC] * n + stack[-n:] )[-n:]
+            del stack[ max( 0, len( stack ) - n ) : ]
+            if all( isinstance( v, _Const ) for v in operands ) :
+                stack.append( _fold( op, [ v.value for v in operands ] ) )
+            else :
+                stack.append( NAC )
+        else :
+            if op in _pop_push :
+                pops, pushes = _pop_push[op]
+            elif op in _call_ops :
+                pops, pushes = 1 - stack_effect( op, arg ), 1
+            elif op in _build_ops :
+                pops, pushes = arg, 1
+            else :
+                # Unknown: keep only the depth, and know nothing of it.
+                depth = len( stack ) + stack_effect( op, arg )
+                stack = [NAC] * max( 0, depth )
+                continue
+            del stack[ max( 0, len( stack ) - pops ) : ]
+            stack.extend( [NAC] * pushes )
+    return state, through
+
+def propagate_code( code, fold=True, verbose=False ):
+    '''
+    Replace each LOAD_FAST of a local known to hold one constant with a
+    LOAD_CONST of it, modifying the code list of a Code object in place.
+    Return a list of tuples (local name, value, line number), one for each
+    load replaced.
+    '''
+    report = []
+    if not code.newlocals or _introspects( code ) :
+        return report
+    codelist = code.code
+    names = set( arg for op, arg in codelist if op in haslocal )
+    if not any( op == LOAD_FAST and arg not in code.args for op, arg in codelist ) :
+        return report
+    graph = FlowGraph( codelist )
+    if graph.entry is None :
+        return report
+    entry = { name : UNBOUND for name in names }
+    for name in code.args :
+        entry[name] = NAC
+
+    # state_in[i] is None until block i is reached.
+    order = graph.reachable()
+    state_in = [None] * len( graph.blocks )
+    state_in[ graph.entry.index ] = entry
+    changed = True
+    while changed :
+        changed = False
+        for block in order :
+            state = state_in[ block.index ]
+            if state is None :
+                continue
+            out, through = _transfer( codelist, block, state, fold )
+            for succ, source in [ (s, out) for s in block.succs ] \
+                                + [ (h, through) for h in block.handlers ] :
+                old = state_in[ succ.index ]
+                if old is None :
+                    new = dict( source )
+                else :
+                    new = { name : _meet( old.get( name, UNBOUND ), source.get( name, UNBOUND ) )
+                            for name in names }
+                if new != old :
+                    state_in[ succ.index ] = new
+                    changed = True
+
+    replace = []
+    for block in order :
+        if state_in[ block.index ] is not None :
+            _transfer( codelist, block, state_in[ block.index ], fold, replace )
+    if not replace :
+        return report
+    lines = {}
+    lineno = None
+    for pos, (op, arg) in enumerate( codelist ) :
+        if op is SetLineno :
+            lineno = arg
+        lines[pos] = lineno
+    for pos, name, value in replace :
+        codelist[pos] = (LOAD_CONST, value)
+        report.append( (name, value, lines[pos]) )
+        if verbose :
+            print( 'local', name, '-->', repr( value ), 'at line', lines[pos] )
+    return report
+
+def _propagate_constants( f, fold=True, verbose=False ):
+    '''
+    Return a copy of function f with its constant locals propagated, or f
+    itself when no load was replaced.
+    '''
+    try:
+        co = f.__code__
+    except AttributeError:
+        return f
+    co = Code.from_code( co )
+    if not propagate_code( co, fold, verbose ) :
+        return f
+    return _func_copy( f, co.to_code() )
+
+def propagate_constants( fold=True, verbose=False ):
+    """
+    Return a decorator for propagating constants through local variables.
+    Verify that the first argument is not the function to decorate.
+    """
+    if type( fold ) == type( propagate_constants ):
+        raise ValueError("The propagate_constants decorator must have arguments.")
+    return lambda f: _propagate_constants( f, fold, verbose )
@@ -4,3 +4,857 @@ def test_python26_build_map():
 	if '.'.join(str(x) for x in sys.version_info[:2]) == '2.6':
 		from byteplay import Code
 		Code.from_code((lambda: {'a': 1}).func_code).to_code()
+
+# byteplay3 and the examples handle the bytecode of Python 3.4 and 3.5, so
+# the tests below are skipped on other versions.
+
+import os
+import sys
+import unittest
+
+needs_35_bytecode = unittest.skipUnless(sys.version_info[:2] in ((3, 4), (3, 5)),
+	'byteplay3 reads and writes the bytecode of Python 3.4 and 3.5')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples'))
+
+def _join_sep(x):
+	return os.path.join(x, os.sep)
+
+@needs_35_bytecode
+def test_make_constants_binds_attribute_chains():
+	from make_constants import make_constants
+	g = make_constants()(_join_sep)
+	assert g is not _join_sep and g('d') == _join_sep('d')
+	# os.path.join and os.sep are each one LOAD_CONST
+	assert g.__code__.co_names == ()
+	assert any(value is os.path.join for value in g.__code__.co_consts)
+
+@needs_35_bytecode
+def test_make_constants_dotted_stoplist():
+	from make_constants import make_constants
+	g = make_constants(stoplist=['os.path'])(_join_sep)
+	assert g('d') == _join_sep('d')
+	# os.path is bound, its join is still looked up, os.sep is bound
+	assert g.__code__.co_names == ('join',)
+	assert any(value is os.path for value in g.__code__.co_consts)
+	assert make_constants(stoplist=['os'])(_join_sep) is _join_sep
+
+@needs_35_bytecode
+def test_hoist_invariants_round_trip():
+	from hoist_invariants import hoist_invariants
+	def f(data):
+		out = []
+		for x in data:
+			out.append(len(x))
+		return out
+	g = hoist_invariants()(f)
+	assert g is not f and g(['a', 'bb']) == f(['a', 'bb']) == [1, 2]
+	def h(data, cb):
+		for x in data:
+			if cb is not None:
+				cb.append(x)
+		return cb
+	# cb.append is looked up only when cb is not None, so it stays put
+	assert hoist_invariants()(h)([1], None) is None
+
+def _double(x):
+	return x * 2
+
+def _maybe(x):
+	if x:
+		y = x
+	return y
+
+@needs_35_bytecode
+def test_inline_calls_round_trip():
+	from byteplay3 import Code, DELETE_FAST
+	from inline_calls import inline_calls
+	def f(n):
+		return _double(n) + 1
+	g = inline_calls([_double])(f)
+	assert g is not f and g(4) == f(4) == 9
+	assert '_double' not in g.__code__.co_names
+	# the renamed parameter does not outlive the inlined code
+	assert (DELETE_FAST, '._double1.x') in Code.from_code(g.__code__).code
+
+@needs_35_bytecode
+def test_inline_calls_refuses_read_before_assignment():
+	from inline_calls import inline_calls
+	def h(a, b):
+		return _maybe(a) + _maybe(b)
+	# y can be read unassigned, which an inlined copy would not notice
+	assert inline_calls([_maybe])(h) is h
+
+_guarded_source = '''
+import types
+SCALE = 2
+box = types.ModuleType('box')
+box.size = 3
+
+def scaled(x, flag):
+    if flag:
+        return x * SCALE
+    return x
+
+def sized(flag):
+    if flag:
+        return box.size
+    return 0
+
+def counted(n):
+    for i in range(n):
+        yield i * SCALE
+'''
+
+_guarded_coroutine = '''
+async def awaited(x):
+    return x * SCALE
+'''
+
+def _run_coroutine(coroutine):
+	try:
+		coroutine.send(None)
+	except StopIteration as stop:
+		return stop.value
+	assert False, 'the coroutine did not finish'
+
+@needs_35_bytecode
+def test_make_constants_guard():
+	from make_constants import make_constants
+	namespace = {}
+	exec(_guarded_source, namespace)
+	scaled = make_constants(guarded=True)(namespace['scaled'])
+	assert 'SCALE' not in scaled.__code__.co_names
+	assert scaled(3, True) == 6
+	namespace['SCALE'] = 5
+	assert scaled(3, True) == 15
+	del namespace['SCALE']
+	# the deleted global is an error only where the original reads it
+	assert scaled(3, False) == 3
+	try:
+		scaled(3, True)
+	except NameError:
+		pass
+	else:
+		assert False, 'the deleted global was still bound'
+
+@needs_35_bytecode
+def test_make_constants_guard_of_attribute_chain():
+	from make_constants import make_constants
+	namespace = {}
+	exec(_guarded_source, namespace)
+	sized = make_constants(guarded=True)(namespace['sized'])
+	assert sized.__code__.co_names == ()
+	assert sized(True) == 3
+	namespace['box'].size = 7
+	assert sized(True) == 7
+	del namespace['box'].size
+	assert sized(False) == 0
+	try:
+		sized(True)
+	except AttributeError:
+		pass
+	else:
+		assert False, 'the deleted attribute was still bound'
+
+@needs_35_bytecode
+def test_make_constants_guard_of_generator_and_coroutine():
+	from make_constants import make_constants
+	namespace = {}
+	exec(_guarded_source, namespace)
+	counted = make_constants(guarded=True)(namespace['counted'])
+	assert list(counted(3)) == [0, 2, 4]
+	namespace['SCALE'] = 5
+	assert list(counted(3)) == [0, 5, 10]
+	if sys.version_info[:2] < (3, 5):
+		return
+	exec(_guarded_coroutine, namespace)
+	namespace['SCALE'] = 2
+	awaited = make_constants(guarded=True)(namespace['awaited'])
+	assert _run_coroutine(awaited(3)) == 6
+	namespace['SCALE'] = 5
+	assert _run_coroutine(awaited(3)) == 15
+
+@needs_35_bytecode
+def test_func_copy_keeps_closures():
+	from make_constants import _func_copy, _make_constants
+	def outer(n):
+		def inner(x, y=1, *, z=2):
+			return len(x) + n + y + z
+		return inner
+	f = outer(10)
+	f.tag = 'kept'
+	g = _func_copy(f, f.__code__)
+	assert g.__closure__[0] is f.__closure__[0]
+	assert (g.__qualname__, g.__defaults__, g.__kwdefaults__, g.tag) \
+		== (f.__qualname__, (1,), {'z': 2}, 'kept')
+	h = _make_constants(f)
+	assert h is not f and 'len' not in h.__code__.co_names
+	assert h('ab') == f('ab') == 15
+
+_package_files = {
+	'mc_sample/__init__.py': 'from . import sub\nimport mc_outside\n'
+		'def top(x):\n    return len(x)\n',
+	'mc_sample/sub.py': 'def helper(x):\n    return abs(x)\n'
+		'def plain(x):\n    return x\n'
+		'class K:\n    def m(self):\n        return len(self.__dict__)\n',
+	'mc_outside.py': 'def other(x):\n    return len(x)\n',
+}
+
+@needs_35_bytecode
+def test_bind_package():
+	import tempfile
+	import importlib
+	from make_constants import bind_package
+	with tempfile.TemporaryDirectory() as directory:
+		for name, text in _package_files.items():
+			path = os.path.join(directory, name)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			with open(path, 'w') as out:
+				out.write(text)
+		sys.path.insert(0, directory)
+		importlib.invalidate_caches()
+		try:
+			package = importlib.import_module('mc_sample')
+			outside = sys.modules['mc_outside'].other
+			stats = bind_package(package)
+			assert stats['modules'] == 2
+			assert (stats['functions'], stats['bound'], stats['skipped'], stats['bindings']) \
+				== (4, 3, 1, 3)
+			assert 'len' not in package.top.__code__.co_names
+			assert 'len' not in package.sub.K.m.__code__.co_names
+			# the module outside the package is left alone
+			assert sys.modules['mc_outside'].other is outside
+			assert package.top('ab') == 2 and package.sub.helper(-3) == 3
+		finally:
+			sys.path.remove(directory)
+			for name in ('mc_sample', 'mc_sample.sub', 'mc_outside'):
+				sys.modules.pop(name, None)
+
+def make_code(items, args=(), name='f'):
+	from byteplay3 import Code, CodeList
+	return Code(CodeList(items), [], list(args), False, False, 0, True, 0,
+	            name, 'test.py', 1, None)
+
+@needs_35_bytecode
+def test_liveness():
+	from byteplay3 import Liveness, LOAD_CONST, STORE_FAST, LOAD_FAST, RETURN_VALUE
+	code = make_code([(LOAD_CONST, 1), (STORE_FAST, 'x'), (LOAD_CONST, 2),
+	                  (STORE_FAST, 'x'), (LOAD_FAST, 'x'), (RETURN_VALUE, None)])
+	live = Liveness(code)
+	assert 'x' not in live.live_after(1)
+	assert 'x' in live.live_after(3)
+	assert 'x' not in live.live_after(4)
+
+@needs_35_bytecode
+def test_dead_stores_round_trip():
+	from dead_stores import dead_stores
+	def f(a):
+		x = a + 1
+		x = a * 2
+		return x
+	g = dead_stores()(f)
+	assert g is not f and g(3) == f(3) == 6
+
+@needs_35_bytecode
+def test_compact_locals_round_trip():
+	from compact_locals import compact_locals
+	def f(n):
+		a = n + 1
+		b = a * 2
+		c = b - 3
+		return c
+	g = compact_locals()(f)
+	assert g is not f and g(5) == f(5) == 9
+	assert g.__code__.co_nlocals < f.__code__.co_nlocals
+
+@needs_35_bytecode
+def test_def_use_follows_changes():
+	from byteplay3 import DefUse, NOP, LOAD_FAST, STORE_FAST, RETURN_VALUE
+	code = make_code([(LOAD_FAST, 'a'), (STORE_FAST, 'b'), (LOAD_FAST, 'b'),
+	                  (RETURN_VALUE, None)], args=['a'])
+	index = code.def_use()
+	assert index.defs('fast', 'b') == [1] and index.uses('fast', 'b') == [2]
+	code.code.insert(0, (NOP, None))
+	assert index.defs('fast', 'b') == [2] and index.uses('fast', 'b') == [3]
+	assert code.def_use() is index
+	# a plain list is copied into a CodeList, which gets a new index
+	code.code = list(code.code)[1:]
+	assert code.def_use() is not index
+	assert code.def_use().uses('fast', 'b') == [2]
+	try:
+		DefUse([(LOAD_FAST, 'a')])
+	except ValueError:
+		pass
+	else:
+		assert False, 'DefUse accepted a plain list'
+
+@needs_35_bytecode
+def test_propagate_constants_round_trip():
+	from byteplay3 import Code, LOAD_FAST
+	from propagate_constants import propagate_constants
+	def f(data):
+		n = 2
+		s = 0
+		for x in data:
+			s += x * n
+		return s
+	g = propagate_constants()(f)
+	assert g is not f and g([1, 2]) == f([1, 2]) == 6
+	assert (LOAD_FAST, 'n') not in Code.from_code(g.__code__).code
+
+@needs_35_bytecode
+def test_type_inference():
+	from byteplay3 import Known, NOP, LOAD_CONST, STORE_FAST, LOAD_FAST, BINARY_ADD, \
+		LOAD_GLOBAL, CALL_FUNCTION, RETURN_VALUE
+	code = make_code([(LOAD_CONST, 2), (STORE_FAST, 'x'), (LOAD_FAST, 'x'),
+	                  (LOAD_CONST, 1.5), (BINARY_ADD, None), (LOAD_GLOBAL, 'len'),
+	                  (LOAD_CONST, 'ab'), (CALL_FUNCTION, 1), (BINARY_ADD, None),
+	                  (RETURN_VALUE, None)])
+	namespace = {}
+	types = code.infer_types(namespace)
+	assert types.local(2, 'x') == Known(2) and types.local(0, 'x') is object
+	assert types.operands(4) == (Known(2), Known(1.5))
+	assert types.stack(5) == (float,)
+	assert types.operands(7) == (Known(len), Known('ab'))
+	assert types.stack(8) == (float, int)
+	assert code.infer_types(namespace) is types
+	# a splice of the code list makes a new inference
+	code.code[0:0] = [(NOP, None)]
+	moved = code.infer_types(namespace)
+	assert moved is not types and moved.stack(9) == (float, int)
+
+_callgraph_source = '''
+import os.path
+from collections import OrderedDict as OD
+from . import sibling
+
+def helper(x):
+    return len(x)
+
+class C:
+    def run(self):
+        return self.step() + helper(1)
+    def step(self):
+        return os.path.join('a', 'b')
+
+def main():
+    OD()
+    sibling.go()
+    obj.run()
+'''
+
+@needs_35_bytecode
+def test_callgraph_resolves_names():
+	import io
+	from byteplay3 import Code
+	from callgraph import code_edges, CallGraph
+	code = Code.from_code(compile(_callgraph_source, 'mod.py', 'exec'))
+	edges = code_edges(code, 'pkg.mod')
+	assert set(edges) == set([
+		('pkg.mod.helper', 'builtins.len', 1),
+		('pkg.mod.C.run', 'pkg.mod.C.step', 1),
+		('pkg.mod.C.run', 'pkg.mod.helper', 1),
+		('pkg.mod.C.step', 'os.path.join', 1),
+		('pkg.mod.main', 'collections.OrderedDict', 1),
+		('pkg.mod.main', 'pkg.sibling.go', 1),
+		('pkg.mod.main', '?obj.run', 1)])
+	graph = CallGraph()
+	graph.merge(edges)
+	assert graph.callers('pkg.mod.helper') == {'pkg.mod.C.run': 1}
+	out = io.StringIO()
+	graph.write(out)
+	again = CallGraph.read(io.StringIO(out.getvalue()))
+	assert sorted(again.iter_edges()) == sorted(edges)
+
+@needs_35_bytecode
+def test_structural_hash_after_change():
+	from byteplay3 import CodeList, SetLineno, LOAD_CONST, RETURN_VALUE
+	c = make_code([(LOAD_CONST, 2), (RETURN_VALUE, None)])
+	d = make_code([(LOAD_CONST, 1), (RETURN_VALUE, None)])
+	assert c != d
+	c.code[0] = (LOAD_CONST, 1)
+	assert c == d and c.structural_hash() == d.structural_hash()
+	c.code = [(LOAD_CONST, 3), (RETURN_VALUE, None)]
+	assert isinstance(c.code, CodeList) and c != d
+	e = make_code([(SetLineno, 5), (LOAD_CONST, 1), (RETURN_VALUE, None)])
+	digest = e.structural_hash(lineno=True)
+	e.firstlineno = 2
+	assert e.structural_hash(lineno=True) != digest
+
+@needs_35_bytecode
+def test_structural_hash_of_numbers():
+	from byteplay3 import LOAD_CONST, RETURN_VALUE
+	def returning(value):
+		return make_code([(LOAD_CONST, value), (RETURN_VALUE, None)])
+	# pairs whose Python hash() is the same, or which are ==
+	for a, b in [(-1, -2), (0, 2**61 - 1), (1, 1.0), (1, True), (0.0, -0.0),
+	             ((1, 2), (1.0, 2)), (frozenset([1]), frozenset([True]))]:
+		assert returning(a) != returning(b)
+		assert returning(a).structural_hash() != returning(b).structural_hash()
+	assert returning(2**61 - 1) == returning(2**61 - 1)
+	assert returning((1, 'a')).structural_hash() == returning((1, 'a')).structural_hash()
+
+@needs_35_bytecode
+def test_diff_of_large_code():
+	import random
+	import time
+	from byteplay3 import LOAD_FAST, POP_TOP, LOAD_CONST, RETURN_VALUE
+	rng = random.Random(5)
+	items = []
+	for i in range(10000):
+		items.extend([(LOAD_FAST, rng.choice('xyz')), (POP_TOP, None)])
+	changed = list(items)
+	for pos in rng.sample(range(0, len(items), 2), 200):
+		changed[pos] = (LOAD_FAST, 'w')
+	end = [(LOAD_CONST, None), (RETURN_VALUE, None)]
+	start = time.perf_counter()
+	entries = make_code(items + end).diff(make_code(changed + end)).entries
+	assert time.perf_counter() - start < 1.0
+	assert len(entries) == 200
+	assert all(tag == 'replace' and i2 - i1 == j2 - j1 == 1
+	           for tag, i1, i2, j1, j2, detail in entries)
+	# code with nothing in common takes no longer to compare
+	other = []
+	for i in range(10000):
+		other.extend([(LOAD_FAST, rng.choice('uvw')), (LOAD_CONST, rng.choice((1, 2)))])
+	start = time.perf_counter()
+	entries = make_code(items).diff(make_code(other)).entries
+	assert time.perf_counter() - start < 1.0
+	assert entries == [('replace', 0, len(items), 0, len(other), None)]
+
+@needs_35_bytecode
+def test_peephole_keeps_captures_apart():
+	from byteplay3 import LOAD_FAST, STORE_FAST
+	from peephole import Any, Op, Ref, Repeat, Rewriter, Rule
+	items = [(LOAD_FAST, 'x'), (LOAD_FAST, 'y'), (STORE_FAST, 'y')]
+	# the thread started at x fails, the later one started at y must not
+	# have been dropped as a duplicate of it
+	ref = Rule([Op(LOAD_FAST, name='a'), Repeat(Any()), Op(STORE_FAST, arg=Ref('a'))],
+	           [], name='ref')
+	match = Rewriter([ref]).search(items)
+	assert (match.start, match.end) == (1, 3)
+	where = Rule([Op(LOAD_FAST, name='a'), Repeat(Any()), Op(STORE_FAST)],
+	             [], where=lambda c: c['a'][1] == 'y', name='where')
+	match = Rewriter([where]).search(items)
+	assert (match.start, match.end, match.captures['a']) == (1, 3, (LOAD_FAST, 'y'))
+	# without a Ref or where, the first start still wins
+	plain = Rule([Op(LOAD_FAST), Repeat(Any()), Op(STORE_FAST)], [], name='plain')
+	match = Rewriter([plain]).search(items)
+	assert (match.start, match.end) == (0, 3)
+
+@needs_35_bytecode
+def test_codeindex_update_find_compact():
+	import tempfile
+	from byteplay3 import LOAD_GLOBAL
+	from codeindex import CodeIndex
+	from corpus import compile_file, walk_code
+	with tempfile.TemporaryDirectory() as directory:
+		source = os.path.join(directory, 'src')
+		os.mkdir(source)
+		def write(name, text):
+			with open(os.path.join(source, name), 'w') as out:
+				out.write(text)
+			return os.path.join(source, name)
+		a = write('idx_a.py', 'def f():\n    exec("1")\n')
+		b = write('idx_b.py', 'def g():\n    return 1\n')
+		write('idx_bad.py', 'def (\n')
+		def found():
+			return sorted((path, qualname) for path, qualname, pos
+			              in index.find(LOAD_GLOBAL, 'exec'))
+		with CodeIndex(os.path.join(directory, 'index')) as index:
+			assert index.update([source], root=source, processes=1) == (2, 0)
+			assert found() == [(a, 'idx_a.f')]
+			# the position is that of the instruction in the Code of f
+			[(path, qualname, pos)] = index.find('LOAD_GLOBAL', 'exec')
+			codes = dict(walk_code(compile_file(a), 'idx_a'))
+			assert codes['idx_a.f'].code[pos] == (LOAD_GLOBAL, 'exec')
+			assert ('idx_a.f' in [q for p, q, i in index.find('LOAD_GLOBAL')])
+			# nothing changed, nothing is indexed again
+			assert index.update([source], root=source, processes=1) == (0, 0)
+			write('idx_b.py', 'def g():\n    exec("2")\n    return 1\n')
+			assert index.update([source], root=source, processes=1) == (1, 0)
+			assert found() == [(a, 'idx_a.f'), (b, 'idx_b.g')]
+			assert len(index.manifest['segments']) == 2
+			os.remove(a)
+			assert index.update([source], root=source, processes=1) == (0, 1)
+			assert found() == [(b, 'idx_b.g')]
+			index.compact()
+			assert found() == [(b, 'idx_b.g')]
+			assert index.files() == [b]
+		# one segment is left, and the index reopens from its manifest
+		assert sorted(os.listdir(os.path.join(directory, 'index'))) \
+			== ['manifest.json', 'segment-2.bpix']
+		with CodeIndex(os.path.join(directory, 'index')) as index:
+			assert found() == [(b, 'idx_b.g')]
+
+def _covered(x):
+	if x:
+		return 1
+	return 2
+
+@needs_35_bytecode
+def test_coverage_collect_and_uninstrument():
+	from instrument import Coverage
+	original = _covered.__code__
+	first = original.co_firstlineno
+	coverage = Coverage()
+	assert coverage.instrument(_covered)
+	assert not coverage.instrument(_covered)
+	assert _covered.__code__ is not original
+	assert [_covered(1), _covered(1), _covered(0)] == [1, 1, 2]
+	lines = coverage.collect()[original.co_filename]
+	assert lines == {first + 1: 3, first + 2: 2, first + 3: 1}
+	coverage.uninstrument()
+	assert _covered.__code__ is original and not coverage.originals
+	# the counters are kept, and no longer change
+	_covered(0)
+	assert coverage.collect()[original.co_filename] == lines
+	coverage.reset()
+	assert set(coverage.collect()[original.co_filename].values()) == {0}
+
+def _blocks(n):
+	total = 0
+	for i in range(n):
+		if i % 2:
+			total += i
+	return total
+
+@needs_35_bytecode
+def test_block_profile_counts():
+	from instrument import BlockProfile
+	original = _blocks.__code__
+	where = (original.co_filename, '_blocks', original.co_firstlineno)
+	profile = BlockProfile()
+	assert profile.instrument(_blocks)
+	assert _blocks(4) == 4
+	counts = profile.collect()[where]
+	# entry once, the loop test 5 times, the body 4 times, the odd branch 2
+	assert counts[0] == 1 and {5, 4, 2} <= set(counts)
+	# instrumenting it again with the same profile changes nothing
+	assert not profile.instrument(_blocks)
+	_blocks(4)
+	assert profile.collect()[where] == [2 * count for count in counts]
+	# another profile counts on top of the first, with the same blocks
+	second = BlockProfile()
+	assert second.instrument(_blocks)
+	_blocks(4)
+	assert second.collect()[where] == counts
+	assert profile.collect()[where] == [3 * count for count in counts]
+	assert '_blocks' in profile.report('_blocks')
+	second.uninstrument()
+	profile.uninstrument()
+	assert _blocks.__code__ is original
+
+def _timed_return(x):
+	return x + 1
+
+def _timed_raise():
+	raise KeyError('k')
+
+def _timed_generator(n):
+	for i in range(n):
+		yield i
+
+@needs_35_bytecode
+def test_timing_exits():
+	import itertools
+	from instrument import Timing
+	# a clock that advances by one at each reading, so that each stretch
+	# of time measured is 1
+	timing = Timing(clock=itertools.count().__next__)
+	functions = [_timed_return, _timed_raise, _timed_generator]
+	originals = [f.__code__ for f in functions]
+	for f in functions:
+		assert timing.instrument(f)
+	assert _timed_return(1) == 2 and _timed_return(2) == 3
+	try:
+		_timed_raise()
+	except KeyError:
+		pass
+	else:
+		assert False, 'the exception was lost'
+	assert list(_timed_generator(2)) == [0, 1]
+	times = {name: value for (filename, name, first), value in timing.collect().items()}
+	assert times['_timed_return'] == (2, 2.0)
+	assert times['_timed_raise'] == (1, 1.0)
+	# the time is added up at each yield and at the end, so the time the
+	# generator is suspended is left out
+	assert times['_timed_generator'] == (1, 3.0)
+	assert '_timed_generator' in timing.report()
+	timing.uninstrument()
+	assert [f.__code__ for f in functions] == originals
+	timing.reset()
+	assert set(timing.collect().values()) == {(0, 0.0)}
+
+@needs_35_bytecode
+def test_offset_map_round_trip():
+	import opcode
+	import types
+	from byteplay3 import Code, Label, SetLineno, NOP, LOAD_FAST, LOAD_CONST, \
+		POP_JUMP_IF_FALSE, RETURN_VALUE
+	end = Label()
+	items = [(SetLineno, 1), (LOAD_FAST, 'x'), (POP_JUMP_IF_FALSE, end), (NOP, None),
+	         (end, None), (SetLineno, 2), (LOAD_CONST, None), (RETURN_VALUE, None)]
+	code = make_code(items, args=['x'])
+	code_object, offsets = code.to_code(offset_map=True)
+	assert len(offsets) == 5 and offsets.size == len(code_object.co_code) == 11
+	# a label or SetLineno has the offset of the instruction after it
+	assert [offsets.offset(pos) for pos in range(8)] == [0, 0, 3, 6, 7, 7, 7, 10]
+	for pos in (1, 2, 3, 6, 7):
+		assert offsets.position(offsets.offset(pos)) == pos
+	# an offset within an instruction is that of the instruction
+	assert [offsets.position(offset) for offset in range(11)] \
+		== [1, 1, 1, 2, 2, 2, 3, 6, 6, 6, 7]
+	try:
+		offsets.position(offsets.size)
+	except IndexError:
+		pass
+	else:
+		assert False, 'an offset past the end was accepted'
+	again, back = Code.from_code(code_object, offset_map=True)
+	assert list(back.offsets) == list(offsets.offsets)
+	assert list(back.positions) == list(offsets.positions)
+	assert again.to_code().co_code == code_object.co_code
+	# an instruction with an EXTENDED_ARG starts at the EXTENDED_ARG
+	co_code = bytes([opcode.EXTENDED_ARG, 1, 0, LOAD_CONST, 1, 0, RETURN_VALUE])
+	code_object = types.CodeType(0, 0, 0, 1, 0, co_code, tuple(range(65538)), (), (),
+	                             'test.py', 'f', 1, b'')
+	code, offsets = Code.from_code(code_object, offset_map=True)
+	load = code.code.index((LOAD_CONST, 65537))
+	assert code.code[load + 1] == (RETURN_VALUE, None)
+	assert [offsets.position(offset) for offset in range(7)] == [load] * 6 + [load + 1]
+	assert (offsets.offset(load), offsets.offset(load + 1)) == (0, 6)
+
+class _AllocPair(object):
+	pass
+
+def _allocating(n):
+	items = []
+	for i in range(n):
+		items.append((i, i))
+	_AllocPair()
+	return dict(items)
+
+@needs_35_bytecode
+def test_allocation_sites():
+	from instrument import AllocationSites
+	first = _allocating.__code__.co_firstlineno
+	sites = AllocationSites(['_AllocPair'])
+	assert sites.instrument(_allocating)
+	assert _allocating(3) == {0: 0, 1: 1, 2: 2}
+	counts = {(lineno - first, op, constructor): count
+	          for count, (filename, name, lineno, op, constructor) in sites.collect()}
+	assert counts == {(1, 'BUILD_LIST', None): 1, (3, 'BUILD_TUPLE', None): 3,
+	                  (4, 'CALL_FUNCTION', '_AllocPair'): 1, (5, 'CALL_FUNCTION', 'dict'): 1}
+	assert sites.collect()[0][0] == 3
+	assert 'BUILD_TUPLE' in sites.report(1) and 'dict' not in sites.report(1)
+	sites.uninstrument()
+
+@needs_35_bytecode
+def test_record_phases():
+	import itertools
+	import byteplay3
+	from byteplay3 import Code, PhaseTimes, record_phases, LOAD_CONST, MAKE_FUNCTION, \
+		RETURN_VALUE
+	inner = make_code([(LOAD_CONST, 1), (RETURN_VALUE, None)], name='g')
+	code = make_code([(LOAD_CONST, inner), (LOAD_CONST, 'g'), (MAKE_FUNCTION, 0),
+	                  (RETURN_VALUE, None)])
+	# off unless asked for: no recorder, and nothing recorded
+	assert byteplay3._phase_recorder is None
+	unused = PhaseTimes()
+	Code.from_code(code.to_code())
+	assert unused.totals == {}
+	clock = itertools.count().__next__
+	with record_phases(PhaseTimes(clock)) as outer:
+		code_object = code.to_code()
+		with record_phases(PhaseTimes(clock)) as nested:
+			assert byteplay3._phase_recorder is nested
+			before = clock()
+			Code.from_code(code_object)
+			after = clock()
+		assert byteplay3._phase_recorder is outer
+	assert byteplay3._phase_recorder is None
+	assert 'to_code' not in nested.totals
+	# the from_code of the nested code object is a phase in the decode phase
+	assert nested.totals['from_code'][0] == 2 and nested.totals['decode'][0] == 2
+	# the nested times were added into the outer recorder
+	assert outer.totals['to_code'][0] == 2 and outer.totals['from_code'][0] == 2
+	# the exclusive times add up to the time of the outermost phase, which
+	# began at the reading of the clock after before, and ended at the one
+	# before after
+	assert sum(total[1] for total in nested.totals.values()) == after - before - 2
+	# the recorder is put back when an exception leaves the block
+	try:
+		with record_phases():
+			raise KeyError('k')
+	except KeyError:
+		pass
+	assert byteplay3._phase_recorder is None
+
+@needs_35_bytecode
+def test_code_cost():
+	from byteplay3 import Label, LOAD_FAST, LOAD_CONST, POP_JUMP_IF_FALSE, JUMP_ABSOLUTE, \
+		RETURN_VALUE, MAKE_FUNCTION, GET_ITER, CALL_FUNCTION
+	from costmodel import code_cost
+	# every instruction costs 1, so a score counts instructions
+	ones = {'other': 1}
+	outer, inner, end = Label(), Label(), Label()
+	code = make_code([(LOAD_FAST, 'n'), (POP_JUMP_IF_FALSE, end),
+	                  (outer, None), (LOAD_FAST, 'n'), (POP_JUMP_IF_FALSE, end),
+	                  (inner, None), (LOAD_FAST, 'n'), (POP_JUMP_IF_FALSE, outer),
+	                  (JUMP_ABSOLUTE, inner),
+	                  (end, None), (LOAD_CONST, None), (RETURN_VALUE, None)], args=['n'])
+	cost = code_cost(code, ones, trip_count=3)
+	assert [(depth, score) for block, depth, score in cost.blocks if score] \
+		== [(0, 2), (1, 2 * 3), (2, 2 * 9), (2, 1 * 9), (0, 2)]
+	assert cost.score == 37
+	assert code_cost(code, ones).score == 2 + 20 + 200 + 100 + 2
+	# a comprehension runs as part of the code that makes it, a function not
+	def making(name):
+		made = make_code([(LOAD_CONST, None), (RETURN_VALUE, None)], name=name)
+		return make_code([(LOAD_CONST, made), (LOAD_CONST, 'f.' + name), (MAKE_FUNCTION, 0),
+		                  (LOAD_FAST, 'n'), (GET_ITER, None), (CALL_FUNCTION, 1),
+		                  (RETURN_VALUE, None)], args=['n'])
+	comprehension = code_cost(making('<listcomp>'), ones)
+	function = code_cost(making('g'), ones)
+	assert (comprehension.score, function.score) == (9, 7)
+	assert [(cost.name, cost.score) for cost in function.walk()] == [('f', 7), ('f.g', 2)]
+	assert 'loop depth 2' in code_cost(code, ones).report()
+
+def nested_loops_code():
+	# for x in a:
+	#     for y in x.items():
+	#         len(y)
+	from byteplay3 import Label, SetLineno, SETUP_LOOP, LOAD_FAST, GET_ITER, FOR_ITER, \
+		STORE_FAST, LOAD_GLOBAL, LOAD_ATTR, CALL_FUNCTION, POP_TOP, JUMP_ABSOLUTE, \
+		POP_BLOCK, LOAD_CONST, RETURN_VALUE
+	outer_end, outer_top, outer_exit = Label(), Label(), Label()
+	inner_end, inner_top, inner_exit = Label(), Label(), Label()
+	return make_code([
+		(SetLineno, 1),
+		(SETUP_LOOP, outer_end), (LOAD_FAST, 'a'), (GET_ITER, None),
+		(outer_top, None), (FOR_ITER, outer_exit), (STORE_FAST, 'x'),
+		(SetLineno, 2),
+		(SETUP_LOOP, inner_end), (LOAD_FAST, 'x'), (LOAD_ATTR, 'items'),
+		(CALL_FUNCTION, 0), (GET_ITER, None),
+		(inner_top, None), (FOR_ITER, inner_exit), (STORE_FAST, 'y'),
+		(SetLineno, 3),
+		(LOAD_GLOBAL, 'len'), (LOAD_FAST, 'y'), (CALL_FUNCTION, 1), (POP_TOP, None),
+		(JUMP_ABSOLUTE, inner_top),
+		(inner_exit, None), (POP_BLOCK, None), (inner_end, None),
+		(JUMP_ABSOLUTE, outer_top),
+		(outer_exit, None), (POP_BLOCK, None), (outer_end, None),
+		(LOAD_CONST, None), (RETURN_VALUE, None)], args=['a'])
+
+@needs_35_bytecode
+def test_flowgraph_loop_nesting():
+	from byteplay3 import FlowGraph
+	loops = FlowGraph(nested_loops_code().code).loops()
+	assert len(loops) == 2
+	outer = [loop for loop in loops if loop.depth == 1][0]
+	inner = [loop for loop in loops if loop.depth == 2][0]
+	assert inner.parent is outer and outer.parent is None
+	assert outer.children == [inner]
+	assert inner.blocks < outer.blocks
+	assert outer.kind == inner.kind == 'for'
+
+@needs_35_bytecode
+def test_code_loops():
+	from loopreport import code_loops, LoopRecord
+	records = code_loops(nested_loops_code(), 'mod', 'f')
+	assert records == [
+		LoopRecord('mod', 'f', 1, 'for', 1, 16, ('len',), ('items',)),
+		LoopRecord('mod', 'f', 2, 'for', 2, 7, ('len',), ())]
+
+@needs_35_bytecode
+def test_loop_report_module_names():
+	import tempfile
+	from loopreport import file_loops, loop_report
+	with tempfile.TemporaryDirectory() as directory:
+		os.mkdir(os.path.join(directory, 'pkg'))
+		path = os.path.join(directory, 'pkg', 'mod.py')
+		with open(path, 'w') as out:
+			out.write('def f(a):\n    for x in a:\n        while x:\n            x -= 1\n')
+		found, records = file_loops(path, directory)
+		assert found == path
+		assert [(record.module, record.function, record.line, record.kind, record.depth)
+		        for record in records] \
+			== [('pkg.mod', 'f', 2, 'for', 1), ('pkg.mod', 'f', 3, 'while', 2)]
+		records = loop_report([directory], sort='depth', processes=1, root=directory)
+		assert [(record.module, record.depth) for record in records] \
+			== [('pkg.mod', 2), ('pkg.mod', 1)]
+		# without a root, the module is named after the file alone
+		assert loop_report([path], processes=1)[0].module == 'mod'
+
+_sample_module = '''
+SCALE = 3
+FACTOR = 1
+
+def scaled(values):
+    total = 0
+    for v in values:
+        total += abs(v) * SCALE * FACTOR
+    return total
+
+def set_factor(n):
+    global FACTOR
+    FACTOR = n
+'''
+
+@needs_35_bytecode
+def test_guided_constants_round_trip():
+	import tempfile
+	import importlib
+	from guided_constants import profile_run, scan_sources, make_plan, write_plan, apply_plan
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'guided_sample.py')
+		with open(path, 'w') as out:
+			out.write(_sample_module)
+		sys.path.insert(0, directory)
+		importlib.invalidate_caches()
+		try:
+			module = importlib.import_module('guided_sample')
+			profile = profile_run(lambda: module.scaled([1, -2]), module)
+			plan = make_plan(profile, scan_sources([path], directory))
+			assert [(entry['qualname'], entry['stoplist']) for entry in plan['functions']] \
+				== [('scaled', ['FACTOR'])]
+			plan_file = os.path.join(directory, 'constants.plan')
+			write_plan(plan, plan_file)
+			with open(plan_file) as source:
+				text = source.read()
+			write_plan(make_plan(profile, scan_sources([path], directory)), plan_file)
+			with open(plan_file) as source:
+				assert source.read() == text
+			original = module.scaled
+			apply_plan(plan_file, 'guided_sample')
+			assert module.scaled is not original
+			assert 'SCALE' not in module.scaled.__code__.co_names
+			assert module.scaled([1, -2]) == 9
+			module.set_factor(2)
+			assert module.scaled([1, -2]) == 18
+		finally:
+			sys.path.remove(directory)
+			sys.modules.pop('guided_sample', None)
+
+@needs_35_bytecode
+def test_block_layout_round_trip():
+	from instrument import BlockProfile
+	from block_layout import block_layout
+	def f(x):
+		if x < 0:
+			raise ValueError('negative')
+		return x + 1
+	profile = BlockProfile()
+	profile.instrument(f)
+	for i in range(100):
+		f(i)
+	profile.uninstrument()
+	g = block_layout(profile.collect())(f)
+	assert g is not f and g(3) == f(3) == 4
+	try:
+		g(-1)
+	except ValueError:
+		pass
+	else:
+		assert False, 'the moved raise was lost'